@@ -8,6 +8,7 @@ Title: Grassmann Optimization
 """
 
 import numpy as np
+from Stiefel_Optimization import Frame_Grams, Center_Mass_GD_Grams
 
 
 """
@@ -33,22 +34,20 @@ class Grassmann_Optimization:
     
     def Center_Mass_function_gradient_pFrobenius(self, Y):
         # find the value and grad of the projected Frobenius distance center of mass function f(A) = \sum_{k=1}^m w_k |AA^T-A_kA_k^T|_F^2 on Gr(p, n)
-        A = Y
-        m = len(self.omega)
-        n = len(A)
-        p = len(A[0])
+        # all n x n projectors are avoided by the p x p cross-Grams A^TA_k: 
+        # |AA^T-A_kA_k^T|_F^2 = |A^TA|_F^2 + |A_k^TA_k|_F^2 - 2|A^TA_k|_F^2 (= 2p - 2|A^TA_k|_F^2 for orthonormal A, A_k)
+        A = np.array(Y, dtype=float)
+        omega = np.asarray(self.omega, dtype=float)
+        Seq = np.asarray(self.Seq, dtype=float)
+        # the cross-Grams A_k^TA and the Grams A^TA, A_k^TA_k
+        cross = np.einsum('knp,nq->kpq', Seq, A)
+        gram_A = np.matmul(A.T, A)
+        gram_Seq = np.einsum('knp,knq->kpq', Seq, Seq)
         # calculate the value f(A) = \sum_{k=1}^m w_k |AA^T-A_kA_k^T|_F^2 on Gr(p, n)
-        value = 0
-        for k in range(m):
-            Mtx = np.matmul(A, A.T) - np.matmul(self.Seq[k], self.Seq[k].T)
-            value = value + self.omega[k]*((np.linalg.norm(Mtx))**2)
-        # calculate grad f(A) =  \sum_{k=1}^m (I-AA^T)(2 w_k A-4 w_k A_kA_k^TA)
-        grad = np.zeros((n, p), dtype=float)
-        for k in range(m):
-            M1 = A * (2 * self.omega[k])
-            M2 = np.matmul(np.matmul(self.Seq[k], self.Seq[k].T), A) * (4 * self.omega[k])
-            grad = grad + M1 - M2;
-        grad = grad - np.matmul(np.matmul(A, A.T), grad)
+        value = np.sum(omega * (np.sum(gram_A**2) + np.sum(gram_Seq**2, axis=(1, 2)) - 2*np.sum(cross**2, axis=(1, 2))))
+        # calculate grad f(A) =  \sum_{k=1}^m (I-AA^T)(2 w_k A-4 w_k A_kA_k^TA), with A_k (A_k^TA) instead of (A_kA_k^T) A
+        grad = 2 * np.sum(omega) * A - 4 * np.einsum('k,knp,kpq->nq', omega, Seq, cross)
+        grad = grad - np.matmul(A, np.matmul(A.T, grad))
         return value, grad
     
     def Center_Mass_pFrobenius(self):
@@ -58,23 +57,143 @@ class Grassmann_Optimization:
         p = len(self.Seq[0][0])
         # total weight is the sum of all weights \sum_{k=1}^m w_k
         total_weight = sum(self.omega)
-        # compute the matrix Mtx = \sum_{k=1}^m (w_k/total weight)A_kA_k^T
-        Mtx = np.zeros((n, n), dtype=float)
-        for k in range(m):
-            Mtx = Mtx + np.matmul(self.Seq[k], self.Seq[k].T)*(self.omega[k]/total_weight)
-        # do an svd decomposition Q D Q1 = Mtx
-        Q, D, Q1 = np.linalg.svd(Mtx, full_matrices=True)
-        # obtain the identity matrix eye_p = diag(1, 1, ..., 1) in dimension p
-        eye_p = np.zeros((p, p), dtype=float)
-        np.fill_diagonal(eye_p, 1)
-        # form I = (eye_p; 0_{n-p, p})
-        I = np.pad(eye_p, ((0,n-p), (0,0)), 'constant', constant_values = (0,0))
-        # the p-Frobenius center of mass is given by QI
-        pF_Center = np.matmul(Q , I)
+        # the matrix Mtx = \sum_{k=1}^m (w_k/total weight)A_kA_k^T is C C^T for the n x (mp) stack C = [sqrt(w_1/total weight)A_1, ..., sqrt(w_m/total weight)A_m]
+        C = np.concatenate([np.sqrt(self.omega[k]/total_weight) * np.asarray(self.Seq[k], dtype=float) for k in range(m)], axis=1)
+        # the left singular vectors of C are the eigenvectors of Mtx, do a thin svd decomposition Q D Q1 = C
+        Q, D, Q1 = np.linalg.svd(C, full_matrices=False)
+        # the p-Frobenius center of mass is given by the first p columns of Q
+        pF_Center = Q[:, :p]
         # evaluate the value and gradient on Gr(p, n) of the p-Frobenius center of mass
         value, grad = self.Center_Mass_function_gradient_pFrobenius(pF_Center)
         
         return pF_Center, value, grad
+    
+    def Center_Mass_GD_pFrobenius(self, Y=None, iteration=100, lr=1.0, lrdecayrate=1.0, method='cg'):
+        # find the projected Frobenius center of mass on Gr(p, n) via Riemannian gradient descent started from Y, or from the closed-form center if Y is None
+        # Y is added to the frames with weight 0, so the iteration runs on the coefficients of Frame_Grams, see Center_Mass_GD_Grams for iteration, lr, lrdecayrate and method
+        # returns the center, the sequences of values and gradient norms (one entry more than the iterations) and the number of iterations
+        if Y is None:
+            Y = self.Center_Mass_pFrobenius()[0]
+        Y = np.array(Y, dtype=float)
+        p = len(Y[0])
+        grams = Frame_Grams(np.concatenate((np.asarray(self.Seq, dtype=float), [Y])))
+        omega = np.append(np.asarray(self.omega, dtype=float), 0)
+        C = np.zeros((len(omega), p, p), dtype=float)
+        C[-1] = np.identity(p)
+        C, valueseq, gradnormseq, iterations = Center_Mass_GD_Grams(grams, grams.function_gradient_pFrobenius, C, omega, None, True, 
+                                                                    self.thereshold_gradnorm, self.threshold_fixedpoint, iteration, lr, lrdecayrate, method)
+        GD_pF_Center = grams.frame(C)
+        return GD_pF_Center, valueseq, gradnormseq, iterations
+    
+    def Center_Mass_Arc(self, Y=None, iteration=100):
+        # find the arc-distance (natural geodesic distance) center of mass, the Karcher mean minimizing f(A)=\sum_{k=1}^m w_k d^2(A, A_k) on Gr(p, n), 
+        # via the fixed-point iteration of Center_Mass_Arc_Batch started from Y, or from the projected Frobenius center if Y is None, up to threshold_fixedpoint
+        # returns the center, the value f and the gradient norm at the center, the number of iterations and whether the iteration converged
+        centers, values, gradnorms, iterations, converged = Center_Mass_Arc_Batch([self.omega], [self.Seq], None, None if Y is None else [Y], 
+                                                                                   self.threshold_fixedpoint, iteration)
+        return centers[0], values[0], gradnorms[0], iterations[0], converged[0]
+
+
+
+
+
+# the Grassmann exponential map exp_Y(H) of stacks of points Y on Gr(p, n) (orthonormal n x p representatives) and horizontal tangent vectors H, both (..., n, p)
+# with the thin svd H = U S V', exp_Y(H) = Y V cos(S) V' + U sin(S) V'
+def exp_grassmann(Y, H):
+    U, S, Vt = np.linalg.svd(H, full_matrices=False)
+    exp = np.matmul(np.matmul(Y, np.swapaxes(Vt, -2, -1)) * np.cos(S)[..., None, :] + U * np.sin(S)[..., None, :], Vt)
+    return exp
+
+
+# the Grassmann logarithmic map log_Y(Y_tilde) of stacks of points Y and Y_tilde on Gr(p, n), both (..., n, p), with two stacked thin svds and no inverse: 
+# rotate Y_tilde by the svd Q S R' = Y_tilde'Y into Y_tilde Q R', then with the thin svd U S V' = (I-YY') Y_tilde Q R', log_Y(Y_tilde) = U arcsin(S) V'
+# returns log and the principal angles arcsin(S) between Y and Y_tilde
+def log_grassmann(Y, Y_tilde):
+    Q, S, Rt = np.linalg.svd(np.matmul(np.swapaxes(Y_tilde, -2, -1), Y))
+    Y_rotated = np.matmul(Y_tilde, np.matmul(Q, Rt))
+    U, S, Vt = np.linalg.svd(Y_rotated - np.matmul(Y, np.matmul(np.swapaxes(Y, -2, -1), Y_rotated)), full_matrices=False)
+    angles = np.arcsin(np.minimum(S, 1))
+    log = np.matmul(U * angles[..., None, :], Vt)
+    return log, angles
+
+
+# the frame sets of the queries rows as a padded (len(rows), m_max, n, p) tensor, sliced from the padded Seq, or gathered from the (N, n, p) Seq with the indexes
+def gather_frames(Seq, indexes, rows):
+    if indexes is None:
+        return np.asarray(Seq[rows], dtype=float)
+    indexes = np.asarray(indexes)[rows]
+    return np.asarray(Seq, dtype=float)[np.where(indexes < 0, 0, indexes)]
+
+
+# the number of queries whose (m_max, n, p) frame sets and the work arrays of the same size, about work_copies of them, fit in memory_budget bytes
+def chunk_queries(Seq, indexes, work_copies, memory_budget):
+    m = np.shape(Seq)[1] if indexes is None else np.shape(indexes)[1]
+    n, p = np.shape(Seq)[-2:]
+    return max(1, memory_budget // (8 * work_copies * m * n * p))
+
+
+# the projected Frobenius centers of mass of T weighted frame sets at once, the first p left singular vectors of the stacks [sqrt(w_{t,1})A_{t,1}, ..., sqrt(w_{t,m})A_{t,m}]
+# the frame sets are given as in Center_Mass_Euclid_Batch, the padded (T, m_max, n, p) tensor Seq, or the (N, n, p) array Seq with the (T, m_max) indexes,
+# and are gathered chunk by chunk of queries, so that the gathered frames and the stacked svd take about memory_budget bytes
+# returns the (T, n, p) centers
+def Center_Mass_pFrobenius_Batch(omega, Seq, indexes=None, memory_budget=2**28):
+    omega = np.asarray(omega, dtype=float)
+    T = len(omega)
+    n, p = np.shape(Seq)[-2:]
+    centers = np.zeros((T, n, p), dtype=float)
+    chunk = chunk_queries(Seq, indexes, 3, memory_budget)
+    for start in range(0, T, chunk):
+        rows = slice(start, start+chunk)
+        Seq_chunk = gather_frames(Seq, indexes, rows)
+        T_chunk, m = Seq_chunk.shape[:2]
+        # the n x (mp) stacks, one stacked thin svd
+        C = np.transpose(np.sqrt(omega[rows])[:, :, None, None] * Seq_chunk, (0, 2, 1, 3)).reshape(T_chunk, n, m*p)
+        U, D, Vt = np.linalg.svd(C, full_matrices=False)
+        centers[rows] = U[:, :, :p]
+    return centers
+
+
+# the arc-distance (Karcher) centers of mass of T weighted frame sets at once, the Gr(p, n) minimizers of f(A)=\sum_{k=1}^m w_{t,k} d^2(A, A_{t,k}) with d the geodesic distance
+# the frame sets are given as in Center_Mass_pFrobenius_Batch, and Y (T, n, p) is the starting point, the projected Frobenius centers if None
+# fixed-point iteration Y <- exp_Y(\sum_k w_{t,k} log_Y(A_{t,k}) / \sum_k w_{t,k}) on all queries of a chunk at once with stacked thin svds, 
+# a query stops once the norm of its step is below threshold, the others go on, up to iteration steps
+# the queries are processed chunk by chunk, so that the gathered frames and the logarithms of a chunk take about memory_budget bytes
+# the number of iterations grows with the spread of the frames: a few for nearby frames, a few tens (and some queries hit iteration) for widely spread ones
+# returns the (T, n, p) centers, the (T) values of f and the (T) gradient norms 2\|\sum_k w_{t,k} log_Y(A_{t,k})\|_F at the centers, the (T) numbers of iterations,
+# and the (T) flags converged, False for the queries stopped by iteration with a step still above threshold
+def Center_Mass_Arc_Batch(omega, Seq, indexes=None, Y=None, threshold=1e-4, iteration=100, memory_budget=2**28):
+    omega = np.asarray(omega, dtype=float)
+    if Y is None:
+        Y = Center_Mass_pFrobenius_Batch(omega, Seq, indexes, memory_budget)
+    centers = np.array(Y, dtype=float)
+    weights = omega / np.sum(omega, axis=1, keepdims=True)
+    T = len(centers)
+    values = np.zeros(T, dtype=float)
+    gradnorms = np.zeros(T, dtype=float)
+    iterations = np.zeros(T, dtype=int)
+    converged = np.zeros(T, dtype=bool)
+    chunk = chunk_queries(Seq, indexes, 4, memory_budget)
+    for start in range(0, T, chunk):
+        Seq_chunk = gather_frames(Seq, indexes, slice(start, start+chunk))
+        # the active queries, and their rows in the chunk
+        active = np.arange(start, start+len(Seq_chunk))
+        for i in range(iteration+1):
+            # the logarithms of all frames of the active queries at their current centers, (T_active, m, n, p)
+            logs, angles = log_grassmann(centers[active, None], Seq_chunk[active-start])
+            step = np.einsum('tk,tknp->tnp', weights[active], logs)
+            values[active] = np.einsum('tk,tkp->t', omega[active], angles**2)
+            step_norm = np.linalg.norm(step, axis=(1, 2))
+            gradnorms[active] = 2 * np.sum(omega[active], axis=1) * step_norm
+            converged[active] = step_norm < threshold
+            if i == iteration:
+                break
+            # move the queries that have not converged
+            active, step = active[~converged[active]], step[~converged[active]]
+            if len(active) == 0:
+                break
+            centers[active] = exp_grassmann(centers[active], step)
+            iterations[active] = iterations[active] + 1
+    return centers, values, gradnorms, iterations, converged
 
 
 
@@ -98,7 +217,7 @@ if __name__ == "__main__":
     Seq[2] = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
     # set the weights
     omega = np.array([1, 10, 100])
-    omega = omega.astype(np.float)
+    omega = omega.astype(float)
     # set the threshold numbers
     threshold_gradnorm = 1e-7
     threshold_fixedpoint = 1e-4
@@ -117,4 +236,32 @@ if __name__ == "__main__":
     
     
     
-    
\ No newline at end of file
+    
+
+
+    # do the Gram-based evaluation at the p-Frobenius center, from its coefficients on the frames
+    doFrameGrams = 1
+    if doFrameGrams:
+        grams = Frame_Grams(Seq)
+        center, value, grad = GrassmannOpt.Center_Mass_pFrobenius()
+        value_grams, D, gradnorm_grams = grams.function_gradient_pFrobenius(grams.coefficients(center), omega)
+        print("Gram-based value is ", value_grams, " gradnorm is ", gradnorm_grams, "\n")
+
+
+    # do the p-Frobenius center of mass by Riemannian GD from a perturbed second frame (the frames themselves are critical points here), 
+    # with fixed steps, Armijo line search and conjugate gradients
+    doCenterMassGDpFrobenius = 1
+    if doCenterMassGDpFrobenius:
+        Y = np.linalg.qr(Seq[1] + 0.1 * np.random.randn(n, p))[0]
+        for method in ['gd', 'armijo', 'cg']:
+            center, valueseq, gradnormseq, iterations = GrassmannOpt.Center_Mass_GD_pFrobenius(Y, 1000, 0.002, 1.0, method)
+            print(method, ": iterations = ", iterations, " value = ", valueseq[-1], " gradnorm = ", gradnormseq[-1], "\n")
+
+
+    # do the arc-distance (Karcher) center of mass from the p-Frobenius center, for the frame set above and, batched, for it and its last two frames
+    doCenterMassArc = 1
+    if doCenterMassArc:
+        center, value, gradnorm, iterations, converged = GrassmannOpt.Center_Mass_Arc()
+        print("arc center is \n", center, "\nvalue is ", value, "\ngradnorm is ", gradnorm, "\niterations = ", iterations, " converged = ", converged, "\n")
+        centers, values, gradnorms, iterations, converged = Center_Mass_Arc_Batch([omega, [0, omega[1], omega[2]]], Seq, [[0, 1, 2], [-1, 1, 2]], None, 1e-10)
+        print("batched values are ", values, "\ngradnorms are ", gradnorms, "\niterations = ", iterations, " converged = ", converged, "\n")
@@ -6,56 +6,545 @@ Created on Mon Jan  18 2021
 @author: Wenqing Hu (Missouri S&T)
 """
 
+import os
 import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
 from scipy.linalg import eigh
 from scipy.spatial.distance import cdist
-from operator import itemgetter
+from scipy.spatial import cKDTree
+import scipy.sparse as sparse
+from scipy.sparse.linalg import lobpcg
+from sklearn.decomposition import PCA, IncrementalPCA
 from buildVisualWordList import buildVisualWordList
-import pandas as pd
 
 # k-nearest neighbor classfication
 # given test data x and label y, find in a training set (X, Y) the k-nearest points x1,...,xk to x, and classify x as majority vote on y1,...,yk
 # if the classification is correct, return 1, otherwise return 0
+# thin wrapper of knn_batch for a single test point
 def knn(x_test, y_test, X_train, Y_train, k):
-    m = len(Y_train)
+    class_predict, isclassified = knn_batch([x_test], X_train, Y_train, k, [y_test])
+    return isclassified[0], class_predict[0]
+
+
+# batched k-nearest neighbor classfication
+# given test data X_test (and optionally labels Y_test), find for every row x of X_test the k-nearest points x1,...,xk in a training set (X, Y) 
+# and classify x as majority vote on y1,...,yk, ties are broken towards the label appearing first in np.unique(Y_train)
+# the squared distances are computed block by block via ||x||^2+||y||^2-2<x,y>, the k nearest are picked by partial selection (argpartition) 
+# and the vote is done by bincount on integer-coded labels
+# each block holds a float64 distance row and an int64 argpartition row per test point, the number of test points in a block is 
+# memory_budget (bytes) / (16 * len(X_train)), unless block_size is given
+# return class_predict = the predicted labels, isclassified = 1 if the classification is correct and 0 otherwise (all 0 if Y_test is not given)
+def knn_batch(X_test, X_train, Y_train, k, Y_test=None, block_size=None, memory_budget=2**28):
+    X_test = np.atleast_2d(np.asarray(X_test, dtype=float))
+    X_train = np.atleast_2d(np.asarray(X_train, dtype=float))
+    m = len(X_train)
     if k>m:
         k=m
-    # find the first k-nearest neighbor
-    dist = [np.linalg.norm(np.array(x_test)-np.array(X_train[i])) for i in range(m)]
-    indexes, dist_sort = zip(*sorted(enumerate(dist), key=itemgetter(1))) 
-    # do a majority vote on the first k-nearest neighbor
-    label = [Y_train[indexes[_]] for _ in range(k)]
-    vote = pd.value_counts(label)
+    # code the labels as integers 0, ..., num_labels-1 so that the vote is a bincount
+    labels, Y_code = np.unique(np.asarray(Y_train), return_inverse=True)
+    num_labels = len(labels)
+    # the squared norms of the training points are shared by all blocks
+    norm_train = np.einsum('ij,ij->i', X_train, X_train)
+    n_test = len(X_test)
+    code_predict = np.zeros(n_test, dtype=int)
+    if block_size is None:
+        block_size = max(1, memory_budget // (16 * m))
+    for start in range(0, n_test, block_size):
+        X_block = X_test[start:start+block_size]
+        # squared distances ||x||^2+||y||^2-2<x,y> of the block to all training points, clipped at 0 against round-off
+        dist = np.einsum('ij,ij->i', X_block, X_block)[:, None] + norm_train[None, :] - 2*np.matmul(X_block, X_train.T)
+        np.maximum(dist, 0, out=dist)
+        # find the first k-nearest neighbor by partial selection
+        if k < m:
+            indexes = np.argpartition(dist, k-1, axis=1)[:, :k]
+        else:
+            indexes = np.broadcast_to(np.arange(m), (len(X_block), m))
+        # do a majority vote on the first k-nearest neighbor, offsetting each row so that one bincount votes for the whole block
+        rows = np.arange(len(X_block))[:, None] * num_labels
+        vote = np.bincount((Y_code[indexes] + rows).ravel(), minlength=len(X_block)*num_labels).reshape(len(X_block), num_labels)
+        code_predict[start:start+block_size] = np.argmax(vote, axis=1)
+    # class_predict is the predicted label based on majority vote
+    class_predict = labels[code_predict]
+    if Y_test is None:
+        isclassified = np.zeros(n_test, dtype=int)
+    else:
+        isclassified = (class_predict == np.asarray(Y_test)).astype(int)
+    return class_predict, isclassified
+
+
+# exact batched k-nearest neighbor classfication, with the same vote as knn_batch, searching the training points leaf by leaf on the kd-tree index
+# index is a VisualWordIndex whose leafs partition the rows of X_train, mbrs = (mbrs_min, mbrs_max) are the MBRs of its leafs in the coordinates of X_train
+# (index.compute_mbrs(X_train), by default the MBRs of the index, which are in the coordinates the tree was built on)
+# for a block of test points, the lower bounds ||x - MBR||^2 of the squared distances of the test points x to all leafs are computed first,
+# and every test point visits the leafs in ascending order of its lower bounds, in rounds of doubling length (its closest leaf, the next 2, 4, ... leafs): 
+# in a round each leaf is compared at once with all test points having it in their round (one matrix product per leaf), skipping the leafs whose lower bound 
+# is above the k-th best squared distance found so far, and a test point stops as soon as its k-th best squared distance is below the lower bound 
+# of its next leaf (branch-and-bound), since no later leaf can contain a nearer neighbor
+# the (test points x leafs x dimension) MBR gaps and the (test points x leaf members) distance blocks hold about memory_budget bytes
+# return class_predict, isclassified as knn_batch
+def knn_tree_batch(X_test, X_train, Y_train, k, index, Y_test=None, mbrs=None, memory_budget=2**28):
+    X_test = np.atleast_2d(np.asarray(X_test, dtype=float))
+    X_train = np.atleast_2d(np.asarray(X_train, dtype=float))
+    m = len(X_train)
+    if k>m:
+        k=m
+    # code the labels as integers 0, ..., num_labels-1 so that the vote is a bincount
+    labels, Y_code = np.unique(np.asarray(Y_train), return_inverse=True)
+    num_labels = len(labels)
+    norm_train = np.einsum('ij,ij->i', X_train, X_train)
+    norm_test = np.einsum('ij,ij->i', X_test, X_test)
+    leafs_perm = index.leafs_perm
+    leafs_offsets = index.leafs_offsets
+    if mbrs is None:
+        mbrs = (index.mbrs_min, index.mbrs_max)
+    mbrs_min = np.asarray(mbrs[0], dtype=float)
+    mbrs_max = np.asarray(mbrs[1], dtype=float)
+    num_leafs = len(leafs_offsets) - 1
+    n_test = len(X_test)
+    # the k nearest found so far (unordered) of every test point, and the k-th best squared distance
+    best_dist = np.full((n_test, k), np.inf)
+    best_indexes = np.zeros((n_test, k), dtype=np.int64)
+    kth_dist = np.full(n_test, np.inf)
+    
+    # compare the test points queries with the members of leaf l and keep the k nearest of each by partial selection
+    def visit(queries, l):
+        members = leafs_perm[leafs_offsets[l]:leafs_offsets[l+1]]
+        if len(members) == 0:
+            return
+        chunk = max(1, memory_budget // (16 * (k + len(members))))
+        for start in range(0, len(queries), chunk):
+            q = queries[start:start+chunk]
+            dist = norm_test[q][:, None] + norm_train[members][None, :] - 2*np.matmul(X_test[q], X_train[members].T)
+            np.maximum(dist, 0, out=dist)
+            dist = np.concatenate((best_dist[q], dist), axis=1)
+            candidates = np.concatenate((best_indexes[q], np.broadcast_to(members, (len(q), len(members)))), axis=1)
+            keep = np.argpartition(dist, k-1, axis=1)[:, :k]
+            rows = np.arange(len(q))[:, None]
+            best_dist[q] = dist[rows, keep]
+            best_indexes[q] = candidates[rows, keep]
+            kth_dist[q] = np.max(best_dist[q], axis=1)
+    
+    block_size = max(1, memory_budget // (16 * num_leafs * X_test.shape[1]))
+    for start in range(0, n_test, block_size):
+        X_block = X_test[start:start+block_size]
+        # lower bounds of the squared distances of the test points to the leafs, the squared distances to their MBRs
+        gap = np.maximum(mbrs_min[None, :, :] - X_block[:, None, :], 0) + np.maximum(X_block[:, None, :] - mbrs_max[None, :, :], 0)
+        bound = np.einsum('ijk,ijk->ij', gap, gap)
+        # the leafs of every test point in ascending order of their lower bounds
+        leaf_order = np.argsort(bound, axis=1)
+        active = np.arange(len(X_block))
+        low, high = 0, 1
+        while low < num_leafs and len(active) > 0:
+            # stop the test points whose k-th best squared distance is below the lower bound of their next leaf
+            active = active[bound[active, leaf_order[active, low]] <= kth_dist[start + active]]
+            # the (test point, leaf) pairs of the round that can still contain a nearer neighbor
+            rows = np.repeat(active, high - low)
+            leafs = leaf_order[active, low:high].ravel()
+            going = bound[rows, leafs] <= kth_dist[start + rows]
+            rows, leafs = rows[going], leafs[going]
+            # group the test points by leaf, and compare each leaf with its group at once
+            group = np.argsort(leafs, kind='stable')
+            group_leafs, group_starts = np.unique(leafs[group], return_index=True)
+            for l, queries in zip(group_leafs, np.split(start + rows[group], group_starts[1:])):
+                visit(queries, l)
+            low, high = high, min(num_leafs, 2*high + 1)
+    # do a majority vote on the k-nearest neighbor, offsetting each row so that one bincount votes for all test points
+    rows = np.arange(n_test)[:, None] * num_labels
+    vote = np.bincount((Y_code[best_indexes] + rows).ravel(), minlength=n_test*num_labels).reshape(n_test, num_labels)
+    code_predict = np.argmax(vote, axis=1)
     # class_predict is the predicted label based on majority vote
-    class_predict = vote.index[0]
-    if class_predict == y_test:
-        isclassified = 1
+    class_predict = labels[code_predict]
+    if Y_test is None:
+        isclassified = np.zeros(n_test, dtype=int)
     else:
-        isclassified = 0
-    return isclassified, class_predict
+        isclassified = (class_predict == np.asarray(Y_test)).astype(int)
+    return class_predict, isclassified
+
+
+# batched selection of the interpolation clusters of the test points X_test among the cluster centers
+# for each test point x, the candidate clusters are all clusters whose center is within ratio_threshold times the distance of the closest center,
+# sorted by ascending distance, with weights w = exp(-K * distance^2)
+# the distances are computed block by block via ||x||^2+||m||^2-2<x,m>, only the max_candidates closest centers are extracted by partial selection
+# (a full sort is done for the rare rows where all of them are within the threshold)
+# if candidates = (candidate_ids, candidate_offsets) is given, x is only compared with the centers candidate_ids[candidate_offsets[i]:candidate_offsets[i+1]],
+# the test points with an empty candidate list are compared with all centers instead
+# return the candidate clusters in CSR form: the clusters of X_test[i] are cluster_ids[offsets[i]:offsets[i+1]], with distances and weights alike,
+# and ratios, ratios[i] = (second smallest, largest) over smallest distance to the compared centers
+# (a test point lying on a center gets infinite (or nan) ratios and keeps only the centers at distance 0, as in the per-point loop)
+def nearest_clusters_batch(X_test, centers, ratio_threshold, K, candidates=None, max_candidates=64, block_size=1024):
+    X_test = np.atleast_2d(np.asarray(X_test, dtype=float))
+    centers = np.asarray(centers, dtype=float)
+    n_test = len(X_test)
+    if candidates is None:
+        # the (query, cluster, distance) pairs of the closest centers of each test point, sorted by query then distance
+        pair_query = []
+        pair_cluster = []
+        pair_dist = []
+        ratios = np.zeros((n_test, 2))
+        norm_centers = np.einsum('ij,ij->i', centers, centers)
+        num_centers = len(centers)
+        kk = min(max_candidates, num_centers)
+        for start in range(0, n_test, block_size):
+            X_block = X_test[start:start+block_size]
+            n_block = len(X_block)
+            dist = np.einsum('ij,ij->i', X_block, X_block)[:, None] + norm_centers[None, :] - 2*np.matmul(X_block, centers.T)
+            dist = np.sqrt(np.maximum(dist, 0))
+            rows = np.arange(n_block)[:, None]
+            if kk < num_centers:
+                closest = np.argpartition(dist, kk-1, axis=1)[:, :kk]
+            else:
+                closest = np.broadcast_to(np.arange(num_centers), (n_block, num_centers))
+            closest = closest[rows, np.argsort(dist[rows, closest], axis=1)]
+            dist_closest = dist[rows, closest]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios[start:start+n_block, 0] = dist_closest[:, min(1, num_centers-1)]/dist_closest[:, 0]
+                ratios[start:start+n_block, 1] = np.max(dist, axis=1)/dist_closest[:, 0]
+            for i in range(n_block):
+                if kk < num_centers and dist_closest[i, -1] <= ratio_threshold * dist_closest[i, 0]:
+                    # all kk extracted centers are within the threshold, sort the whole row
+                    order = np.argsort(dist[i])
+                    pair_cluster.append(order)
+                    pair_dist.append(dist[i, order])
+                else:
+                    pair_cluster.append(closest[i])
+                    pair_dist.append(dist_closest[i])
+                pair_query.append(np.full(len(pair_cluster[-1]), start+i))
+        pair_query = np.concatenate(pair_query)
+        pair_cluster = np.concatenate(pair_cluster)
+        pair_dist = np.concatenate(pair_dist)
+        row_start = np.searchsorted(pair_query, np.arange(n_test))
+    else:
+        candidate_ids, candidate_offsets = candidates
+        candidate_ids = np.asarray(candidate_ids)
+        candidate_offsets = np.asarray(candidate_offsets)
+        counts = np.diff(candidate_offsets)
+        empty = counts == 0
+        if np.any(empty):
+            # fall back to the full scan of the centers for the test points without candidates
+            num_centers = len(centers)
+            counts_full = np.where(empty, num_centers, counts)
+            offsets_full = np.zeros(n_test+1, dtype=int)
+            offsets_full[1:] = np.cumsum(counts_full)
+            ids_full = np.zeros(offsets_full[-1], dtype=int)
+            rows = np.repeat(np.arange(n_test), counts)
+            ids_full[offsets_full[rows] + np.arange(len(rows)) - candidate_offsets[rows]] = candidate_ids[:len(rows)]
+            rows_empty = np.repeat(np.flatnonzero(empty), num_centers)
+            all_centers = np.tile(np.arange(num_centers), np.count_nonzero(empty))
+            ids_full[offsets_full[rows_empty] + all_centers] = all_centers
+            candidate_ids, candidate_offsets = ids_full, offsets_full
+        pair_query = np.repeat(np.arange(n_test), np.diff(candidate_offsets))
+        pair_dist = np.zeros(len(pair_query))
+        for start in range(0, len(pair_query), block_size):
+            pair_dist[start:start+block_size] = np.linalg.norm(X_test[pair_query[start:start+block_size]] - centers[candidate_ids[start:start+block_size]], axis=1)
+        # sort the pairs by query then distance
+        order = np.lexsort((pair_dist, pair_query))
+        pair_query = pair_query[order]
+        pair_cluster = candidate_ids[order]
+        pair_dist = pair_dist[order]
+        row_start = np.asarray(candidate_offsets[:-1])
+        row_end = np.asarray(candidate_offsets[1:])
+        ratios = np.zeros((n_test, 2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios[:, 0] = pair_dist[np.minimum(row_start+1, row_end-1)]/pair_dist[row_start]
+            ratios[:, 1] = pair_dist[row_end-1]/pair_dist[row_start]
+    # keep the pairs within ratio_threshold of the closest center of their query, they lead each sorted row
+    keep = pair_dist <= ratio_threshold * pair_dist[row_start][pair_query]
+    cluster_ids = pair_cluster[keep]
+    distances = pair_dist[keep]
+    weights = np.exp(-K * distances**2)
+    offsets = np.zeros(n_test+1, dtype=int)
+    offsets[1:] = np.cumsum(np.bincount(pair_query[keep], minlength=n_test))
+    return cluster_ids, distances, weights, offsets, ratios
+
+
+# cross-projection store for projecting the aggregate clusters through interpolated Stiefel Euclid centers, built once with the trained model
+# the partners of leaf i are the num_partners leafs whose centers are closest to its own, itself first, partners[i] = their indexes,
+# and projections[leafs_offsets[i]:leafs_offsets[i+1], r] = X[leaf i] * Seq[partners[i, r]] are the training points of leaf i projected 
+# onto the frames of its partners, leaf after leaf as in leafs_perm, kept in the dtype of the direct projection X * Seq so that the projected points 
+# (and the nearest neighbors found among them) are the same as without the store, the store holds len(X) x num_partners x p such numbers
+# each leaf is read once and projected onto all its partner frames by one matrix product
+def CrossProjection_Build(X, index, Seq, centers, num_partners):
+    X = np.asarray(X)
+    Seq = np.asarray(Seq)
+    centers = np.asarray(centers, dtype=float)
+    num_leafs, d, p = np.shape(Seq)
+    num_partners = min(num_partners, num_leafs)
+    # the closest centers of each leaf center, the leaf itself comes first
+    norm_centers = np.einsum('ij,ij->i', centers, centers)
+    dist = norm_centers[:, None] + norm_centers[None, :] - 2*np.matmul(centers, centers.T)
+    dist[np.arange(num_leafs), np.arange(num_leafs)] = -np.inf
+    partners = np.argsort(dist, axis=1, kind='stable')[:, :num_partners]
+    projections = np.zeros((len(index.leafs_perm), num_partners, p), dtype=np.result_type(X.dtype, Seq.dtype))
+    for i in range(num_leafs):
+        # the partner frames side by side, d x (num_partners p)
+        frames_i = np.transpose(Seq[partners[i]], (1, 0, 2)).reshape(d, num_partners*p)
+        projections[index.leafs_offsets[i]:index.leafs_offsets[i+1]] = np.matmul(X[index.leaf(i)], frames_i).reshape(-1, num_partners, p)
+    return partners, projections
+
+
+# project the aggregate cluster of the leafs indexes through the Stiefel Euclid center U V' of their frames with weights w, using the cross-projection store
+# with B = \sum_k w_k A_k = U S V', the center is U V' = B M with M = V S^{-1} V' = (B'B)^{-1/2},
+# so X_leaf * center = (\sum_k w_k X_leaf A_k) M costs p x p work per training point once the X_leaf A_k are read from the store
+# (the frames A_k that are not among the partners of the leaf are projected onto directly, only then X is touched)
+# return the projected training points leaf after leaf (in the order of indexes) and M
+def CrossProjection_Center(X, index, Seq, partners, projections, indexes, w):
+    indexes = np.asarray(indexes, dtype=int)
+    w = np.asarray(w, dtype=float)
+    B = np.tensordot(w, Seq[indexes], axes=1)
+    # M = V S^{-1} V' from the eigendecomposition B'B = V S^2 V', the directions with vanishing S are dropped as in the pseudo-inverse
+    S2, V = np.linalg.eigh(np.matmul(B.T, B))
+    keep = S2 > S2[-1] * 1e-12
+    M = np.matmul(V[:, keep] / np.sqrt(S2[keep]), V[:, keep].T)
+    X_projected = []
+    for i in indexes:
+        rows = slice(index.leafs_offsets[i], index.leafs_offsets[i+1])
+        # the weights of the partner frames of leaf i, the other frames are summed up with their weights
+        position = {j: r for r, j in enumerate(partners[i])}
+        w_partners = np.zeros(len(partners[i]))
+        B_others = np.zeros(np.shape(B))
+        for k in range(len(indexes)):
+            if indexes[k] in position:
+                w_partners[position[indexes[k]]] = w[k]
+            else:
+                B_others = B_others + w[k] * Seq[indexes[k]]
+        Z = np.tensordot(projections[rows], w_partners, axes=([1], [0]))
+        if np.any(B_others):
+            Z = Z + np.matmul(X[index.leaf(i)], B_others)
+        X_projected.append(np.matmul(Z, M))
+    return np.concatenate(X_projected), M
 
 
 # solve the laplacian embedding, given data set X={x1,...,xm}, the graph laplacian L and degree matrix D    
-def LPP(X, L, D):
-    # turn X, L, D into arrays
+# num_eig, ridge and solver are passed to LPP_solve, dual = True/False/'auto' picks the sample-space solve (see LPP_use_dual)
+def LPP(X, L, D, num_eig=None, ridge=0, solver='dense', dual='auto'):
+    # turn X, L, D into arrays, keep L, D sparse if they come from a sparse affinity
     X = np.array(X)
-    L = np.array(L)
-    D = np.array(D)
+    if not sparse.issparse(L):
+        L = np.array(L)
+    if not sparse.issparse(D):
+        D = np.array(D)
+    if LPP_use_dual(len(X), len(X[0]), num_eig, dual):
+        # the generalized eigenvectors lie in the row space of X, w = X' * alpha, 
+        # so solve (K * L * K) alpha = LAMBDA (K * D * K) alpha in sample space with the Gram matrix K = X * X'
+        K = np.matmul(X, X.T)
+        mtx_L = np.matmul(K, L @ K)
+        mtx_D = np.matmul(K, D @ K)
+        alpha, LAMBDA = LPP_solve(mtx_L, mtx_D, num_eig, ridge, solver)
+        # map the eigenvectors back to d-dimensional frames
+        return np.matmul(X.T, alpha), LAMBDA
     # calculate mtx_L = X' * L * X
-    mtx_L = np.matmul(np.matmul(X.T, L), X)
+    mtx_L = np.matmul(X.T, L @ X)
     # calculate mtx_D = X' * D * X
-    mtx_D = np.matmul(np.matmul(X.T, D), X)
-    # solve the generalized eigenvalue problem mtx_L W = LAMBDA mtx_D W
-    LAMBDA, W = eigh(mtx_L, mtx_D, eigvals_only=False)
-    # sort the eigenvalues in a descending order
-    SORT_ORDER, LAMBDA = zip(*sorted(enumerate(LAMBDA), key=itemgetter(1), reverse=False)) 
-    # reorder the generalized eigenvector matrix W according to SORT_ORDER
-    W = [W[SORT_ORDER[_]] for _ in range(len(SORT_ORDER))]
+    mtx_D = np.matmul(X.T, D @ X)
+    return LPP_solve(mtx_L, mtx_D, num_eig, ridge, solver)
+
+
+# decide if the laplacian embedding of n samples in dimension d is solved in the n x n sample space (dual) instead of the d x d feature space
+# with dual = 'auto' this is the case when n < d, since then X' * D * X is rank-deficient, and the requested num_eig eigenpairs exist in sample space
+def LPP_use_dual(n, d, num_eig, dual):
+    if dual == 'auto':
+        return n < d and (num_eig is None or num_eig <= n)
+    return bool(dual)
+
+
+# solve the generalized eigenvalue problem mtx_L W = LAMBDA mtx_D W of the laplacian embedding, given mtx_L = X' * L * X and mtx_D = X' * D * X
+#   num_eig = the number of smallest eigenpairs to compute, None for all of them
+#   ridge = add ridge * mean(diag(mtx_D)) * I to mtx_D, so that a singular mtx_D (fewer samples than dimensions) stays positive definite
+#   solver = 'dense' for the subset-by-index dense solve, 'lobpcg' for the iterative LOBPCG solve (for large d and small num_eig)
+#   W0 = the d x num_eig starting block of LOBPCG, e.g. the eigenvectors of a previous solve (warm start), None for a random block
+# return W = the d x num_eig array of generalized eigenvectors (columns), LAMBDA = the array of eigenvalues, both in ascending order
+def LPP_solve(mtx_L, mtx_D, num_eig=None, ridge=0, solver='dense', W0=None):
+    d = len(mtx_L)
+    if num_eig is None or num_eig > d:
+        num_eig = d
+    if ridge > 0:
+        mtx_D = mtx_D + ridge * np.mean(np.diag(mtx_D)) * np.identity(d)
+    if solver == 'lobpcg' and 5*num_eig < d:
+        # iterative solve of the num_eig smallest eigenpairs, started from W0 or a random block
+        if W0 is not None and np.shape(W0) == (d, num_eig):
+            X0 = np.array(W0)
+        else:
+            X0 = np.random.randn(d, num_eig)
+        LAMBDA, W = lobpcg(mtx_L, X0, B=mtx_D, largest=False, tol=1e-8, maxiter=500)
+        SORT_ORDER = np.argsort(LAMBDA)
+        LAMBDA = LAMBDA[SORT_ORDER]
+        W = W[:, SORT_ORDER]
+    else:
+        # solve the generalized eigenvalue problem mtx_L W = LAMBDA mtx_D W for the num_eig smallest eigenvalues only, returned in ascending order
+        LAMBDA, W = eigh(mtx_L, mtx_D, eigvals_only=False, subset_by_index=[0, num_eig-1])
     return W, LAMBDA 
     
  
+# solve the laplacian embedding for the supervised affinity with between_class_affinity = 0, given data set X={x1,...,xm} with label Y={y1,...,ym}
+# then S, L, D are block-diagonal by label, so mtx_L = X' * L * X and mtx_D = X' * D * X are accumulated one class block at a time
+# and the full n x n matrices are never formed, the heat kernel size is the mean of cdist(X, X) as in affinity_supervised, 
+# computed exactly in row blocks or, if num_sample is given, estimated from num_sample random pairs
+# the exact mean still costs O(n^2 d) time (only the memory is saved), the class blocks then cost O(\sum_c n_c^2 d) with n_c the class sizes
+# if LPP_use_dual, the blocks accumulated are K_c' * L_c * K_c with K_c = X_c * X' instead, as in LPP
+# num_eig, ridge and solver are passed to LPP_solve
+def LPP_ClassBlock(X, Y, num_sample=None, block_size=1024, num_eig=None, ridge=0, solver='dense', dual='auto'):
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y)
+    n = len(X)
+    d = len(X[0])
+    # heat kernel size
+    if num_sample is None:
+        sum_dist = 0
+        for start in range(0, n, block_size):
+            sum_dist = sum_dist + np.sum(cdist(X[start:start+block_size], X, 'euclidean'))
+        mdist = sum_dist/(n*n)
+    else:
+        pair_i = np.random.randint(0, n, num_sample)
+        pair_j = np.random.randint(0, n, num_sample)
+        mdist = np.mean(np.linalg.norm(X[pair_i]-X[pair_j], axis=1))
+    h = -np.log(0.15)/mdist
+    # in sample space the rows x_i of X are replaced by the rows K_i = x_i * X' of the Gram matrix
+    use_dual = LPP_use_dual(n, d, num_eig, dual)
+    if use_dual:
+        Z = np.matmul(X, X.T)
+    else:
+        Z = X
+    mtx_L = np.zeros((len(Z[0]), len(Z[0])), dtype=float)
+    mtx_D = np.zeros((len(Z[0]), len(Z[0])), dtype=float)
+    for label in np.unique(Y):
+        X_c = X[Y == label]
+        Z_c = Z[Y == label]
+        # the within-class block of the supervised affinity S, and its degrees
+        S_c = np.exp(-h*cdist(X_c, X_c, 'euclidean'))
+        D_c = np.sum(S_c, 0)
+        # accumulate Z_c' * D_c * Z_c and Z_c' * (D_c - S_c) * Z_c
+        ZDZ_c = np.matmul(Z_c.T, D_c[:, None]*Z_c)
+        mtx_D = mtx_D + ZDZ_c
+        mtx_L = mtx_L + ZDZ_c - np.matmul(Z_c.T, np.matmul(S_c, Z_c))
+    W, LAMBDA = LPP_solve(mtx_L, mtx_D, num_eig, ridge, solver)
+    if use_dual:
+        # map the eigenvectors back to d-dimensional frames
+        W = np.matmul(X.T, W)
+    return W, LAMBDA
+
+
+"""
+Incremental LPP model of one leaf
+
+keeps the running mtx_S = X' * S * X and mtx_D = X' * D * X of the supervised affinity S (between_class_affinity = 0) of the leaf samples,
+so that adding or removing a sample is a low-rank update of the class block of its label instead of a rebuild of S, L, D:
+adding z of class c with affinities s_j = exp(-h*|z-x_j|) to the members x_j of class c changes
+    mtx_S by z * a' + a * z' + z * z', with a = sum_j s_j x_j,
+    mtx_D by sum_j s_j x_j * x_j' + (sum_j s_j + 1) z * z' 
+and removing a sample is the reverse update
+the heat kernel h is fixed while the exact running mean distance of the leaf stays within h_tolerance of the one h was set from, 
+beyond that the accumulators are rebuilt with the new h
+the frame is solved in the d-dimensional feature space (no leaf PCA, no sample-space solve), by default with LOBPCG warm-started from the previous eigenvectors 
+where LPP_solve can use it (5 (d_LPP+1) < d), and with the dense solve otherwise, where a warm start has nothing to gain
+"""
+class LPP_LeafModel:
+    
+    def __init__(self,
+                 X,                 # the leaf samples
+                 Y,                 # their labels
+                 ids,               # their indexes in the training set
+                 d_LPP,             # the LPP embedding dimension
+                 ridge=1e-8,        # the relative ridge passed to LPP_solve
+                 solver=None,       # the eigensolver passed to LPP_solve, None for 'lobpcg' if 5 (d_LPP+1) < d and 'dense' otherwise
+                 h_tolerance=0.1    # the relative change of the mean distance that triggers a rebuild with a new heat kernel
+                 ):
+        self.X = np.array(X, dtype=float)
+        self.Y = np.array(Y)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.d_LPP = d_LPP
+        self.ridge = ridge
+        if solver is None:
+            solver = 'lobpcg' if 5*(d_LPP+1) < len(self.X[0]) else 'dense'
+        self.solver = solver
+        self.h_tolerance = h_tolerance
+        self.W = None
+        self.LAMBDA = None
+        # the running sum of the distances over all ordered pairs, for the mean distance of the heat kernel
+        self.sum_dist = 0
+        for start in range(0, len(self.X), 1024):
+            self.sum_dist = self.sum_dist + np.sum(cdist(self.X[start:start+1024], self.X, 'euclidean'))
+        self.rebuild()
+    
+    
+    # the mean distance over all ordered pairs of samples, as in affinity_supervised
+    def mean_dist(self):
+        return self.sum_dist / len(self.X)**2
+    
+    
+    # set the heat kernel from the current mean distance and accumulate mtx_S, mtx_D class block by class block as LPP_ClassBlock
+    def rebuild(self):
+        self.mdist = self.mean_dist()
+        self.h = -np.log(0.15)/self.mdist
+        d = len(self.X[0])
+        self.mtx_S = np.zeros((d, d))
+        self.mtx_D = np.zeros((d, d))
+        for label in np.unique(self.Y):
+            X_c = self.X[self.Y == label]
+            S_c = np.exp(-self.h*cdist(X_c, X_c, 'euclidean'))
+            self.mtx_D = self.mtx_D + np.matmul(X_c.T, np.sum(S_c, 0)[:, None]*X_c)
+            self.mtx_S = self.mtx_S + np.matmul(X_c.T, np.matmul(S_c, X_c))
+    
+    
+    # the rank-one-per-class-member update of mtx_S, mtx_D for the sample z of label y, sign = +1 to add it and -1 to remove it
+    # the other members of the class are X_c, z itself must not be among them
+    def update(self, z, X_c, sign):
+        s = np.exp(-self.h*np.linalg.norm(X_c - z, axis=1))
+        a = np.matmul(s, X_c)
+        zz = np.outer(z, z)
+        self.mtx_S = self.mtx_S + sign * (np.outer(z, a) + np.outer(a, z) + zz)
+        self.mtx_D = self.mtx_D + sign * (np.matmul(X_c.T, s[:, None]*X_c) + (np.sum(s) + 1) * zz)
+    
+    
+    # add the samples X_new with labels Y_new and training set indexes ids_new
+    def add(self, X_new, Y_new, ids_new):
+        X_new = np.atleast_2d(np.asarray(X_new, dtype=float))
+        for i in range(len(X_new)):
+            z = X_new[i]
+            self.sum_dist = self.sum_dist + 2*np.sum(np.linalg.norm(self.X - z, axis=1))
+            self.update(z, self.X[self.Y == Y_new[i]], 1)
+            self.X = np.concatenate((self.X, z[None, :]))
+            self.Y = np.append(self.Y, Y_new[i])
+            self.ids = np.append(self.ids, ids_new[i])
+        self.check_heat_kernel()
+    
+    
+    # remove the samples with training set indexes ids_remove
+    def remove(self, ids_remove):
+        for id_remove in ids_remove:
+            row = int(np.flatnonzero(self.ids == id_remove)[0])
+            z = self.X[row]
+            others = np.arange(len(self.X)) != row
+            self.sum_dist = self.sum_dist - 2*np.sum(np.linalg.norm(self.X[others] - z, axis=1))
+            self.update(z, self.X[others & (self.Y == self.Y[row])], -1)
+            self.X = self.X[others]
+            self.Y = self.Y[others]
+            self.ids = self.ids[others]
+        self.check_heat_kernel()
+    
+    
+    # rebuild the accumulators with a new heat kernel if the mean distance drifted beyond h_tolerance
+    def check_heat_kernel(self):
+        if abs(self.mean_dist() - self.mdist) > self.h_tolerance * self.mdist:
+            self.rebuild()
+    
+    
+    # solve for the LPP frame of the leaf (warm-started from the previous eigenvectors with LOBPCG), post-processed as in LPP_Frame
+    def frame(self):
+        mtx_L = self.mtx_D - self.mtx_S
+        self.W, self.LAMBDA = LPP_solve(mtx_L, self.mtx_D, self.d_LPP+1, self.ridge, self.solver, self.W)
+        LPP_k, R = np.linalg.qr(self.W)
+        return LPP_k[:, 1:self.d_LPP+1]
+
+
 # construct the graph laplacian L and the degress matrix D from the given affinity matrix S 
+# if S is a scipy.sparse matrix, L and D are returned as sparse CSR matrices
 def graph_laplacian(S):
+    if sparse.issparse(S):
+        # compute the D matrix from the column sums of the sparse S
+        D = sparse.diags(np.asarray(S.sum(0)).ravel()).tocsr()
+        L = (D - S).tocsr()
+        return L, D
     # first turn S into an array
     S = np.array(S)
     # compute the D matrix
@@ -86,6 +575,198 @@ def affinity_supervised(X, Y, between_class_affinity):
     return S
 
 
+# given a set of data points X={x1,...,xm} with label Y={y1,...,ym}, construct a sparse supervised affinity matrix S for LPP
+# S keeps only the k nearest same-class neighbours of each point (plus, optionally, all same-class points within distance epsilon),
+# symmetrized by S = max(S, S'), between-class affinities are 0 and the diagonal is exp(0)=1 as in affinity_supervised
+# the heat kernel size is estimated from the mean distance over num_sample random pairs instead of all n^2 pairs
+# return S as a scipy.sparse CSR matrix with O(n*k) nonzeros
+def affinity_supervised_sparse(X, Y, k, epsilon=None, num_sample=10000):
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y)
+    n = len(X)
+    # heat kernel size, estimated on random pairs (i, j) so that its mean approximates the mean of cdist(X, X)
+    pair_i = np.random.randint(0, n, num_sample)
+    pair_j = np.random.randint(0, n, num_sample)
+    mdist = np.mean(np.linalg.norm(X[pair_i]-X[pair_j], axis=1))
+    h = -np.log(0.15)/mdist
+    rows = [np.arange(n)]
+    cols = [np.arange(n)]
+    dists = [np.zeros(n)]
+    # utilize supervised info, only search for neighbours within each class
+    for label in np.unique(Y):
+        offs = np.flatnonzero(Y == label)
+        n_c = len(offs)
+        if n_c == 1:
+            continue
+        tree = cKDTree(X[offs])
+        # the k nearest same-class neighbours, the first neighbour returned is the point itself
+        k_c = min(k, n_c-1)
+        dist_c, nbrs_c = tree.query(X[offs], k_c+1)
+        rows.append(np.repeat(offs, k_c))
+        cols.append(offs[nbrs_c[:, 1:].ravel()])
+        dists.append(dist_c[:, 1:].ravel())
+        # the same-class points within the epsilon-ball
+        if epsilon is not None:
+            ball = tree.sparse_distance_matrix(tree, epsilon, output_type='coo_matrix')
+            rows.append(offs[ball.row])
+            cols.append(offs[ball.col])
+            dists.append(ball.data)
+    # drop the (i, j) pairs found by both the knn and the epsilon-ball search, csr_matrix would otherwise sum them
+    keys, first = np.unique(np.concatenate(rows)*n + np.concatenate(cols), return_index=True)
+    dists = np.concatenate(dists)[first]
+    S = sparse.csr_matrix((np.exp(-h*dists), (keys // n, keys % n)), shape=(n, n))
+    S = S.maximum(S.T).tocsr()
+    return S
+
+
+
+# compute the top d principal directions of the rows of X_blocks, a list of 2-d arrays (possibly memmaps) treated as their concatenation
+# solver = 'full' for the full PCA (all components are computed), 'randomized' for the truncated randomized PCA of the d components only,
+#          'incremental' for the incremental PCA that streams X_blocks in chunks of chunk_size rows and never concatenates them,
+#          it tracks d+oversample components since the truncation at each chunk perturbs the last tracked ones
+# return the d_data x d basis as a contiguous array, its columns are the principal directions
+def PCA_Basis(X_blocks, d, solver='full', chunk_size=10000, oversample=10):
+    if solver == 'incremental':
+        n_components = min(d+oversample, len(X_blocks[0][0]))
+        pca = IncrementalPCA(n_components=n_components)
+        # every chunk passed to partial_fit needs at least n_components rows, so a short final chunk is merged into the previous one
+        chunk_size = max(chunk_size, n_components)
+        pending = None
+        for X in X_blocks:
+            for start in range(0, len(X), chunk_size):
+                chunk = np.asarray(X[start:start+chunk_size], dtype=float)
+                if pending is not None and len(chunk) < n_components:
+                    chunk = np.concatenate((pending, chunk))
+                elif pending is not None:
+                    pca.partial_fit(pending)
+                pending = chunk
+        pca.partial_fit(pending)
+    else:
+        if len(X_blocks) == 1:
+            X = X_blocks[0]
+        else:
+            X = np.concatenate(X_blocks)
+        if solver == 'randomized':
+            pca = PCA(n_components=d, svd_solver='randomized')
+        else:
+            pca = PCA()
+        pca.fit(X)
+    return np.ascontiguousarray(pca.components_[:d].T)
+
+
+# project the rows of X onto the columns of basis, chunk by chunk so that a float32 memmap X is never converted to float64 as a whole
+def PCA_Project(X, basis, chunk_size=10000):
+    X_projected = np.zeros((len(X), len(basis[0])), dtype=float)
+    for start in range(0, len(X), chunk_size):
+        X_projected[start:start+chunk_size] = np.matmul(np.asarray(X[start:start+chunk_size], dtype=float), basis)
+    return X_projected
+
+
+# build the LPP frame in St(d_LPP, d) of one leaf with samples X_k and labels Y_k, using the supervised affinity with between_class_affinity = 0
+# LPP_options is a dictionary of the LPP choices:
+#   "d_SecondPCA_beforeLPP" = the leaf PCA dimension before LPP, 0 for no leaf PCA
+#   "PCA_solver" = the solver of the leaf PCA, passed to PCA_Basis
+#   "doSparseAffinity", "k_affinity", "epsilon_affinity" = use affinity_supervised_sparse with these k and epsilon
+#   "doClassBlockLPP" = use LPP_ClassBlock (dense affinity only), with the heat kernel size estimated from "num_sample_heat" random pairs (None for all pairs)
+#   "ridge", "solver", "dual" = passed to LPP_solve and LPP_use_dual
+def LPP_Frame(X_k, Y_k, d_LPP, LPP_options):
+    X_k = np.asarray(X_k, dtype=float)
+    d_PCA_k = LPP_options["d_SecondPCA_beforeLPP"]
+    if d_PCA_k > 0:
+        # do a second-level PCA first, so X_k dimension is reduced to d_SecondPCA_beforeLPP, only these components are computed
+        PCA_k = PCA_Basis([X_k], d_PCA_k, LPP_options["PCA_solver"])
+        X_k = np.matmul(X_k, PCA_k)
+    # the first generalized eigenvector is dropped, so d_LPP+1 eigenpairs are needed
+    num_eig = d_LPP+1
+    if LPP_options["doSparseAffinity"]:
+        # construct the sparse supervise affinity matrix S over the nearest same-class neighbours
+        S_k = affinity_supervised_sparse(X_k, Y_k, LPP_options["k_affinity"], LPP_options["epsilon_affinity"])
+        L_k, D_k = graph_laplacian(S_k)
+        A_k, LAMBDA = LPP(X_k, L_k, D_k, num_eig, LPP_options["ridge"], LPP_options["solver"], LPP_options["dual"])
+    elif LPP_options["doClassBlockLPP"]:
+        # S is block-diagonal by label, accumulate the LPP matrices class block by class block without forming S, L, D
+        A_k, LAMBDA = LPP_ClassBlock(X_k, Y_k, num_sample=LPP_options.get("num_sample_heat"), num_eig=num_eig, ridge=LPP_options["ridge"], solver=LPP_options["solver"], dual=LPP_options["dual"])
+    else:
+        # construct the supervise affinity matrix S, the graph Laplacian L and degree matrix D
+        between_class_affinity = 0
+        S_k = affinity_supervised(X_k, Y_k, between_class_affinity)
+        L_k, D_k = graph_laplacian(S_k)
+        A_k, LAMBDA = LPP(X_k, L_k, D_k, num_eig, LPP_options["ridge"], LPP_options["solver"], LPP_options["dual"])
+    LPP_k, R = np.linalg.qr(A_k)
+    frame = LPP_k[:, 1:d_LPP+1]
+    if d_PCA_k > 0:
+        frame = np.matmul(PCA_k, frame)
+    return frame
+
+
+# state of a worker process of LPP_BuildFrames_Parallel: the shared training data and the shared frames Seq
+LPP_worker = {}
+
+
+# initialize a worker process of LPP_BuildFrames_Parallel: attach to the shared memory blocks and cap the BLAS threads
+def LPP_BuildFrames_Init(name_x, shape_x, name_y, name_seq, shape_seq, d_LPP, LPP_options, blas_threads):
+    try:
+        from threadpoolctl import threadpool_limits
+        LPP_worker["limits"] = threadpool_limits(limits=blas_threads)
+    except ImportError:
+        pass
+    LPP_worker["shm"] = [shared_memory.SharedMemory(name=name) for name in [name_x, name_y, name_seq]]
+    LPP_worker["x"] = np.ndarray(shape_x, dtype=float, buffer=LPP_worker["shm"][0].buf)
+    LPP_worker["y"] = np.ndarray(shape_x[0], dtype=np.int64, buffer=LPP_worker["shm"][1].buf)
+    LPP_worker["Seq"] = np.ndarray(shape_seq, dtype=float, buffer=LPP_worker["shm"][2].buf)
+    LPP_worker["d_LPP"] = d_LPP
+    LPP_worker["LPP_options"] = LPP_options
+
+
+# build the frame of the k-th leaf with indexes leaf_k in a worker process and write it into the shared Seq[k]
+def LPP_BuildFrames_Task(task):
+    k, leaf_k = task
+    frame = LPP_Frame(LPP_worker["x"][leaf_k], LPP_worker["y"][leaf_k], LPP_worker["d_LPP"], LPP_worker["LPP_options"])
+    LPP_worker["Seq"][k] = frame
+    return k, np.linalg.norm(np.matmul(frame.T, frame)-np.identity(len(frame[0])))
+
+
+# build the LPP frames of all leafs in parallel with a pool of num_workers processes, each process limited to blas_threads BLAS threads
+# the training data X (n x d) and labels Y are placed once in shared memory, each task only receives its leaf indexes
+# the workers write their frames directly into the shared copy of Seq, which is copied back into the preallocated Seq (number of leafs x d x d_LPP)
+def LPP_BuildFrames_Parallel(X, Y, leafs, d_LPP, LPP_options, Seq, num_workers, blas_threads=1):
+    X = np.asarray(X, dtype=float)
+    # code the labels as integers, only the equality of labels is used by LPP
+    labels, Y_code = np.unique(np.asarray(Y), return_inverse=True)
+    Y_code = Y_code.astype(np.int64)
+    shm = [shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) for array in [X, Y_code, Seq]]
+    Seq_shared = None
+    try:
+        np.ndarray(X.shape, dtype=float, buffer=shm[0].buf)[:] = X
+        np.ndarray(Y_code.shape, dtype=np.int64, buffer=shm[1].buf)[:] = Y_code
+        Seq_shared = np.ndarray(Seq.shape, dtype=float, buffer=shm[2].buf)
+        # the BLAS libraries of spawned workers read their thread count from the environment at import
+        blas_env = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+        blas_env_old = {var: os.environ.get(var) for var in blas_env}
+        for var in blas_env:
+            os.environ[var] = str(blas_threads)
+        try:
+            pool = multiprocessing.Pool(num_workers, initializer=LPP_BuildFrames_Init,
+                                        initargs=(shm[0].name, X.shape, shm[1].name, shm[2].name, Seq.shape, d_LPP, LPP_options, blas_threads))
+        finally:
+            for var in blas_env:
+                if blas_env_old[var] is None:
+                    del os.environ[var]
+                else:
+                    os.environ[var] = blas_env_old[var]
+        with pool:
+            tasks = [(k, np.asarray(leafs[k], dtype=np.int64)) for k in range(len(leafs))]
+            for k, residue in pool.imap_unordered(LPP_BuildFrames_Task, tasks):
+                print("frame ",k+1," size=(", Seq.shape[1],",",Seq.shape[2], "), IfStiefel? Residue = ", residue)
+        Seq[:] = Seq_shared
+    finally:
+        # the views on the shared memory must be released before it is closed
+        Seq_shared = None
+        for block in shm:
+            block.close()
+            block.unlink()
+    return Seq
+
 
 if __name__ == "__main__":
 
@@ -108,6 +789,16 @@ if __name__ == "__main__":
         k = 6
         isclassified = knn(x_test, y_test, X_train, Y_train, k)
         print("isclassified=", isclassified)
+        X_test = [[0, 0], [3, 1], [0, 4]]
+        Y_test = [2, 1, 2]
+        class_predict, isclassified = knn_batch(X_test, X_train, Y_train, 3, Y_test)
+        print("class_predict=", class_predict, "isclassified=", isclassified)
+        centers = [[0, 0], [1, 0], [5, 5]]
+        cluster_ids, distances, weights, offsets, ratios = nearest_clusters_batch(X_test, centers, 1.5, 0.1)
+        print("cluster_ids=", cluster_ids, "offsets=", offsets, "weights=", weights, "ratios=", ratios)
+        # a test point far from every center, with an empty candidate list, is compared with all centers
+        cluster_ids, distances, weights, offsets, ratios = nearest_clusters_batch(X_test + [[100, 100]], centers, 1.5, 0.1, ([0, 1, 1, 2], [0, 2, 3, 4, 4]))
+        print("with candidates, cluster_ids=", cluster_ids, "offsets=", offsets, "ratios=", ratios)
         
         S = [[2, 1], [1, 2]]
         L, D = graph_laplacian(S)
@@ -122,3 +813,15 @@ if __name__ == "__main__":
         between_class_affinity = 0
         S = affinity_supervised(X, Y, between_class_affinity)
         print("S=", S)
+        S = affinity_supervised_sparse(X, Y, 2)
+        print("S_sparse=", S.toarray())
+        W, LAMBDA = LPP_ClassBlock(X, Y, ridge=1e-6)
+        print("W_ClassBlock=", W)
+        print("LAMBDA_ClassBlock=", LAMBDA)
+        
+        X = np.random.randn(40, 6)
+        Y = np.random.randint(0, 2, 40)
+        leaf_model = LPP_LeafModel(X[:30], Y[:30], np.arange(30), 2, solver='dense')
+        leaf_model.add(X[30:], Y[30:], np.arange(30, 40))
+        leaf_model.remove([0, 1])
+        print("incremental leaf frame=", leaf_model.frame())
@@ -6,13 +6,11 @@ Created on Mon Aug  3 17:32:08 2020
 @author: Wenqing Hu (Missouri S&T)
 """
 
-from Stiefel_Optimization import Stiefel_Optimization
-from Grassmann_Optimization import Grassmann_Optimization
-from buildVisualWordList import buildVisualWordList
+from Stiefel_Optimization import Stiefel_Optimization, Center_Mass_Euclid_Batch
+from Grassmann_Optimization import Grassmann_Optimization, Center_Mass_Arc_Batch
+from buildVisualWordList import buildVisualWordIndex, VisualWordIndex, locate
 from umap_data_aug import UMAP_Augmentation
 import numpy as np
-from operator import itemgetter
-from sklearn.decomposition import PCA
 import tensorflow as tf
 import time
 from cifar10vgg import cifar10vgg
@@ -21,7 +19,9 @@ from sklearn.mixture import GaussianMixture
 from sklearn.svm import SVC
 import sklearn.datasets
 from sklearn.datasets import fetch_olivetti_faces
-from LPP_Auxiliary import knn, LPP, graph_laplacian, affinity_supervised
+from LPP_Auxiliary import knn, knn_batch, knn_tree_batch, nearest_clusters_batch, CrossProjection_Build, CrossProjection_Center, LPP_Frame, LPP_LeafModel, LPP_BuildFrames_Parallel, PCA_Basis, PCA_Project
+from LPP_ModelStore import LPP_ModelKey, LPP_DataFingerprint, LPP_SaveModel, LPP_LoadModel
+from LPP_DataStore import DataStore_Write, DataStore_Read, DataStore_Columns
 import scipy.io
 from vox1VggFace import vggFace
 
@@ -32,7 +32,17 @@ model_MNISTLeNetv2 = MNISTLeNetv2()
 model_vgg_faces = vggFace()
 
 # load the data set
+# data_original_train = {"x": contiguous float32 array (number of samples x d), "y": int32 label codes, "labels": label-name table}, data_original_test likewise
+# if doDataStore, each dataset is converted once into the columnar store in data_store_dir and then returned as zero-copy memory-mapped views
 def load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces, dopca256):
+    # the name of the chosen dataset in the data store
+    data_name = [name for name, chosen in [("MNIST", doMNIST), ("CIFAR10", doCIFAR10), ("Olivetti", doOlivetti), ("vgg_faces", dovgg_faces), ("pca256", dopca256)] if chosen][-1]
+    if doDataStore:
+        data_stored = DataStore_Read(data_store_dir, data_name)
+        if data_stored is not None:
+            if dovgg_faces and doResplit_vgg_faces:
+                return vgg_faces_resplit(*data_stored)
+            return data_stored
     # load MNIST dataset
     if doMNIST:
         # load the MNIST dataset
@@ -44,15 +54,9 @@ def load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces, dopca256):
         mnist = tf.keras.datasets.mnist
         (x_train, y_train), (x_test, y_test) = mnist.load_data()
         # preprocess the dataset to fit the format we use
-        data_original_train = {"x": [], "y": []}
-        data_original_test = {"x": [], "y": []}
-        # first turn the matrices of x_train and x_test to 28 x 28 = 784 dimensional vectors
-        for i in range(60000):
-            data_original_train["x"].append(np.reshape(x_train[i], 784))
-            data_original_train["y"].append(y_train[i])
-        for i in range(10000):
-            data_original_test["x"].append(np.reshape(x_test[i], 784))
-            data_original_test["y"].append(y_test[i])
+        # turn the matrices of x_train and x_test to 28 x 28 = 784 dimensional vectors
+        x_train_blocks = [np.reshape(x_train, (len(x_train), 784))]
+        x_test_blocks = [np.reshape(x_test, (len(x_test), 784))]
     # load CIFAR10 dataset
     if doCIFAR10:
         # load the CIFAR-10 dataset
@@ -64,15 +68,11 @@ def load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces, dopca256):
         cifar10 = tf.keras.datasets.cifar10
         (x_train, y_train), (x_test, y_test) = cifar10.load_data()
         # preprocess the dataset to fit the format we use
-        data_original_train = {"x": [], "y": []}
-        data_original_test = {"x": [], "y": []}
-        # first turn the matrices of x_train and x_test to 32 x 32 x 3 = 3072 dimensional vectors
-        for i in range(50000):
-            data_original_train["x"].append(np.reshape(x_train[i], 3072))
-            data_original_train["y"].append(y_train[i][0])
-        for i in range(10000):
-            data_original_test["x"].append(np.reshape(x_test[i], 3072))
-            data_original_test["y"].append(y_test[i][0])
+        # turn the matrices of x_train and x_test to 32 x 32 x 3 = 3072 dimensional vectors
+        x_train_blocks = [np.reshape(x_train, (len(x_train), 3072))]
+        x_test_blocks = [np.reshape(x_test, (len(x_test), 3072))]
+        y_train = y_train[:, 0]
+        y_test = y_test[:, 0]
     # load the AT&T Olivetti face data set
     if doOlivetti:
         # load the AT&T Olivetti dataset
@@ -80,24 +80,20 @@ def load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces, dopca256):
         #    images: list (400, 4096) dtype=float32
         #    target: list (400, 0) dtype=float32
         OlivettiFaceData = sklearn.datasets.fetch_olivetti_faces(random_state=0)
-        x = OlivettiFaceData.images
+        x = np.reshape(OlivettiFaceData.images, (len(OlivettiFaceData.images), 4096))
         y = OlivettiFaceData.target
-        # preprocess the dataset to fit the format we use
-        data_original_train = {"x": [], "y": []}
-        data_original_test = {"x": [], "y": []}
         # extract the training and testing data sets
-        for i in range(350):
-            data_original_train["x"].append(np.reshape(x[i], 4096))
-            data_original_train["y"].append(y[i])
-        for i in range(50):
-            data_original_test["x"].append(np.reshape(x[350+i], 4096))
-            data_original_test["y"].append(y[350+i])
+        x_train_blocks = [x[:350]]
+        y_train = y[:350]
+        x_test_blocks = [x[350:400]]
+        y_test = y[350:400]
     # load the vgg_faces data set
     if dovgg_faces:
         # load the vgg_faces dataset
         # structure: ["classes": np.shape(number_in_class, features)]
-        # preprocess the dataset to fit the format we use
-        data_original = {"x": [], "y": []}
+        # preprocess the dataset to fit the format we use, one block of rows per class
+        x_blocks = []
+        y = []
         for fileindex in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
             vgg_faces = scipy.io.loadmat('data\\Batch'+str(fileindex)+'vgg_f.mat')
             vgg_labels = scipy.io.loadmat('data\\label_batch'+str(fileindex)+'.mat')
@@ -105,73 +101,60 @@ def load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces, dopca256):
             keys = list(vgg_faces.keys())
             num_classes = len(keys)
             for i in range(3, num_classes):
-                num_faces = len(vgg_faces[keys[i]])
-                for j in range(num_faces):
-                    data_original["x"].append(list(vgg_faces[keys[i]][j]))
-                    data_original["y"].append(vgg_labels[keys[i]][0])
-        # turn the names to indexes in data_original["y"]
-        from sklearn.preprocessing import LabelEncoder
-        # creating instance of labelencoder
-        le = LabelEncoder()
-        le.fit(data_original["y"])
-        le_name_mapping = dict(zip(le.transform(le.classes_), le.classes_))
+                x_blocks.append(vgg_faces[keys[i]])
+                y.extend([vgg_labels[keys[i]][0]] * len(vgg_faces[keys[i]]))
+        x = np.concatenate(x_blocks)
+        y = np.array(y)
+        # record the index-name correspondence, the label codes 0-206 are the indexes of the sorted names
+        label_names = np.unique(y)
         file=open('vgg_face_names.txt', 'w')
-        for i in range(len(le_name_mapping)):
-            print(i, le_name_mapping[i], file=file)
-            print(i, le_name_mapping[i])
-        file.close()
-        # store the index-name correspondence to le_name_mapping
-        file=open('vgg_face_names.txt', 'r')
-        le_name_mapping = {}
-        for line in file.readlines():
-            line = line.strip()
-            k = line.split(' ')[0]
-            v = line.split(' ')[1]
-            le_name_mapping[k] = v
-        print(le_name_mapping)
+        for i in range(len(label_names)):
+            print(i, label_names[i], file=file)
+            print(i, label_names[i])
         file.close()
-        # create the label data 0-206
-        data_original["y"] = le.transform(data_original["y"])
-        num_total_faces = len(data_original["y"])
-        # split into the training and testing data sets
-        data_original_train = {"x": [], "y": []}
-        data_original_test = {"x": [], "y": []}
-        # extract the training and testing data sets
+        num_total_faces = len(y)
+        # split into the training and testing data sets at random
+        # with doDataStore this split is written into the store once and reused by every later run, unless doResplit_vgg_faces draws a new one at every load
         indexes = np.random.permutation(num_total_faces)
         train_size = int(0.95*num_total_faces)
-        train_indexes = [indexes[_] for _ in range(train_size)]
-        test_indexes = [indexes[_] for _ in range(train_size, num_total_faces)]
-        data_original_train["x"] = [data_original["x"][_] for _ in train_indexes]
-        data_original_train["y"] = [data_original["y"][_] for _ in train_indexes]
-        data_original_test["x"] = [data_original["x"][_] for _ in test_indexes]
-        data_original_test["y"] = [data_original["y"][_] for _ in test_indexes]
+        train_indexes = indexes[:train_size]
+        test_indexes = indexes[train_size:]
+        x_train_blocks = [x[train_indexes]]
+        y_train = y[train_indexes]
+        x_test_blocks = [x[test_indexes]]
+        y_test = y[test_indexes]
     # load the pca256 dataset for vgg_faces, that is the 256 dimensional PCA embedding of the 400K raw faces
     if dopca256:
         # load the pca256 dataset for vgg_faces
         # structure: ["classes": np.shape(number_in_class, features)]
-        # preprocess the dataset to fit the format we use
+        # preprocess the dataset to fit the format we use, one block of rows per class, the class keys are the labels
         pca256_train = scipy.io.loadmat('data\\pca256_train_size32.mat')
         pca256_test = scipy.io.loadmat('data\\pca256_test_size32.mat')
-        # initialize training and testing data sets
-        data_original_train = {"x": [], "y": []}
-        data_original_test = {"x": [], "y": []}
         # extract the training data set
-        keys_train = list(pca256_train.keys())
-        num_classes_keys_train = len(keys_train)
-        for i in range(3, num_classes_keys_train):
-            num_faces_train = len(pca256_train[keys_train[i]])
-            for j in range(num_faces_train):
-                data_original_train["x"].append(list(pca256_train[keys_train[i]][j]))
-                data_original_train["y"].append(keys_train[i])
+        keys_train = list(pca256_train.keys())[3:]
+        x_train_blocks = [pca256_train[key] for key in keys_train]
+        y_train = np.repeat(keys_train, [len(pca256_train[key]) for key in keys_train])
         # extract the testing data set
-        keys_test = list(pca256_test.keys())
-        num_classes_keys_test = len(keys_test)
-        for i in range(3, num_classes_keys_test):
-            num_faces_test = len(pca256_test[keys_test[i]])
-            for j in range(num_faces_test):
-                data_original_test["x"].append(list(pca256_test[keys_test[i]][j]))
-                data_original_test["y"].append(keys_test[i])
-
+        keys_test = list(pca256_test.keys())[3:]
+        x_test_blocks = [pca256_test[key] for key in keys_test]
+        y_test = np.repeat(keys_test, [len(pca256_test[key]) for key in keys_test])
+
+    if doDataStore:
+        # convert the dataset once, then return memory-mapped views of it
+        DataStore_Write(data_store_dir, data_name, x_train_blocks, y_train, x_test_blocks, y_test)
+        return DataStore_Read(data_store_dir, data_name)
+    return DataStore_Columns(x_train_blocks, y_train, x_test_blocks, y_test)
+
+
+# pool the stored training and testing rows of vgg_faces and split them again at random, 95% for training as in load_data
+# the rows are copied out of the store, so the returned sets are in-memory arrays instead of memory-mapped views
+def vgg_faces_resplit(data_original_train, data_original_test):
+    x = np.concatenate((data_original_train["x"], data_original_test["x"]))
+    y = np.concatenate((data_original_train["y"], data_original_test["y"]))
+    indexes = np.random.permutation(len(y))
+    train_size = int(0.95*len(y))
+    data_original_train = {"x": x[indexes[:train_size]], "y": y[indexes[:train_size]], "labels": data_original_train["labels"]}
+    data_original_test = {"x": x[indexes[train_size:]], "y": y[indexes[train_size:]], "labels": data_original_test["labels"]}
     return data_original_train, data_original_test
 
 
@@ -188,8 +171,11 @@ def LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_k
     #   ht = the partition tree height
     # Output
     #   data_train, data_test = the training/testing data set , size is traing_size/test_size
-    #   leafs = leafs{k}, the cluster indexes in data_train
+    #   index = the kd-tree index (VisualWordIndex): cut dimensions and cut values, the cluster indexes in data_train as leafs, 
+    #           with the kd-tree embedding of the data (see LPP_KdtreeEmbedding)
     #   inv_mat = the pseudo-inverse map that helps to reconstruct the labels for newly-generated training data x using pre-trained model
+    #   PCA_basis = the d_data x d_PCA basis of the preliminary PCA, None if it is not done
+    #   data_insert = the training data held out of the model to be inserted online (LPP_InsertData), insert_size points if doInsertData, else empty
     
     # compute the sizes of the original training and testing dataset
     n_data_original_train = len(data_original_train["x"]) 
@@ -197,21 +183,19 @@ def LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_k
     
     # choose to do preliminary dimension reduction for computational feasability only
     if do_preliminary_PCA_reduction:
-        # first concatnate data_original_train["x"] and data_original_test["x"] together
-        data_x = np.array(data_original_train["x"] + data_original_test["x"])
-        # do an initial PCA on data
-        pca = PCA()
-        pca.fit(data_x)
-        A0 = pca.components_
+        # do an initial PCA on data_original_train["x"] and data_original_test["x"] together, only the top d_PCA directions are computed
+        PCA_basis = PCA_Basis([data_original_train["x"], data_original_test["x"]], d_PCA, PCA_solver)
         # bulid a given dimensional d_PCA embedding of data_orginal_train(test).x into new data_original_train(test).x, for faster computation only
-        data_original_train["x"] = np.matmul(data_original_train["x"], np.array([A0[_] for _ in range(d_PCA)]).T)
-        data_original_test["x"] = np.matmul(data_original_test["x"], np.array([A0[_] for _ in range(d_PCA)]).T)
+        data_original_train["x"] = PCA_Project(data_original_train["x"], PCA_basis)
+        data_original_test["x"] = PCA_Project(data_original_test["x"], PCA_basis)
         # record the pseudo-inverse map that helps to recover the low-dimensional data to original data dimension
-        inv_mat = np.linalg.pinv(np.array([A0[_] for _ in range(d_PCA)]).T)
+        # the basis is orthonormal, so its pseudo-inverse is its transpose
+        inv_mat = np.ascontiguousarray(PCA_basis.T)
     else:
         # record the pseudo-inverse map that helps to recover the low-dimensional data to original data dimension
         d_data = len(data_original_train["x"][0])
         inv_mat = np.identity(d_data, dtype=float)
+        PCA_basis = None
     
     # build the training data set
     indexes = np.random.permutation(n_data_original_train) 
@@ -221,6 +205,10 @@ def LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_k
     data_train_x = [data_original_train["x"][_] for _ in train_indexes]
     data_train_y = [data_original_train["y"][_] for _ in train_indexes]
     data_train = {"x": data_train_x, "y": data_train_y}
+    # the next insert_size points of the permutation are held out as newly arriving training data
+    insert_indexes = [indexes[_] for _ in range(train_size, train_size + (insert_size if doInsertData else 0))]
+    data_insert = {"x": np.array([data_original_train["x"][_] for _ in insert_indexes], dtype=float).reshape(len(insert_indexes), len(data_original_train["x"][0])), 
+                   "y": np.array([data_original_train["y"][_] for _ in insert_indexes])}
     
     # choose to augment the obtained training data x and y globally and label the new x inputs using pre-trained learning model
     if doAugment_Global:
@@ -247,13 +235,13 @@ def LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_k
     data_test = {"x": data_test_x, "y": data_test_y}
     
     # choose to do a second level PCA to dimension d_SecondPCA_kdtree before the kd-tree decomposition
+    PCA_basis_kdtree = None
+    offs = None
     if doSecondPCA_kdtree:
         # do another initial PCA on data_train to d_SecondPCA_kdtree
-        pca = PCA()
-        pca.fit(data_train_x)
-        A0 = pca.components_
+        PCA_basis_kdtree = PCA_Basis([np.asarray(data_train_x)], d_SecondPCA_kdtree, PCA_solver)
         # bulid a d_SecondPCA_kdtree dimensional embedding of data_train in x0
-        x0 = np.matmul(data_train_x, np.array([A0[_] for _ in range(d_SecondPCA_kdtree)]).T)
+        x0 = PCA_Project(np.asarray(data_train_x), PCA_basis_kdtree)
         # in case if we pick particular dimensions of training data to form the kd tree partition
         if dokdtreetuning:
             offs = np.random.permutation(12)
@@ -272,19 +260,33 @@ def LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_k
             x0 = data_train_x
 
     # from x0, partition into 2^ht leaf nodes, each leaf node can give samples for a local LPP
-    indx, leafs, mbrs = buildVisualWordList(x0, ht)
+    # the subtrees below depth kdtree_parallel_depth are built in parallel, the labels are attached for later online insertion
+    index = buildVisualWordIndex(x0, ht, y=data_train_y, parallel_depth=kdtree_parallel_depth, num_workers=num_workers_build)
+    # record how the data was embedded for the kd-tree, so that queries can be located on it
+    index.PCA_basis_kdtree = PCA_basis_kdtree
+    index.offs_kdtree = offs
     
-    return data_train, leafs, data_test, inv_mat
+    return data_train, index, data_test, inv_mat, PCA_basis, data_insert
+
+
+# embed the rows of X in the coordinates the kd-tree in index was built on: the second level PCA and the tuning permutation of dimensions
+def LPP_KdtreeEmbedding(index, X):
+    X = np.asarray(X)
+    if index.PCA_basis_kdtree is not None:
+        X = PCA_Project(X, index.PCA_basis_kdtree)
+    if index.offs_kdtree is not None:
+        X = X[:, index.offs_kdtree]
+    return X
 
 
 # build LPP Model for each leaf in data_train
-# Assume the tree partition indexes of data_train into clusters C_1, ..., C_{2^{ht}} with centers m_1, ..., m_{2^{ht}} is given in leafs
+# Assume the tree partition indexes of data_train into clusters C_1, ..., C_{2^{ht}} with centers m_1, ..., m_{2^{ht}} is given in the leafs of index
 # first project each C_i to local PCA with dimension d_SecondPCA_beforeLPP  
 # then continue to construct the local LPP frames A_1, ..., A_{2^{ht}} in G(d_data, d_LPP) using supervised affinity
-def LPP_BuildDataModel(data_train, leafs, d_SecondPCA_beforeLPP, d_LPP, inv_mat, train_size):
+def LPP_BuildDataModel(data_train, index, d_SecondPCA_beforeLPP, d_LPP, inv_mat, train_size):
     # Input:
     #   data_train = the training data set
-    #   leafs = the tree partition indexes of data_train into clusters C_1, ..., C_{2^{ht}}
+    #   index = the kd-tree index, its leafs are the tree partition indexes of data_train into clusters C_1, ..., C_{2^{ht}}
     #   d_SecondPCA_beforeLPP = the second-level PCA embedding dimension before we do LPP
     #   d_LPP = the LPP embedding dimension 
     #   inv_mat = the pseudo-inverse map that helps to reconstruct the labels for newly-generated training data x within kd-tree cluster using pre-trained model
@@ -292,18 +294,24 @@ def LPP_BuildDataModel(data_train, leafs, d_SecondPCA_beforeLPP, d_LPP, inv_mat,
     # Output:
     #   Seq = the LPP frames corresponding to each cluster in data_train, labeling the correponding Grassmann equivalence class
     #   data_train = the training data set possibly modified by augmenting each cluster using pre-trained model labeling
-    #   leafs = the indexes of data_train into new possibly augmented clusters C_1, ..., C_{2^{ht}}
+    #   index = the kd-tree index, with the leafs extended to the new possibly augmented clusters C_1, ..., C_{2^{ht}}
 
     # obtain the dimension of each sample in data_train["x"]
     d_data = len(data_train["x"][0])
     # initialize the LPP frames A_1,...,A_{2^{ht}}
-    Seq = np.zeros((len(leafs), d_data, d_LPP))
+    Seq = np.zeros((index.num_leafs, d_data, d_LPP))
+    # collect the LPP choices for LPP_Frame
+    LPP_options = LPP_Options(d_SecondPCA_beforeLPP)
+    # build LPP Model for all leafs in parallel, the augmentation needs the pre-trained learning model and stays sequential
+    if doParallelBuild and not doAugment_kdtreeCluster:
+        Seq = LPP_BuildFrames_Parallel(data_train["x"], data_train["y"], index.leafs(), d_LPP, LPP_options, Seq, num_workers_build, blas_threads_build)
+        return Seq, data_train, index
     # build LPP Model for each leaf
-    # input: data, indx, leafs
-    for k in range(len(leafs)):
+    # input: data, index
+    for k in range(index.num_leafs):
         # form the data_train subsample the k-th cluster
-        data_train_x_k = [data_train["x"][_] for _ in leafs[k]]
-        data_train_y_k = [data_train["y"][_] for _ in leafs[k]]
+        data_train_x_k = [data_train["x"][_] for _ in index.leaf(k)]
+        data_train_y_k = [data_train["y"][_] for _ in index.leaf(k)]
         # augment the data_train_x_k and pre-trained learning model prediction
         if doAugment_kdtreeCluster:
             # generate new data from data_train_x_k via teh given method
@@ -317,47 +325,118 @@ def LPP_BuildDataModel(data_train, leafs, d_SecondPCA_beforeLPP, d_LPP, inv_mat,
             data_train_x_k.extend(data_train_x_k_additional)
             data_train_y_k.extend(data_train_y_k_additional)
 
-        if doSecondPCA_beforeLPP:
-            # do a second-level PCA first, for the k-th cluster, so data_train_x_k dimension is reduced to d_SecondPCA_beforeLPP
-            pca = PCA()
-            pca.fit(data_train_x_k)
-            PCA_k = pca.components_
-            data_train_x_k = np.matmul(data_train_x_k, np.array([PCA_k[_] for _ in range(d_SecondPCA_beforeLPP)]).T)
-            # then do LPP for the PCA embedded data_train_x_k and reduce the dimension to d_LPP
-            # construct the supervise affinity matrix S
-            between_class_affinity = 0
-            S_k = affinity_supervised(data_train_x_k, data_train_y_k, between_class_affinity)
-            # construct the graph Laplacian L and degree matrix D
-            L_k, D_k = graph_laplacian(S_k)
-            # do LPP
-            A_k, LAMBDA = LPP(data_train_x_k, L_k, D_k)
-            LPP_k, R = np.linalg.qr(A_k)        
-            # obtain the frame Seq(:,:,k)
-            Seq[k] = np.matmul(np.array([PCA_k[_] for _ in range(d_SecondPCA_beforeLPP)]).T, np.array([LPP_k[_] for _ in range(1, d_LPP+1)]).T)
-            print("frame ",k+1," size=(", len(Seq[k]),",",len(Seq[k][0]), "), IfStiefel? Residue = ", np.linalg.norm(np.array(np.matmul(Seq[k].T, Seq[k]))-np.array(np.diag(np.ones(d_LPP)))))
-        else:
-            # do LPP directly to data_train_x_k and reduce the dimension to d_LPP
-            # construct the supervise affinity matrix S
-            between_class_affinity = 0
-            S_k = affinity_supervised(data_train_x_k, data_train_y_k, between_class_affinity)
-            # construct the graph Laplacian L and degree matrix D
-            L_k, D_k = graph_laplacian(S_k)
-            # do LPP
-            A_k, LAMBDA = LPP(data_train_x_k, L_k, D_k)
-            LPP_k, R = np.linalg.qr(A_k)        
-            # obtain the frame Seq(:,:,k)
-            Seq[k] = np.array([LPP_k[_] for _ in range(1, d_LPP+1)]).T
-            print("frame ",k+1," size=(", len(Seq[k]),",",len(Seq[k][0]), "), IfStiefel? Residue = ", np.linalg.norm(np.array(np.matmul(Seq[k].T, Seq[k]))-np.array(np.diag(np.ones(d_LPP)))))
+        # do LPP for data_train_x_k (possibly after a second-level PCA) and reduce the dimension to d_LPP, obtain the frame Seq(:,:,k)
+        Seq[k] = LPP_Frame(data_train_x_k, data_train_y_k, d_LPP, LPP_options)
+        print("frame ",k+1," size=(", len(Seq[k]),",",len(Seq[k][0]), "), IfStiefel? Residue = ", np.linalg.norm(np.array(np.matmul(Seq[k].T, Seq[k]))-np.array(np.diag(np.ones(d_LPP)))))
 
     # choose to use the augmented data with labels from pre-trained model for the clusters
     if doUseAugmentData_kdtreeCluster and doAugment_kdtreeCluster:
-        for k in range(len(leafs)):
+        for k in range(index.num_leafs):
             # finalize the training data for the k-th cluster
             data_train["x"].extend(data_train_x_k_additional)    
             data_train["y"].extend(data_train_y_k_additional)
-            leafs[k].extend(range(train_size + k * number_samples_additional_kdtreeCluster, train_size + (k+1) * number_samples_additional_kdtreeCluster))
+        index.extend_leafs([range(train_size + k * number_samples_additional_kdtreeCluster, train_size + (k+1) * number_samples_additional_kdtreeCluster) for k in range(index.num_leafs)])
    
-    return Seq, data_train, leafs
+    return Seq, data_train, index
+
+
+# the LPP choices for LPP_Frame
+def LPP_Options(d_SecondPCA_beforeLPP):
+    LPP_options = {"d_SecondPCA_beforeLPP": d_SecondPCA_beforeLPP if doSecondPCA_beforeLPP else 0,
+                   "PCA_solver": PCA_solver,
+                   "doSparseAffinity": doSparseAffinity,
+                   "k_affinity": k_affinity,
+                   "epsilon_affinity": epsilon_affinity,
+                   "doClassBlockLPP": doClassBlockLPP,
+                   "num_sample_heat": num_sample_heat,
+                   "ridge": LPP_ridge,
+                   "solver": LPP_solver,
+                   "dual": LPP_dual}
+    return LPP_options
+
+
+# insert newly arrived labelled data (x_new, y_new) into the trained model online
+# the new points are routed to their kd-tree leafs, the leafs over max_leaf_size_kdtree are split, 
+# and only the LPP frames of the leafs changed by the insertion are recomputed, incrementally if leaf_models is given
+def LPP_InsertData(data_train, index, Seq, m, x_new, y_new, d_SecondPCA_beforeLPP, d_LPP, leaf_models=None):
+    # Input:
+    #   data_train = the training data set the model was built on
+    #   index = the kd-tree index of data_train, the embedded data_train is attached to it if it is not (after LPP_ModelStore or extend_leafs)
+    #   Seq = the LPP frames of the leafs of index
+    #   m = the centers of the leafs of index
+    #   x_new, y_new = the new data points and their labels
+    #   d_SecondPCA_beforeLPP = the second-level PCA embedding dimension before we do LPP
+    #   d_LPP = the LPP embedding dimension 
+    #   leaf_models = dictionary {k: LPP_LeafModel of leaf k}, updated in place by low-rank updates of the changed leafs (created at their first change)
+    #                 None to recompute the frames from scratch with LPP_Frame, the incremental models are not used with doSecondPCA_beforeLPP
+    # Output:
+    #   data_train = the training data set with the new data appended
+    #   index = the kd-tree index with the new data inserted
+    #   Seq = the LPP frames of the leafs of index, with the frames of the changed leafs recomputed
+    #   m = the centers of the leafs of index, with the centers of the changed leafs recomputed
+    
+    # the frames and centers of a model loaded from the store are read-only memory maps, copy them before they are updated in place
+    if not Seq.flags.writeable:
+        Seq = np.array(Seq)
+    if not m.flags.writeable:
+        m = np.array(m)
+    if index.x is None:
+        index.attach_data(LPP_KdtreeEmbedding(index, data_train["x"]), data_train["y"])
+    # append the new data to data_train, the new rows get the same indexes in index
+    data_train = {"x": np.concatenate((np.asarray(data_train["x"]), np.asarray(x_new))), "y": np.concatenate((np.asarray(data_train["y"]), np.asarray(y_new)))}
+    changed = index.insert(LPP_KdtreeEmbedding(index, x_new), y_new, max_leaf_size_kdtree)
+    # add the frames of the leafs created by splits
+    if index.num_leafs > len(Seq):
+        Seq = np.concatenate((Seq, np.zeros((index.num_leafs - len(Seq), len(Seq[0]), len(Seq[0][0])))))
+        m = np.concatenate((m, np.zeros((index.num_leafs - len(m), len(m[0])))))
+    LPP_options = LPP_Options(d_SecondPCA_beforeLPP)
+    for k in changed:
+        members = index.leaf(k)
+        if leaf_models is not None and not doSecondPCA_beforeLPP:
+            model_k = leaf_models.get(k)
+            if model_k is not None:
+                # the samples that joined leaf k, and those that left it by a split
+                added = np.setdiff1d(members, model_k.ids)
+                removed = np.setdiff1d(model_k.ids, members)
+                if len(added) + len(removed) > len(members)/2:
+                    # too many changes for low-rank updates, rebuild the leaf model
+                    model_k = None
+                else:
+                    model_k.remove(removed)
+                    model_k.add(data_train["x"][added], data_train["y"][added], added)
+            if model_k is None:
+                # the leaf model picks LOBPCG, warm-started from the previous eigenvectors by the later solves, only where it applies (5 (d_LPP+1) < d)
+                model_k = LPP_LeafModel(data_train["x"][members], data_train["y"][members], members, d_LPP, LPP_ridge)
+                leaf_models[k] = model_k
+            Seq[k] = model_k.frame()
+        else:
+            Seq[k] = LPP_Frame(data_train["x"][members], data_train["y"][members], d_LPP, LPP_options)
+        m[k] = np.mean(data_train["x"][members], axis=0)
+        print("frame ",k+1," recomputed after insertion, leaf size=", len(members))
+    index.dirty[changed] = False
+    return data_train, index, Seq, m
+
+
+# the dataset choice and all parameters that determine the trained model, the key of the model store is a hash of them and of the data fingerprint
+# the test-time parameters (ratio_threshold, K, k_nearest_neighbor, center of mass choices) are left out, 
+# except doCrossProjection and num_partners_cross, which decide the cross-projection store kept with the model
+def LPP_TrainingParameters():
+    params = {"doMNIST": doMNIST, "doCIFAR10": doCIFAR10, "doOlivetti": doOlivetti, "dovgg_faces": dovgg_faces, "dopca256": dopca256,
+              "do_preliminary_PCA_reduction": do_preliminary_PCA_reduction, "d_PCA": d_PCA,
+              "PCA_solver": PCA_solver, "doSecondPCA_kdtree": doSecondPCA_kdtree, "d_SecondPCA_kdtree": d_SecondPCA_kdtree, "dokdtreetuning": dokdtreetuning,
+              "train_size": train_size, "test_size": test_size, "ht": ht,
+              "doSecondPCA_beforeLPP": doSecondPCA_beforeLPP, "d_SecondPCA_beforeLPP": d_SecondPCA_beforeLPP, "d_LPP": d_LPP,
+              "doSparseAffinity": doSparseAffinity, "k_affinity": k_affinity, "epsilon_affinity": epsilon_affinity,
+              "doClassBlockLPP": doClassBlockLPP, "num_sample_heat": num_sample_heat, "LPP_solver": LPP_solver, "LPP_ridge": LPP_ridge, "LPP_dual": LPP_dual,
+              "doAugment_Global": doAugment_Global, "number_samples_additional_Global": number_samples_additional_Global,
+              "number_components_Global": number_components_Global,
+              "doAugment_kdtreeCluster": doAugment_kdtreeCluster, "doUseAugmentData_kdtreeCluster": doUseAugmentData_kdtreeCluster,
+              "number_samples_additional_kdtreeCluster": number_samples_additional_kdtreeCluster,
+              "number_components_kdtreeCluster": number_components_kdtreeCluster,
+              "doAugmentViaGMM": doAugmentViaGMM, "doAugmentViaUMAP": doAugmentViaUMAP, "number_neighbors_UMAP": number_neighbors_UMAP,
+              "learning_model": learning_model, "doInsertData": doInsertData, "insert_size": insert_size,
+              "doCrossProjection": doCrossProjection, "num_partners_cross": num_partners_cross}
+    return params
 
 
 # Test the LPP piecewise linear embedding model and the interpolated piecewise linear embedding model
@@ -368,25 +447,79 @@ def LPP_NearestNeighborTest():
     # load data
     data_original_train, data_original_test = load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces, dopca256)
 
-    # obtain the train, test sets in nwpu and the LPP frames Seq(:,:,k) for each cluster with indexes in leafs
-    data_train, leafs, data_test, inv_mat = LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_kdtree, train_size, test_size, ht)
-    Seq, data_train, leafs = LPP_BuildDataModel(data_train, leafs, d_SecondPCA_beforeLPP, d_LPP, inv_mat, train_size)
+    # look up the trained model in the model store, the training parameters and the fingerprint of the loaded data enter its key, 
+    # so that a changed or replaced dataset is trained anew
+    model = None
+    if doModelStore:
+        model_params = LPP_TrainingParameters()
+        model_params["data_fingerprint"] = LPP_DataFingerprint([data_original_train["x"], data_original_train["y"], data_original_test["x"], data_original_test["y"]])
+        model_key = LPP_ModelKey(model_params)
+        model = LPP_LoadModel(model_store_dir, model_key)
+
+    if model is not None:
+        # reuse the stored model and skip the training entirely
+        print("loaded model", model_key, "from", model_store_dir)
+        data_train = {"x": model["data_train_x"], "y": model["data_train_y"]}
+        data_test = {"x": model["data_test_x"], "y": model["data_test_y"]}
+        index = VisualWordIndex.from_arrays(model)
+        inv_mat = model["inv_mat"]
+        Seq = model["Seq"]
+        m = model["leafs_centers"]
+        cross_partners = model.get("cross_partners")
+        cross_projections = model.get("cross_projections")
+        d_data = len(data_train["x"][0])
+        data_insert = {"x": model.get("data_insert_x", np.zeros((0, d_data))), "y": model.get("data_insert_y", np.zeros(0))}
+    else:
+        # obtain the train, test sets in nwpu and the LPP frames Seq(:,:,k) for each cluster with indexes in the leafs of index
+        data_train, index, data_test, inv_mat, PCA_basis, data_insert = LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_kdtree, train_size, test_size, ht)
+        Seq, data_train, index = LPP_BuildDataModel(data_train, index, d_SecondPCA_beforeLPP, d_LPP, inv_mat, train_size)
+
+        # data original dimension d_data
+        d_data = len(data_train["x"][0])
+        
+        # find m_1, ..., m_{2^{ht}}, the means of the chosen clusters, by segmented reductions over the leafs
+        m = index.compute_means(data_train["x"])
+
+        # the cross-projection store: the training points of each leaf projected onto the frames of the leafs with the closest centers
+        cross_partners, cross_projections = None, None
+        if doCrossProjection:
+            cross_partners, cross_projections = CrossProjection_Build(data_train["x"], index, Seq, m, num_partners_cross)
+
+        # store the trained model for later runs with the same training parameters
+        if doModelStore:
+            model = {"data_train_x": data_train["x"], "data_train_y": data_train["y"],
+                     "data_test_x": data_test["x"], "data_test_y": data_test["y"],
+                     "inv_mat": inv_mat, "Seq": Seq, "leafs_centers": m}
+            if doCrossProjection:
+                model["cross_partners"] = cross_partners
+                model["cross_projections"] = cross_projections
+            if doInsertData:
+                model["data_insert_x"] = data_insert["x"]
+                model["data_insert_y"] = data_insert["y"]
+            model.update(index.to_arrays())
+            if PCA_basis is not None:
+                model["PCA_basis"] = PCA_basis
+            print("stored model", model_key, "in", LPP_SaveModel(model_store_dir, model_key, model, model_params))
+
+    # insert the held-out training data into the model online, insert_batch_size points at a time as they would arrive,
+    # only the frames and centers of the leafs changed by each batch are recomputed
+    # with doLeafModel the frames of the changed leafs are refreshed after every batch by low-rank updates of their incremental leaf models
+    if doInsertData:
+        leaf_models = {} if doLeafModel else None
+        for start in range(0, len(data_insert["y"]), insert_batch_size):
+            data_train, index, Seq, m = LPP_InsertData(data_train, index, Seq, m, data_insert["x"][start:start+insert_batch_size], data_insert["y"][start:start+insert_batch_size], 
+                                                       d_SecondPCA_beforeLPP, d_LPP, leaf_models)
+        print("inserted", len(data_insert["y"]), "training points online, number of leafs =", index.num_leafs)
+        # the leafs, frames and centers have changed, so the cross-projection store is built anew
+        if doCrossProjection:
+            cross_partners, cross_projections = CrossProjection_Build(data_train["x"], index, Seq, m, num_partners_cross)
 
     # all these LPP Stiefel frames are on St(n, p)
     n = len(Seq[0])
     p = len(Seq[0][0])
-        
-    # data original dimension d_data
-    d_data = len(data_train["x"][0])
-        
-    # find m_1, ..., m_{2^{ht}}, the means of the chosen clusters
-    m = np.zeros((2**ht, d_data))
-    for k in range(2**ht):
-        m[k] = np.mean([data_train["x"][_] for _ in leafs[k]], axis=0)
-
-    # set the sequence of interpolation numbers and the threshold ratio for determining the interpolation number
-    interpolation_number_seq = np.ones(test_size)
-    ratio_seq = np.zeros((test_size, 2)) # the sequence of second smallest (or largest) to-center distance over smallest to-center distance, for tuning ratio_threshold
+
+    # the sequence of interpolation numbers and ratio_seq, the sequence of second smallest (or largest) to-center distance over smallest to-center distance, 
+    # for tuning ratio_threshold, are set by the batched cluster selection below
    
     classified_o = np.zeros(test_size) # list of classified/not classified projections for using the original data point and nearest cluster
     classified_agg_o = np.zeros(test_size) # list of classified/not classified projections for using the original data point and nearest (interpolation_number) clusters
@@ -395,42 +528,57 @@ def LPP_NearestNeighborTest():
     classified_model = np.zeros(test_size) # list of classified/not classified projections for using the pre-trained learning model
     
     cpu_time_start = time.process_time()
+    # locate all test points on the kd-tree at once, the candidate clusters of a test point are the leafs within locate_margin of its split planes
+    if doTreeLocate:
+        candidates = locate(index, LPP_KdtreeEmbedding(index, data_test["x"]), locate_margin)
+    else:
+        candidates = None
+    # select the interpolation clusters of all test points at once: the clusters within ratio_threshold times the distance of the closest cluster center, 
+    # sorted by ascending distance, with their weights exp(-K * distance^2)
+    cluster_ids, cluster_dist, cluster_weights, cluster_offsets, ratio_seq = nearest_clusters_batch(data_test["x"], m, ratio_threshold, K, candidates)
+    # interpolation_number = number of frames used for interpolation between cluster LDA frames, for each test point x
+    interpolation_number_seq = np.diff(cluster_offsets)
+    # the frames of the clusters of all test points padded to the largest interpolation number with zero weights, for the batched centers
+    if (not doGrassmannpFCenter and doStiefelEuclidCenter and not doGD) or (doGrassmannpFCenter and doGrassmannArcCenter):
+        pad_rows = np.repeat(np.arange(test_size), interpolation_number_seq)
+        pad_columns = np.arange(len(cluster_ids)) - np.repeat(cluster_offsets[:-1], interpolation_number_seq)
+        pad_indexes = -np.ones((test_size, np.max(interpolation_number_seq)), dtype=int)
+        pad_indexes[pad_rows, pad_columns] = cluster_ids
+        pad_weights = np.zeros((test_size, np.max(interpolation_number_seq)))
+        pad_weights[pad_rows, pad_columns] = cluster_weights
+    # the arc-distance (Karcher) Grassmann centers of all test points at once, started from their projected Frobenius centers
+    if doGrassmannpFCenter and doGrassmannArcCenter:
+        arc_centers, arc_values, arc_gradnorms, arc_iterations, arc_converged = Center_Mass_Arc_Batch(pad_weights, Seq, pad_indexes, None, threshold_fixedpoint, arc_iteration)
+        print("arc center fixed-point iterations: mean = ", np.mean(arc_iterations), ", max = ", np.max(arc_iterations), 
+              ", not converged within", arc_iteration, "iterations:", np.count_nonzero(~arc_converged), "test points")
+    # the Stiefel Euclid centers of all test points at once
+    if not doGrassmannpFCenter and doStiefelEuclidCenter and not doGD:
+        centers_batch, values_batch, gradnorms_batch = Center_Mass_Euclid_Batch(pad_weights, Seq, pad_indexes)
+        # the training data as one array, for the frames missing from the cross-projection store
+        if doCrossProjection:
+            data_train_x = np.asarray(data_train["x"])
     for test_index in range(test_size):
         print("\ntest point", test_index+1, " -----------------------------------------------------------\n")
         x = data_test["x"][test_index]
         y = data_test["y"][test_index]
-        # sort the cluster centers m_1, ..., m_{2^{ht}} by ascending distances to x 
-        dist = [np.linalg.norm(x-m[k]) for k in range(2**ht)]
-        indexes, dist_sort = zip(*sorted(enumerate(dist), key=itemgetter(1))) 
-        # count the number of St(p, n) interpolation clusters for current test point x
-        # interpolation_number = number of frames used for interpolation between cluster LDA frames
-        interpolation_number = 1
-        print("ratio between [", dist_sort[1]/dist_sort[0], ",", dist_sort[2**ht-1]/dist_sort[0], "]")
-        ratio_seq[test_index][0] = dist_sort[1]/dist_sort[0]
-        ratio_seq[test_index][1] = dist_sort[2**ht-1]/dist_sort[0]
-        for k in range(1, 2**ht):
-            if dist_sort[k] <= ratio_threshold * dist_sort[0]:
-                interpolation_number = interpolation_number + 1
-            else:
-                break
+        # the St(p, n) interpolation clusters for current test point x, sorted by ascending distances to x
+        indexes = cluster_ids[cluster_offsets[test_index]:cluster_offsets[test_index+1]]
+        interpolation_number = interpolation_number_seq[test_index]
+        print("ratio between [", ratio_seq[test_index][0], ",", ratio_seq[test_index][1], "]")
         print("interpolation number = ", interpolation_number)
-        # record the sequence of all interpolation numbers for each test point x
-        interpolation_number_seq[test_index] = interpolation_number
         # find the LPP Stiefel projection frames A_k1, ..., A_k{interpolation_number} for the first (interpolation_number) closest clusters to x
         frames = np.zeros((interpolation_number, d_data, d_LPP))
         for i in range(interpolation_number):
             frames[i] = Seq[indexes[i]]
         # find the weights w_1, ..., w_{interpolation_number} for the first (interpolation_number) closest clusters to x
-        w = [np.exp(-K * (dist_sort[i]**2)) for i in range(interpolation_number)]
+        w = list(cluster_weights[cluster_offsets[test_index]:cluster_offsets[test_index+1]])
         # collect all indexes in clusters corresponding to the first (interpolation_number) closest clusters to x
-        aggregate_cluster = []
-        for i in range(interpolation_number):
-            aggregate_cluster = list(set(aggregate_cluster) | set(leafs[indexes[i]]))
+        aggregate_cluster = np.unique(np.concatenate([index.leaf(_) for _ in indexes]))
         # do k-nearest-neighbor classification based on the closest cluster to x, in original space
         x_test = x
         y_test = y
-        X_train = [data_train["x"][_] for _ in leafs[indexes[0]]]
-        Y_train = [data_train["y"][_] for _ in leafs[indexes[0]]]
+        X_train = [data_train["x"][_] for _ in index.leaf(indexes[0])]
+        Y_train = [data_train["y"][_] for _ in index.leaf(indexes[0])]
         isclassified_o, class_predict = knn(x_test, y_test, X_train, Y_train, k_nearest_neighbor)
         classified_o[test_index] = isclassified_o
         # do k-nearest-neighbor classification based on the (interpolation_number) nearest clusters to x, in oroginal space
@@ -443,8 +591,8 @@ def LPP_NearestNeighborTest():
         # project x to A1 x and classify it using k-nearest-neighbor on the projection via A1 of the closest cluster
         x_test = np.matmul(x, frames[0])
         y_test = y
-        X_train = [np.matmul(data_train["x"][_],  frames[0]) for _ in leafs[indexes[0]]]
-        Y_train = [data_train["y"][_] for _ in leafs[indexes[0]]]
+        X_train = [np.matmul(data_train["x"][_],  frames[0]) for _ in index.leaf(indexes[0])]
+        Y_train = [data_train["y"][_] for _ in index.leaf(indexes[0])]
         isclassified_bm, class_predict = knn(x_test, y_test, X_train, Y_train, k_nearest_neighbor)
         classified_bm[test_index] = isclassified_bm
         # calculate the center of mass for the (interpolation_number) nearest cluster LPP frames with respect to weights w 
@@ -452,7 +600,12 @@ def LPP_NearestNeighborTest():
             # do Grassmann center of mass method
             GrassmannOpt = Grassmann_Optimization(w, frames, threshold_gradnorm, threshold_fixedpoint, threshold_checkonGrassmann)
             if doGD:
-                break
+                # Riemannian descent from the closed-form center, or from the frame of the closest cluster
+                center, valueseq, gradnormseq, iterations = GrassmannOpt.Center_Mass_GD_pFrobenius(None if GD_warmstart else frames[0], GD_iteration, GD_lr, GD_lrdecayrate, GD_method)
+                print("GD iterations = ", iterations, ", gradnorm = ", gradnormseq[-1])
+            elif doGrassmannArcCenter:
+                # computed for all test points before the loop
+                center, value, gradnorm = arc_centers[test_index], arc_values[test_index], arc_gradnorms[test_index]
             else:
                 center, value, grad = GrassmannOpt.Center_Mass_pFrobenius()
         else:
@@ -460,16 +613,24 @@ def LPP_NearestNeighborTest():
             StiefelOpt = Stiefel_Optimization(w, frames, threshold_gradnorm, threshold_fixedpoint, threshold_checkonStiefel, threshold_logStiefel)
             if doStiefelEuclidCenter:
                 if doGD:
-                    break
+                    # Riemannian descent from the closed-form center, or from the frame of the closest cluster
+                    center, valueseq, gradnormseq, iterations = StiefelOpt.Center_Mass_GD_Euclid(None if GD_warmstart else frames[0], GD_iteration, GD_lr, GD_lrdecayrate, GD_method)
+                    print("GD iterations = ", iterations, ", gradnorm = ", gradnormseq[-1])
                 else:
-                    center, value, gradnorm = StiefelOpt.Center_Mass_Euclid()
+                    # computed for all test points before the loop
+                    center, value, gradnorm = centers_batch[test_index], values_batch[test_index], gradnorms_batch[test_index]
             else:
                 break
         # project x to center x and classify it using k-nearest-neighbor on the projection via center of all (interpolation number) clusters
         x_test = np.matmul(x , center)
         y_test = y
-        X_train = [np.matmul(data_train["x"][_], center) for _ in aggregate_cluster]
-        Y_train = [data_train["y"][_] for _ in aggregate_cluster]    
+        if not doGrassmannpFCenter and doStiefelEuclidCenter and not doGD and doCrossProjection:
+            # the projections through the center from the stored projections onto the cluster frames, with p x p work per training point
+            X_train, M = CrossProjection_Center(data_train_x, index, Seq, cross_partners, cross_projections, indexes, w)
+            Y_train = [data_train["y"][_] for i in indexes for _ in index.leaf(i)]
+        else:
+            X_train = [np.matmul(data_train["x"][_], center) for _ in aggregate_cluster]
+            Y_train = [data_train["y"][_] for _ in aggregate_cluster]    
         isclassified_c, class_predict = knn(x_test, y_test, X_train, Y_train, k_nearest_neighbor)
         classified_c[test_index] = isclassified_c
         # classify x using pre-trained learning model
@@ -550,26 +711,21 @@ def LPP_NearestNeighborTest():
 # can choose the data set to be augmented by the pre-trained model, in a global fashion or by each cluster
 def OriginalFullDataSet_NearestNeighborTest():
     # load data
-    data_original_train, data_original_test = load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces)
-    # obtain the train, test sets in nwpu and the LPP frames Seq(:,:,k) for each cluster with indexes in leafs
-    data_train, leafs, data_test, inv_mat = LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_kdtree, train_size, test_size, ht)
+    data_original_train, data_original_test = load_data(doMNIST, doCIFAR10, doOlivetti, dovgg_faces, dopca256)
+    # obtain the train, test sets in nwpu and the LPP frames Seq(:,:,k) for each cluster with indexes in the leafs of index
+    data_train, index, data_test, inv_mat, PCA_basis, _ = LPP_ObtainData(data_original_train, data_original_test, d_PCA, d_SecondPCA_kdtree, train_size, test_size, ht)
     # augment leaf by leaf
     if doAugment_kdtreeCluster and doUseAugmentData_kdtreeCluster:
-        Seq, data_train, leafs = LPP_BuildDataModel(data_train, leafs, d_SecondPCA_beforeLPP, d_LPP, inv_mat, train_size)
+        Seq, data_train, index = LPP_BuildDataModel(data_train, index, d_SecondPCA_beforeLPP, d_LPP, inv_mat, train_size)
     # list of classified/not classified projections for using knn in the whole data set in itr original space
-    classified_fulldataset = np.zeros(test_size) 
+    # do k-nearest-neighbor classification of all test points at once for all training data in the original space
+    if doTreeKnn:
+        # the exact search by branch-and-bound on the kd-tree leafs, with their min bounding rectangles in the original space
+        class_predict, classified_fulldataset = knn_tree_batch(data_test["x"], data_train["x"], data_train["y"], k_nearest_neighbor, index, data_test["y"], index.compute_mbrs(data_train["x"]))
+    else:
+        class_predict, classified_fulldataset = knn_batch(data_test["x"], data_train["x"], data_train["y"], k_nearest_neighbor, data_test["y"])
     for test_index in range(test_size):
-        print("\ntest point", test_index+1, " -----------------------------------------------------------\n")
-        x = data_test["x"][test_index]
-        y = data_test["y"][test_index]
-        # do k-nearest-neighbor classification for all training data in the original space
-        x_test = x
-        y_test = y
-        X_train = data_train["x"]
-        Y_train = data_train["y"]
-        isclassified_fulldataset, class_predict = knn(x_test, y_test, X_train, Y_train, k_nearest_neighbor)
-        classified_fulldataset[test_index] = isclassified_fulldataset
-        print("full dataset in original dimension classified =", isclassified_fulldataset)
+        print("test point", test_index+1, ": full dataset in original dimension classified =", classified_fulldataset[test_index])
     # summarize the final result
     rate_f = (sum(classified_fulldataset)/test_size)*100
     file=open('conclusion_originalknn.txt', 'w')
@@ -622,9 +778,9 @@ def TrainingDataAugmentation(training_data_original_x, training_data_original_y,
             training_data_additional_y.append(predicted_y_i)
             print("SVM: Newly generated input data #", i, ", pre-trained model predicted label is ", training_data_additional_y[i])
     elif learning_model == 'knn':
+        predicted_y, isclassified = knn_batch(training_data_additional_x_[:number_samples_additional], training_data_original_x, training_data_original_y, 1)
         for i in range(number_samples_additional):
-            isclassified, predicted_y_i = knn(training_data_additional_x_[i], '', training_data_original_x, training_data_original_y, 1) 
-            training_data_additional_y.append(predicted_y_i)
+            training_data_additional_y.append(predicted_y[i])
             print("knn: Newly generated input data #", i, ", pre-trained model predicted label is ", training_data_additional_y[i])
     elif learning_model == 'MNISTLeNetv2':
         model = model_MNISTLeNetv2
@@ -673,6 +829,8 @@ if __name__ == "__main__":
     doSecondPCA_kdtree = 0
     # choose to do a PCA for each cluster to dimension d_SecondPCA_beforeLPP before do LPP on that cluster
     doSecondPCA_beforeLPP = 0
+    # the PCA solver: 'full' computes all components, 'randomized' only the kept ones, 'incremental' streams the data in chunks
+    PCA_solver = 'randomized'
 
     # select which dataset to work on
     doMNIST = 0
@@ -688,12 +846,45 @@ if __name__ == "__main__":
     d_SecondPCA_beforeLPP = 100
     # the LPP embedding dimension = d_LPP on each given cluster
     d_LPP = 128
+    # choose to build the supervised affinity of each cluster as a sparse matrix over the k_affinity nearest same-class neighbours
+    doSparseAffinity = 0
+    # the number of nearest same-class neighbours kept in the sparse affinity
+    k_affinity = 10
+    # the radius of the same-class epsilon-ball added to the sparse affinity, None for knn only
+    epsilon_affinity = None
+    # choose to assemble the LPP matrices of each cluster class block by class block, without the n x n affinity (dense affinity only)
+    doClassBlockLPP = 1
+    # the number of random sample pairs the class block LPP estimates the heat kernel size from (unseeded, so the frames vary from run to run), 
+    # None for the exact mean over all pairs as in the baseline, O(n^2 d) time but only O(n) memory per row block
+    num_sample_heat = None
+    # the LPP generalized eigensolver: 'dense' for the subset-by-index dense solve, 'lobpcg' for the iterative solve
+    LPP_solver = 'dense'
+    # the relative ridge added to X'DX in LPP, keeps the solve well-posed when a cluster has fewer samples than dimensions
+    LPP_ridge = 1e-8
+    # solve LPP in the n x n sample space instead of the d x d feature space: 'auto' does so for clusters with fewer samples than dimensions
+    LPP_dual = 'auto'
+    # choose to build the LPP frames of the clusters in parallel over a pool of num_workers_build processes
+    doParallelBuild = 0
+    # the number of worker processes and the number of BLAS threads per worker for the parallel build
+    num_workers_build = 8
+    blas_threads_build = 1
     # train_size = the training data size
     train_size = 380000
     # ht = the partition tree height
     ht = 8
     # choose if we want to do a further tuning for the kd tree
     dokdtreetuning = 0
+    # build the kd-tree subtrees below this depth in parallel over num_workers_build processes, 0 for a sequential build
+    kdtree_parallel_depth = 0
+    # the leaf size over which a kd-tree leaf is split when new data is inserted online (LPP_InsertData), None for never
+    max_leaf_size_kdtree = None
+    # choose to hold insert_size training points out of the model and insert them online (LPP_InsertData) before the test, insert_batch_size at a time
+    doInsertData = 0
+    insert_size = 1000
+    insert_batch_size = 100
+    # choose to keep an incremental LPP model (LPP_LeafModel) of each leaf changed by the insertion, updated by low-rank updates instead of rebuilt
+    # (not used with doSecondPCA_beforeLPP)
+    doLeafModel = 1
     # test_size = the test data size
     test_size = 1000
 
@@ -745,12 +936,32 @@ if __name__ == "__main__":
     K = 1e-8 
     # the parameter k for k-nearest-neighbor classification
     k_nearest_neighbor = 1
+    # choose to find the candidate clusters of a test point by locating it on the kd-tree instead of comparing it with all cluster centers
+    doTreeLocate = 0
+    # the distance to the split planes within which the kd-tree location also descends into the far side
+    locate_margin = 1.0
     # do or do not do projected Frobenius center of mass for Grassmannian frame    
     doGrassmannpFCenter = 0 
+    # for the Grassmann frame, do the arc-distance (Karcher) center of mass instead of the projected Frobenius one, and its maximal number of fixed-point iterations
+    doGrassmannArcCenter = 0
+    arc_iteration = 100
     # do or do not do Euclid center of mass for Stiefel frame     
     doStiefelEuclidCenter = 1 
     # do or do not do GD for finding center of mass     
     doGD = 0 
+    # the GD method, 'gd' fixed step, 'armijo' line search or 'cg' Riemannian conjugate gradient, its maximal number of iterations, (initial) step and step decay rate
+    GD_method = 'cg'
+    GD_iteration = 100
+    GD_lr = 1.0
+    GD_lrdecayrate = 1.0
+    # choose to start GD from the closed-form center instead of the frame of the closest cluster
+    GD_warmstart = 1
+    # for the Stiefel Euclid center without GD, project the training points through the center via the projections onto the cluster frames 
+    # stored with the model, each leaf is stored projected onto the frames of the num_partners_cross leafs with the closest centers (itself included)
+    # the store holds train_size x num_partners_cross x d_LPP numbers, more than the training data once num_partners_cross * d_LPP > d_data,
+    # and it is built anew whenever the model is trained or data is inserted, so it is meant to be kept with doModelStore
+    doCrossProjection = 0
+    num_partners_cross = 8
     # threshold parameters for Stiefel and Grassmann Optimization
     threshold_gradnorm = 1e-4
     threshold_fixedpoint = 1e-4
@@ -758,9 +969,24 @@ if __name__ == "__main__":
     threshold_checkonStiefel = 1e-10
     threshold_logStiefel = 1e-4
 
+    # choose to convert each dataset once into a columnar float32 store and load it memory-mapped in later runs
+    doDataStore = 0
+    # the directory of the dataset store
+    data_store_dir = 'data_store'
+    # the vgg_faces train/test split is random, with doDataStore the split made at conversion is reused by every later run, 
+    # choose to draw a new random split from the stored rows at every load instead
+    doResplit_vgg_faces = 0
+    # choose to keep the trained model (data, tree, frames) in an on-disk store and reuse it in later runs with the same training parameters
+    doModelStore = 0
+    # the directory of the model store
+    model_store_dir = 'model_store'
+
     # do the test of the classification rate using original full data set and original dimension
     # can choose the data set to be augmented by the pre-trained model, either globally or by each cluster 
     doTestFullData_knn = 0
+    # choose to search the full data set exactly leaf by leaf on the kd-tree, pruning the leafs by their min bounding rectangles, instead of brute force
+    # (this only pays off when the data has low intrinsic dimension, on high dimensional data the blocked brute force of knn_batch is faster)
+    doTreeKnn = 0
     # do the LPP analysis on different datasets
     doLPP_NearestNeighborTest = 1
 
@@ -0,0 +1,98 @@
+"""
+%%%%%%%%%%%%%%%%%%%% Columnar, memory-mapped store of the datasets %%%%%%%%%%%%%%%%%%%%
+
+Each dataset is converted once into store_dir/name/ with
+    x_train.npy, x_test.npy = contiguous float32 feature matrices (number of samples x d)
+    y_train.npy, y_test.npy = int32 label codes, shared by the training and testing sets
+    labels.npy = the label-name table, labels[y] is the original label of code y
+and is afterwards loaded as zero-copy memory-mapped views
+"""
+
+import os
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+# write the dataset name into the store, x_train_blocks and x_test_blocks are lists of 2-d arrays (blocks of rows) written one after the other,
+# so the sources never have to be concatenated in memory, y_train and y_test are the original labels of the rows
+# the files are written to a temporary directory that is renamed at the end, so an interrupted conversion never looks like a stored dataset
+def DataStore_Write(store_dir, name, x_train_blocks, y_train, x_test_blocks, y_test):
+    data_dir = os.path.join(store_dir, name)
+    tmp_dir = data_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    # code the labels of the training and testing sets with one label-name table
+    y_train = np.asarray(y_train)
+    y_test = np.asarray(y_test)
+    labels, y_code = np.unique(np.concatenate((y_train, y_test)), return_inverse=True)
+    np.save(os.path.join(tmp_dir, "labels.npy"), labels, allow_pickle=False)
+    np.save(os.path.join(tmp_dir, "y_train.npy"), y_code[:len(y_train)].astype(np.int32), allow_pickle=False)
+    np.save(os.path.join(tmp_dir, "y_test.npy"), y_code[len(y_train):].astype(np.int32), allow_pickle=False)
+    # write the feature blocks into float32 memmaps
+    for file_name, x_blocks in [("x_train.npy", x_train_blocks), ("x_test.npy", x_test_blocks)]:
+        num_rows = sum([len(block) for block in x_blocks])
+        d = np.shape(x_blocks[0])[1]
+        x = open_memmap(os.path.join(tmp_dir, file_name), mode="w+", dtype=np.float32, shape=(num_rows, d))
+        start = 0
+        for block in x_blocks:
+            x[start:start+len(block)] = block
+            start = start + len(block)
+        x.flush()
+        del x
+    if os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+    os.rename(tmp_dir, data_dir)
+    return data_dir
+
+
+# read the dataset name from the store as memory-mapped views, return None if it has not been converted yet
+# data_original_train = {"x": x_train, "y": y_train, "labels": labels}, data_original_test likewise
+def DataStore_Read(store_dir, name):
+    data_dir = os.path.join(store_dir, name)
+    if not os.path.isdir(data_dir):
+        return None
+    arrays = {}
+    for array_name in ["x_train", "y_train", "x_test", "y_test", "labels"]:
+        arrays[array_name] = np.load(os.path.join(data_dir, array_name + ".npy"), mmap_mode="r", allow_pickle=False)
+    data_original_train = {"x": arrays["x_train"], "y": arrays["y_train"], "labels": arrays["labels"]}
+    data_original_test = {"x": arrays["x_test"], "y": arrays["y_test"], "labels": arrays["labels"]}
+    return data_original_train, data_original_test
+
+
+# the same layout as DataStore_Read, kept in memory instead of the store
+def DataStore_Columns(x_train_blocks, y_train, x_test_blocks, y_test):
+    y_train = np.asarray(y_train)
+    y_test = np.asarray(y_test)
+    labels, y_code = np.unique(np.concatenate((y_train, y_test)), return_inverse=True)
+    data_original_train = {"x": np.concatenate(x_train_blocks).astype(np.float32), "y": y_code[:len(y_train)].astype(np.int32), "labels": labels}
+    data_original_test = {"x": np.concatenate(x_test_blocks).astype(np.float32), "y": y_code[len(y_train):].astype(np.int32), "labels": labels}
+    return data_original_train, data_original_test
+
+
+
+"""
+################################ MAIN TESTING FILE #####################################
+################################ FOR DEBUGGING ONLY #####################################
+
+testing the dataset store
+"""
+
+if __name__ == "__main__":
+
+    import tempfile
+    store_dir = tempfile.mkdtemp()
+    x_train_blocks = [np.random.randn(3, 4), np.random.randn(2, 4)]
+    y_train = ["b", "b", "a", "c", "a"]
+    x_test_blocks = [np.random.randn(2, 4)]
+    y_test = ["c", "a"]
+    DataStore_Write(store_dir, "toy", x_train_blocks, y_train, x_test_blocks, y_test)
+    data_original_train, data_original_test = DataStore_Read(store_dir, "toy")
+    print("x_train=", data_original_train["x"], data_original_train["x"].dtype)
+    print("y_train=", data_original_train["y"], "y_test=", data_original_test["y"], "labels=", data_original_train["labels"])
+    print("missing dataset=", DataStore_Read(store_dir, "missing"))
+    data_columns_train, data_columns_test = DataStore_Columns(x_train_blocks, y_train, x_test_blocks, y_test)
+    print("in-memory columns equal=", np.array_equal(data_columns_train["x"], data_original_train["x"]), np.array_equal(data_columns_test["y"], data_original_test["y"]))
+    del data_original_train, data_original_test
+    shutil.rmtree(store_dir)
@@ -0,0 +1,106 @@
+"""
+%%%%%%%%%%%%%%%%%%%% On-disk store of trained subspace-index models %%%%%%%%%%%%%%%%%%%%
+
+The artifacts of a trained model (PCA basis, inv_mat, tree cuts, leaf indexes, leaf means, LPP frames, train/test data)
+are kept as memory-mappable .npy files in the directory store_dir/key, where key is a hash of the training parameters and of a fingerprint of the data
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+# the key of a trained model, a hash of the dictionary params of the dataset choice and all training parameters
+# test-time parameters should be left out of params, so that changing them reuses the same stored model
+def LPP_ModelKey(params):
+    params_string = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(params_string.encode("utf-8")).hexdigest()[:16]
+
+
+# the fingerprint of the data a model is trained on, a hash of the shapes, dtypes and contents of the arrays, to be put into the params of LPP_ModelKey
+# so that a changed or replaced dataset never reuses a stale model, the arrays are read chunk by chunk so that memmaps are never loaded as a whole
+def LPP_DataFingerprint(arrays, chunk_size=2**24):
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = np.asarray(array)
+        if array.dtype == object:
+            array = array.astype(str)
+        sha.update(json.dumps([array.shape, str(array.dtype)]).encode("utf-8"))
+        flat = array.reshape(-1)
+        for start in range(0, len(flat), chunk_size):
+            sha.update(np.ascontiguousarray(flat[start:start+chunk_size]).tobytes())
+    return sha.hexdigest()[:16]
+
+
+# turn the leafs (list of lists of indexes) into a CSR pair: leafs[k] = leafs_perm[leafs_offsets[k]:leafs_offsets[k+1]]
+def leafs_to_csr(leafs):
+    leafs_offsets = np.zeros(len(leafs)+1, dtype=np.int64)
+    leafs_offsets[1:] = np.cumsum([len(leaf) for leaf in leafs])
+    leafs_perm = np.concatenate([np.asarray(leaf, dtype=np.int64) for leaf in leafs])
+    return leafs_perm, leafs_offsets
+
+
+# turn a CSR pair back into the leafs, each leaf is a (zero-copy) view of leafs_perm
+def csr_to_leafs(leafs_perm, leafs_offsets):
+    return [leafs_perm[leafs_offsets[k]:leafs_offsets[k+1]] for k in range(len(leafs_offsets)-1)]
+
+
+# save the model, a dictionary {name: array}, to store_dir/key/name.npy together with the params it was trained with
+# the files are written to a temporary directory that is renamed at the end, so an interrupted save never looks like a stored model
+def LPP_SaveModel(store_dir, key, model, params=None):
+    model_dir = os.path.join(store_dir, key)
+    tmp_dir = model_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, array in model.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.asarray(array), allow_pickle=False)
+    with open(os.path.join(tmp_dir, "params.json"), "w") as file:
+        json.dump(params, file, sort_keys=True, indent=1, default=str)
+    if os.path.isdir(model_dir):
+        shutil.rmtree(model_dir)
+    os.rename(tmp_dir, model_dir)
+    return model_dir
+
+
+# load the model stored under key as a dictionary {name: array}, the arrays are memory-mapped read-only
+# return None if no model is stored under key
+def LPP_LoadModel(store_dir, key):
+    model_dir = os.path.join(store_dir, key)
+    if not os.path.isdir(model_dir):
+        return None
+    model = {}
+    for file_name in os.listdir(model_dir):
+        if file_name.endswith(".npy"):
+            model[file_name[:-4]] = np.load(os.path.join(model_dir, file_name), mmap_mode="r", allow_pickle=False)
+    return model
+
+
+
+"""
+################################ MAIN TESTING FILE #####################################
+################################ FOR DEBUGGING ONLY #####################################
+
+testing the model store
+"""
+
+if __name__ == "__main__":
+
+    import tempfile
+    store_dir = tempfile.mkdtemp()
+    params = {"ht": 2, "d_LPP": 2, "data_fingerprint": LPP_DataFingerprint([np.arange(6.0), np.array([0, 1])])}
+    key = LPP_ModelKey(params)
+    leafs = [[0, 3], [1], [2, 4, 5]]
+    leafs_perm, leafs_offsets = leafs_to_csr(leafs)
+    model = {"Seq": np.random.randn(3, 4, 2), "leafs_perm": leafs_perm, "leafs_offsets": leafs_offsets}
+    LPP_SaveModel(store_dir, key, model, params)
+    model_loaded = LPP_LoadModel(store_dir, key)
+    print("key=", key)
+    print("Seq equal=", np.array_equal(model["Seq"], model_loaded["Seq"]))
+    print("leafs=", csr_to_leafs(model_loaded["leafs_perm"], model_loaded["leafs_offsets"]))
+    print("missing key=", LPP_LoadModel(store_dir, LPP_ModelKey({"ht": 3})))
+    params_changed = dict(params, data_fingerprint=LPP_DataFingerprint([np.arange(6.0) + 1, np.array([0, 1])]))
+    print("changed data, missing key=", LPP_LoadModel(store_dir, LPP_ModelKey(params_changed)))
+    shutil.rmtree(store_dir)
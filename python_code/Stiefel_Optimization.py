@@ -8,6 +8,7 @@ Title: Stiefel Optimization
 """
 
 import numpy as np
+from scipy.linalg import expm
 
 
 """
@@ -28,47 +29,93 @@ class Stiefel_Optimization:
         self.omega=omega
         self.Seq=Seq
         self.thereshold_gradnorm=threshold_gradnorm
+        self.threshold_fixedpoint=threshold_fixedpoint
         self.threshold_checkonStiefel=threshold_checkonStiefel
         self.threshold_logStiefel=threshold_logStiefel
         
         
     # given the matrix A in St(p, n), complete it into Q = [A B] in SO(n)
-    def Complete_SpecialOrthogonal(self, A):
+    # the complement B is taken from the Householder QR of A, so no n x n svd or determinant is needed: 
+    # with A = H R (H = H_1 ... H_p the product of the Householder reflections, R orthogonal upper triangular, so diagonal +-1), 
+    # det[A B] = det(H) det(R) = (-1)^(number of nontrivial reflections) * prod(diag(R)), and the first column of B is flipped if it is -1
+    # if implicit, return (A, complement) instead, where complement = (h, tau, sign) represents B for apply_complement and apply_complement_T, 
+    # in O(np) memory 
+    def Complete_SpecialOrthogonal(self, A, implicit=False):
         # first turn the matrix A into an array
-        A = np.array(A)
+        A = np.array(A, dtype=float)
         # the number of rows in A
         n = len(A)
         # the number of columns in A
         p = len(A[0])
-        # full svd decomposition of A
-        O1, D, O2 = np.linalg.svd(A, full_matrices=True)
-        D = np.diag(D)
-        # extend O2 to O2_ext = [O2 zeros(p, n-p); zeros(n-p, p) eye(n-p)]
-        O2_ext = np.pad(O2, ((0,n-p),(0,n-p)), 'constant', constant_values = (0,0))
-        for j in range(n-p):
-            O2_ext[p+j][p+j]=1
-        # compute Q = O1 * O2_ext, if det(Q)=-1, make it +1 
-        Q = np.matmul(O1, O2_ext)
-        if np.linalg.det(Q)<0:
-            Q[0:n-1, p] = -Q[0:n-1, p]
+        # thin svd decomposition of A, the first p columns of Q are O1 * O2
+        O1, D, O2 = np.linalg.svd(A, full_matrices=False)
+        A = np.matmul(O1, O2)
+        if p == n:
+            # A is square, so Q = A with its last column flipped if det(A) = -1, and the complement B is empty
+            if np.linalg.det(A) < 0:
+                A[:, -1] = -A[:, -1]
+            if implicit:
+                h, tau = np.linalg.qr(A, mode='raw')
+                return A, (h, tau, 1)
+            return A
+        # the Householder reflections of A, the row j of h holds the reflection vector v_j below its unit entry j
+        h, tau = np.linalg.qr(A, mode='raw')
+        # the sign of det[A B] for B the last n-p columns of H
+        sign = np.prod(np.sign(np.diag(h[:, :p]))) * (-1)**np.count_nonzero(tau)
+        complement = (h, tau, sign)
+        if implicit:
+            return A, complement
+        # form Q = [A B], with B = H * [zeros(p, n-p); eye(n-p)]
+        Q = np.zeros((n, n), dtype=float)
+        Q[:, :p] = A
+        Q[:, p:] = self.apply_complement(complement, np.identity(n-p))
         return Q
     
     
+    # given the implicit complement (h, tau, sign) of A returned by Complete_SpecialOrthogonal, compute B * X for X of size (n-p) x k in O(npk)
+    def apply_complement(self, complement, X):
+        h, tau, sign = complement
+        p, n = np.shape(h)
+        # Z = [zeros(p, k); X] with the first row of X signed, then Z = H_1 * (H_2 * ... (H_p * Z))
+        Z = np.zeros((n, np.shape(X)[1]), dtype=float)
+        Z[p:] = X
+        if p < n:
+            Z[p] = sign * Z[p]
+        for j in reversed(range(p)):
+            v = np.concatenate(([1], h[j, j+1:]))
+            Z[j:] = Z[j:] - tau[j] * np.outer(v, np.matmul(v, Z[j:]))
+        return Z
+    
+    
+    # given the implicit complement (h, tau, sign) of A returned by Complete_SpecialOrthogonal, compute B' * Z for Z of size n x k in O(npk)
+    def apply_complement_T(self, complement, Z):
+        h, tau, sign = complement
+        p, n = np.shape(h)
+        # H' * Z = H_p * (... (H_1 * Z)), B' * Z are its last n-p rows, with the first one signed
+        Z = np.array(Z, dtype=float)
+        for j in range(p):
+            v = np.concatenate(([1], h[j, j+1:]))
+            Z[j:] = Z[j:] - tau[j] * np.outer(v, np.matmul(v, Z[j:]))
+        X = Z[p:]
+        if p < n:
+            X[0] = sign * X[0]
+        return X
+    
+    
     # calculate the function value and the gradient on Stiefel manifold St(p, n) 
     # of the Euclidean center of mass function f_F(A)=\sum_{k=1}^m w_k \|A-A_k\|_F^2
     def Center_Mass_function_gradient_Euclid(self, Y):
-        # identify m
-        m = len(self.omega)
-        n = len(self.Seq[0])
-        p = len(self.Seq[0][0])
-        # evaluate f
-        f = 0
-        for i in range(m):
-            f = f + self.omega[i]*((np.linalg.norm(Y-self.Seq[i]))**2)
-        # evaluate gradf
-        gradf = np.zeros((n, p), dtype=float)
-        for i in range(m):
-            gradf = gradf + 2*self.omega[i]*((Y-self.Seq[i])-np.matmul(np.matmul(Y, (Y-self.Seq[i]).T), Y));
+        Y = np.array(Y, dtype=float)
+        omega = np.asarray(self.omega, dtype=float)
+        Seq = np.asarray(self.Seq, dtype=float)
+        # B = \sum_{k=1}^m w_k A_k and the total weight
+        B = np.einsum('k,knp->np', omega, Seq)
+        total_weight = np.sum(omega)
+        # evaluate f = \sum_k w_k (\|Y\|_F^2 + \|A_k\|_F^2 - 2 <Y, A_k>)
+        f = total_weight * np.sum(Y*Y) + np.einsum('k,knp,knp->', omega, Seq, Seq) - 2 * np.sum(Y*B)
+        # evaluate gradf = \sum_k 2 w_k ((Y-A_k) - Y (Y-A_k)' Y) = 2 (G - Y G' Y) with G = total_weight * Y - B, p x p products only
+        G = total_weight * Y - B
+        gradf = 2 * (G - np.matmul(Y, np.matmul(G.T, Y)))
         return f, gradf
     
     # directly calculate the Euclidean center of mass that is the St(p, n) minimizer of f_F(A)=\sum_{k=1}^m w_k\|A-A_k\|_F^2, 
@@ -79,22 +126,34 @@ class Stiefel_Optimization:
         n = len(self.Seq[0])
         p = len(self.Seq[0][0])
         # form B = \sum_{k=1}^m w_k A_k
-        B = np.zeros((n, p), dtype=float)
-        for i in range(m):
-            B = B + self.omega[i] * self.Seq[i]
-        # do svd on B
-        O1, D, O2 = np.linalg.svd(B, full_matrices=True)
-        D = np.diag(D)
-        # form the Euclid Center of Mass according to our elegant lemma based on SVD
-        Mtx = np.zeros((p, n), dtype=float)
-        for j in range(p):
-            Mtx[j][j]=1
-        Mtx = Mtx.T
-        Euclid_Center = np.matmul(np.matmul(O1, Mtx), O2)
+        B = np.einsum('k,knp->np', np.asarray(self.omega, dtype=float), np.asarray(self.Seq, dtype=float))
+        # do thin svd on B, O1 is n x p
+        O1, D, O2 = np.linalg.svd(B, full_matrices=False)
+        # form the Euclid Center of Mass according to our elegant lemma based on SVD, O1 * [I_p; 0] * O2 with the thin O1
+        Euclid_Center = np.matmul(O1, O2)
         # evaluate f_F(A)=\sum_{k=1}^m w_k\|A-A_k\|_F^2 at the center and its grad norm
         value, grad = self.Center_Mass_function_gradient_Euclid(Euclid_Center)
         gradnorm = np.linalg.norm(grad)
         return Euclid_Center, value, gradnorm
+    
+    
+    # find the Euclidean center of mass, the St(p, n) minimizer of f_F(A)=\sum_{k=1}^m w_k\|A-A_k\|_F^2, via Riemannian gradient descent started from Y,
+    # or from the closed-form center Center_Mass_Euclid if Y is None
+    # Y is added to the frames with weight 0, so the iteration runs on the coefficients of Frame_Grams, see Center_Mass_GD_Grams for iteration, lr, lrdecayrate and method
+    # returns the center, the sequences of values and gradient norms (one entry more than the iterations) and the number of iterations
+    def Center_Mass_GD_Euclid(self, Y=None, iteration=100, lr=1.0, lrdecayrate=1.0, method='cg'):
+        if Y is None:
+            Y = self.Center_Mass_Euclid()[0]
+        Y = np.array(Y, dtype=float)
+        p = len(Y[0])
+        grams = Frame_Grams(np.concatenate((np.asarray(self.Seq, dtype=float), [Y])))
+        omega = np.append(np.asarray(self.omega, dtype=float), 0)
+        C = np.zeros((len(omega), p, p), dtype=float)
+        C[-1] = np.identity(p)
+        C, valueseq, gradnormseq, iterations = Center_Mass_GD_Grams(grams, grams.function_gradient_Euclid, C, omega, None, False, 
+                                                                    self.thereshold_gradnorm, self.threshold_fixedpoint, iteration, lr, lrdecayrate, method)
+        GD_Euclid_Center = grams.frame(C)
+        return GD_Euclid_Center, valueseq, gradnormseq, iterations
 
 
     # test if the given matrix Y is on the Stiefel manifold St(p, n)
@@ -151,12 +210,345 @@ class Stiefel_Optimization:
         p = len(Y[0])
         # compute (Y' * Z - Z' * Y)/2        
         skew = np.subtract(np.matmul(Y.T, Z), np.matmul(Z.T, Y))/2
-        # form I_n matrix
-        eye_n = np.zeros((n, n), dtype=float)
-        np.fill_diagonal(eye_n, 1)        
-        # compute the projection
-        prj_tg = np.add(np.matmul(Y, skew), np.matmul(np.subtract(eye_n, np.matmul(Y, Y.T)), Z))
+        # compute the projection Y * skew + (I_n - Y * Y') * Z = Y * skew + Z - Y * (Y' * Z), without the n x n matrices
+        prj_tg = np.add(np.matmul(Y, skew), np.subtract(Z, np.matmul(Y, np.matmul(Y.T, Z))))
         return prj_tg
+    
+    
+    # Exponential Map on Stiefel manifold St(p, n), Y is the matrix on St(p, n) and H is the tangent vector
+    # returns M, N, Q and based on them one can calculate exp_Y(H) = YM+QN, see exp_stiefel
+    def ExpStiefel(self, Y, H):
+        return exp_stiefel(Y, H)
+    
+    
+    # Logarithmic Map on Stiefel manifold St(p, n), Y is the matrix on St(p, n) and Y_tilde is another matrix on St(p, n) close to Y
+    # returns A, B, Q such that one can calculate log_Y(Y_tilde) = H = YA+QB with the precision threshold_logStiefel, see log_stiefel
+    def LogStiefel(self, Y, Y_tilde, iteration=100):
+        A, B, Q, log, iterations = log_stiefel(Y, Y_tilde, self.threshold_logStiefel, iteration)
+        return A, B, Q, log
+
+
+
+# the Euclidean centers of mass of T weighted frame sets at once, the St(p, n) minimizers of f_F(A)=\sum_{k=1}^m w_{t,k}\|A-A_{t,k}\|_F^2
+# the frame sets are either the padded (T, m_max, n, p) tensor Seq, or, if indexes is given, the frames Seq[indexes[t, k]] of the (N, n, p) array Seq
+# with a (T, m_max) integer array indexes, the padding entries (negative indexes, or any frame) must have weight omega[t, k] = 0
+# B_t = \sum_k w_{t,k} A_{t,k} is accumulated by einsum, all centers U_t V_t' come from one stacked thin SVD B_t = U_t D_t V_t',
+# and f_F and its Stiefel gradient 2(G_t - Y G_t' Y) with G_t = (\sum_k w_{t,k}) Y - B_t are evaluated in closed form
+# return the (T, n, p) centers, the (T) values of f_F and the (T) gradient norms at the centers
+def Center_Mass_Euclid_Batch(omega, Seq, indexes=None):
+    omega = np.asarray(omega, dtype=float)
+    Seq = np.asarray(Seq, dtype=float)
+    if indexes is None:
+        # form B_t and \sum_k w_{t,k}\|A_{t,k}\|_F^2 from the frame tensor
+        B = np.einsum('tk,tknp->tnp', omega, Seq)
+        norm_frames = np.einsum('tk,tknp,tknp->t', omega, Seq, Seq)
+    else:
+        # gather the frames one padding column at a time, never forming the (T, m_max, n, p) tensor
+        indexes = np.where(np.asarray(indexes) < 0, 0, indexes)
+        norm_Seq = np.einsum('knp,knp->k', Seq, Seq)
+        B = np.zeros((len(omega), len(Seq[0]), len(Seq[0][0])), dtype=float)
+        for k in range(len(omega[0])):
+            B = B + omega[:, k, None, None] * Seq[indexes[:, k]]
+        norm_frames = np.sum(omega * norm_Seq[indexes], axis=1)
+    p = B.shape[2]
+    # stacked thin svd B_t = U_t D_t V_t', the center is U_t V_t'
+    U, D, Vt = np.linalg.svd(B, full_matrices=False)
+    centers = np.matmul(U, Vt)
+    # f_F = \sum_k w_k (\|Y\|_F^2 + \|A_k\|_F^2 - 2 <Y, A_k>) with \|Y\|_F^2 = p
+    sum_omega = np.sum(omega, axis=1)
+    values = sum_omega * p + norm_frames - 2 * np.einsum('tnp,tnp->t', centers, B)
+    # the gradient 2 \sum_k w_k ((Y-A_k) - Y (Y-A_k)' Y)
+    G = sum_omega[:, None, None] * centers - B
+    grads = 2 * (G - np.matmul(centers, np.matmul(np.transpose(G, (0, 2, 1)), centers)))
+    gradnorms = np.linalg.norm(grads, axis=(1, 2))
+    return centers, values, gradnorms
+
+
+
+# the Stiefel exponential map exp_Y(H) = YM+QN of stacks of points Y on St(p, n) and tangent vectors H, both (..., n, p)
+# with the thin QR decomposition QR = (I-YY')H, [M; N] are the first p columns of the 2p x 2p matrix exponential of [Y'H -R'; R 0]
+# returns M, N, Q and exp = exp_Y(H)
+def exp_stiefel(Y, H):
+    Y = np.asarray(Y, dtype=float)
+    H = np.asarray(H, dtype=float)
+    p = Y.shape[-1]
+    YtH = np.matmul(np.swapaxes(Y, -2, -1), H)
+    Q, R = np.linalg.qr(H - np.matmul(Y, YtH))
+    Mtx = np.zeros(Y.shape[:-2] + (2*p, 2*p), dtype=float)
+    Mtx[..., :p, :p] = YtH
+    Mtx[..., :p, p:] = -np.swapaxes(R, -2, -1)
+    Mtx[..., p:, :p] = R
+    Exponential = expm(Mtx)
+    M = Exponential[..., :p, :p]
+    N = Exponential[..., p:, :p]
+    exp = np.matmul(Y, M) + np.matmul(Q, N)
+    return M, N, Q, exp
+
+
+# the matrix logarithms of a stack (T, 2p, 2p) of matrices in SO(2p), from the batched eigendecomposition V = U diag(e^{i theta}) U^{-1}
+# (an orthogonal matrix is normal, so it is diagonalizable), the skew-symmetric part of the real U diag(i theta) U^{-1}
+def logm_orthogonal(V):
+    eigenvalues, U = np.linalg.eig(V)
+    L = np.matmul(U * np.log(eigenvalues)[..., None, :], np.linalg.inv(U)).real
+    return (L - np.swapaxes(L, -2, -1))/2
+
+
+# the Stiefel logarithmic map log_Y(Y_tilde) = YA+QB of stacks of points Y and Y_tilde on St(p, n), both (..., n, p), Y_tilde close to Y, 
+# by the iterative algorithm of the MATLAB LogStiefel: with M = Y'Y_tilde and the thin QR decomposition QN = Y_tilde-YM, 
+# complete [M; N] into V in SO(2p), and rotate the last p columns of V by expm(-C) until the lower right block C of log(V) = [A -B'; B C] 
+# has \|C\|_F < threshold, each pair leaves the iteration as soon as it converges, so only the slow pairs pay for more 2p x 2p logarithms
+# returns A, B, Q, log = log_Y(Y_tilde) and the number of iterations of each pair (iteration + 1 if it has not converged)
+def log_stiefel(Y, Y_tilde, threshold=1e-4, iteration=100):
+    Y = np.asarray(Y, dtype=float)
+    Y_tilde = np.asarray(Y_tilde, dtype=float)
+    shape = Y.shape[:-2]
+    n, p = Y.shape[-2:]
+    Y = Y.reshape(-1, n, p)
+    Y_tilde = Y_tilde.reshape(-1, n, p)
+    M = np.matmul(np.swapaxes(Y, -2, -1), Y_tilde)
+    Q, N = np.linalg.qr(Y_tilde - np.matmul(Y, M))
+    # complete [M; N] with the orthogonal complement from its full QR decomposition, flipping its last column if needed to get det(V) = 1
+    MN = np.concatenate((M, N), axis=1)
+    V = np.concatenate((MN, np.linalg.qr(MN, mode='complete')[0][..., p:]), axis=2)
+    V[:, :, -1] = V[:, :, -1] * np.sign(np.linalg.det(V))[:, None]
+    A = np.zeros((len(Y), p, p), dtype=float)
+    B = np.zeros((len(Y), p, p), dtype=float)
+    iterations = np.full(len(Y), iteration+1)
+    active = np.arange(len(Y))
+    for k in range(iteration+1):
+        Log_Matrix = logm_orthogonal(V[active])
+        A[active] = Log_Matrix[:, :p, :p]
+        B[active] = Log_Matrix[:, p:, :p]
+        C = Log_Matrix[:, p:, p:]
+        converged = np.linalg.norm(C, axis=(1, 2)) < threshold
+        iterations[active[converged]] = k
+        if k == iteration:
+            break
+        # rotate the last p columns of the pairs that have not converged
+        active, C = active[~converged], C[~converged]
+        if len(active) == 0:
+            break
+        V[active, :, p:] = np.matmul(V[active, :, p:], expm(-C))
+    log = np.matmul(Y, A) + np.matmul(Q, B)
+    return A.reshape(shape + (p, p)), B.reshape(shape + (p, p)), Q.reshape(shape + (n, p)), log.reshape(shape + (n, p)), iterations.reshape(shape)
+
+
+# the cross-Grams G[i, j] = A_i'A_j of the N frames of Seq, computed when the Frame_Grams is built, to evaluate the center of mass functions 
+# of both manifolds for any candidate frame Y in the span of the frames and any weights with p x p contractions only
+# the grams are a dense N x N x p x p array, so a Frame_Grams is built per query over its own frames (its m interpolation frames and the 
+# starting frame, as in Center_Mass_GD_Euclid and Center_Mass_GD_pFrobenius), not once over all leaf frames of a model, 
+# which would take 2^{2 ht} p^2 floats (8.6 GB at ht = 8, p = 128)
+# Y is represented by its coefficients C, a (m, p, p) stack with Y = \sum_j A_{indexes[j]} C_j, and the weights omega by a length m vector 
+# on the same frames (indexes = range(N) if None), C, omega and indexes may carry leading batch dimensions (..., m, p, p), (..., m), (..., m) 
+# the gradients are returned as coefficients D on the same frames, with their Riemannian norms
+# the descent iterates Y - t grad of the center of mass functions never leave the span of Y and the A_k, so the whole iteration can run on coefficients
+class Frame_Grams:
+
+    def __init__(self, Seq):
+        self.Seq = np.asarray(Seq, dtype=float)
+        # the (N, N, p, p) array of the p x p cross-Grams
+        self.grams = np.einsum('inp,jnq->ijpq', self.Seq, self.Seq)
+        
+        
+    # the cross-Grams of the frames indexes, a (..., m, m, p, p) array
+    def sub_grams(self, indexes=None):
+        if indexes is None:
+            return self.grams
+        indexes = np.asarray(indexes)
+        return self.grams[indexes[..., :, None], indexes[..., None, :]]
+    
+    
+    # the frame Y = \sum_j A_{indexes[j]} C_j of the coefficients C
+    def frame(self, C, indexes=None):
+        Seq = self.Seq if indexes is None else self.Seq[np.asarray(indexes)]
+        return np.einsum('...jnp,...jpq->...nq', Seq, C)
+    
+    
+    # the coefficients C of the frame Y (n x p) on the frames indexes, the least squares solution of \sum_j A_{indexes[j]} C_j = Y, 
+    # exact when Y is in the span of the frames, the only step that touches the n-dimensional frames
+    def coefficients(self, Y, indexes=None):
+        Seq = self.Seq if indexes is None else self.Seq[np.asarray(indexes)]
+        m, n, p = np.shape(Seq)
+        q = len(Y[0])
+        A = np.transpose(Seq, (1, 0, 2)).reshape(n, m*p)
+        C = np.linalg.lstsq(A, np.asarray(Y, dtype=float), rcond=None)[0]
+        return C.reshape(m, p, q)
+    
+    
+    # the products P[k] = Y'A_k, Y'Y and the total weight of the coefficients C, shared by the evaluations below
+    def products(self, C, omega, indexes=None):
+        G = self.sub_grams(indexes)
+        P = np.einsum('...jpq,...jkpr->...kqr', C, G)
+        YtY = np.einsum('...kqr,...krs->...qs', P, C)
+        return G, P, YtY, np.sum(omega, axis=-1)
+    
+    
+    # the p x p products Y'Z = \sum_{j,k} C_j' A_j'A_k Z_k of the frames of the coefficients C and Z
+    def cross(self, C, Z, indexes=None):
+        G = self.sub_grams(indexes)
+        return np.einsum('...jpq,...jkpr,...krs->...qs', C, G, Z)
+    
+    
+    # the Frobenius inner products <\sum_j A_j D1_j, \sum_j A_j D2_j> of the coefficients D1 and D2
+    def inner(self, D1, D2, indexes=None):
+        return np.trace(self.cross(D1, D2, indexes), axis1=-2, axis2=-1)
+    
+    
+    # the Riemannian norms \|\sum_j A_j D_j\|_F of the coefficients D, from the quadratic form of the Grams, 
+    # so norms far below sqrt(machine precision) times the size of D are only resolved up to that floor
+    def norm(self, D, indexes=None):
+        return np.sqrt(np.maximum(self.inner(D, D, indexes), 0))
+    
+    
+    # the projection of Z onto the tangent space at Y, Z - Y (Y'Z + Z'Y)/2 on St(p, n), or the horizontal Z - Y Y'Z on Gr(p, n) if grassmann
+    def projection_tangent(self, C, Z, indexes=None, grassmann=False):
+        YtZ = self.cross(C, Z, indexes)
+        if not grassmann:
+            YtZ = (YtZ + np.swapaxes(YtZ, -2, -1))/2
+        return Z - np.matmul(C, YtZ[..., None, :, :])
+    
+    
+    # the Stiefel gradient D of the canonical metric (as from function_gradient_Euclid) turned into the one of the embedded metric, D - Y (Y'D)/2,
+    # which is the tangent projection of the Euclidean gradient, so that the Frobenius inner product <D_e, H> is the directional derivative along a tangent H 
+    # (<D, H> is not), on Gr(p, n) Y'D = 0 and both agree
+    def gradient_embedded(self, C, D, indexes=None, grassmann=False):
+        if grassmann:
+            return D
+        return D - np.matmul(C, self.cross(C, D, indexes)[..., None, :, :])/2
+    
+    
+    # the polar retraction of Y + H back onto St(p, n), the coefficients (C + D) S^{-1/2} with S = (Y + H)'(Y + H), 
+    # it is also a retraction on Gr(p, n) since the center of mass function there only depends on the span
+    def retraction(self, C, D, indexes=None):
+        E = C + D
+        s, V = np.linalg.eigh(self.cross(E, E, indexes))
+        S_inv_sqrt = np.matmul(V / np.sqrt(s)[..., None, :], np.swapaxes(V, -2, -1))
+        return np.matmul(E, S_inv_sqrt[..., None, :, :])
+    
+    
+    # the value and the Stiefel gradient of the Euclidean center of mass function f_F(Y)=\sum_k w_k \|Y-A_k\|_F^2, as in Stiefel_Optimization
+    # f_F = (\sum_k w_k) tr(Y'Y) + \sum_k w_k tr(A_k'A_k) - 2 \sum_k w_k tr(Y'A_k), 
+    # gradf = 2 (H - Y H'Y) with H = (\sum_k w_k) Y - \sum_k w_k A_k, the coefficients of H are (\sum_k w_k) C_j - w_j I_p
+    def function_gradient_Euclid(self, C, omega, indexes=None):
+        C = np.asarray(C, dtype=float)
+        omega = np.asarray(omega, dtype=float)
+        G, P, YtY, total_weight = self.products(C, omega, indexes)
+        eye_p = np.identity(C.shape[-1])
+        trace_frames = np.einsum('...kkpp->...k', G)
+        trace_P = np.einsum('...kpp->...k', P)
+        value = total_weight * np.trace(YtY, axis1=-2, axis2=-1) + np.sum(omega * (trace_frames - 2 * trace_P), axis=-1)
+        # H'Y = (\sum_k w_k) Y'Y - \sum_k w_k A_k'Y
+        HtY = total_weight[..., None, None] * YtY - np.einsum('...k,...kqr->...rq', omega, P)
+        H = total_weight[..., None, None, None] * C - omega[..., None, None] * eye_p
+        D = 2 * (H - np.matmul(C, HtY[..., None, :, :]))
+        return value, D, self.norm(D, indexes)
+    
+    
+    # the value and the Grassmann gradient of the projected Frobenius center of mass function f(Y) = \sum_k w_k \|YY'-A_kA_k'\|_F^2, as in Grassmann_Optimization
+    # f = \sum_k w_k (\|Y'Y\|_F^2 + \|A_k'A_k\|_F^2 - 2 \|Y'A_k\|_F^2), 
+    # gradf = (I - YY') H with H = 2 (\sum_k w_k) Y - 4 \sum_k w_k A_k A_k'Y, the coefficients of H are 2 (\sum_k w_k) C_j - 4 w_j A_j'Y
+    def function_gradient_pFrobenius(self, C, omega, indexes=None):
+        C = np.asarray(C, dtype=float)
+        omega = np.asarray(omega, dtype=float)
+        G, P, YtY, total_weight = self.products(C, omega, indexes)
+        norm_frames = np.einsum('...kkpq,...kkpq->...k', G, G)
+        norm_P = np.sum(P**2, axis=(-2, -1))
+        value = np.sum(omega * (np.sum(YtY**2, axis=(-2, -1))[..., None] + norm_frames - 2 * norm_P), axis=-1)
+        H = 2 * total_weight[..., None, None, None] * C - 4 * omega[..., None, None] * np.swapaxes(P, -2, -1)
+        # Y'H = \sum_k Y'A_k H_k
+        YtH = np.einsum('...kqr,...krs->...qs', P, H)
+        D = H - np.matmul(C, YtH[..., None, :, :])
+        return value, D, self.norm(D, indexes)
+
+
+
+# minimize the center of mass function evaluate (grams.function_gradient_Euclid, or grams.function_gradient_pFrobenius with grassmann = True) 
+# over the frames with coefficients C by Riemannian descent on the Frame_Grams grams, every step is p x p work, 
+# C, omega and indexes may carry leading batch dimensions, then the queries are iterated together and each one stops on its own
+# method = 'gd' is the fixed step lr, decayed by lrdecayrate once the gradnorm is below threshold_gradnorm and stopped below 0.1 threshold_gradnorm, as in MATLAB, 
+# method = 'armijo' is steepest descent with Armijo backtracking from the step lr, later from twice the last accepted step, 
+# method = 'cg' is Riemannian conjugate gradient (Polak-Ribiere+, directions transported by tangent projection) with the same line search, 
+# the slopes, the steepest descent directions and the Polak-Ribiere coefficients use the gradient of the embedded metric (see gradient_embedded), 
+# a conjugate direction along which the line search fails is replaced by the steepest descent direction with the step lr,
+# both stop once the gradnorm is below threshold_gradnorm, or when the backtracking step along the steepest descent direction drops below threshold_fixedpoint lr 
+# without a decrease
+# returns the coefficients of the centers, the values and the gradnorms of the iterates (iteration + 1, ...), padded with the last ones after a query stops, 
+# and the number of iterations of each query
+def Center_Mass_GD_Grams(grams, evaluate, C, omega, indexes=None, grassmann=False, threshold_gradnorm=1e-4, threshold_fixedpoint=1e-4, 
+                         iteration=100, lr=1.0, lrdecayrate=1.0, method='cg', armijo=1e-4, backtrack=0.5):
+    C = np.array(C, dtype=float)
+    omega = np.asarray(omega, dtype=float)
+    value, grad, gradnorm = evaluate(C, omega, indexes)
+    # the gradient norm below which a query is done
+    stop = 0.1 * threshold_gradnorm if method == 'gd' else threshold_gradnorm
+    active = gradnorm >= stop
+    grad_embedded = grams.gradient_embedded(C, grad, indexes, grassmann)
+    direction = -grad if method == 'gd' else -grad_embedded
+    # the queries whose direction is the steepest descent one
+    steepest = np.ones(np.shape(gradnorm), dtype=bool)
+    step = lr * np.ones(np.shape(gradnorm))
+    iterations = np.zeros(np.shape(gradnorm), dtype=int)
+    valueseq = [value]
+    gradnormseq = [gradnorm]
+    for i in range(iteration):
+        if not np.any(active):
+            break
+        if method == 'gd':
+            step = np.where(active & (gradnorm < threshold_gradnorm), step * lrdecayrate, step)
+            C_new = grams.retraction(C, step[..., None, None, None] * direction, indexes)
+            stalled = np.zeros(np.shape(active), dtype=bool)
+            restart = np.zeros(np.shape(active), dtype=bool)
+        else:
+            # fall back to steepest descent where the conjugate direction is not a descent direction
+            slope = grams.inner(grad_embedded, direction, indexes)
+            reset = slope >= 0
+            direction = np.where(reset[..., None, None, None], -grad_embedded, direction)
+            slope = np.where(reset, -grams.inner(grad_embedded, grad_embedded, indexes), slope)
+            steepest = steepest | reset
+            # Armijo backtracking, all queries still searching try their current step together
+            C_new = C
+            searching = active.copy()
+            stalled = np.zeros(np.shape(active), dtype=bool)
+            while np.any(searching):
+                C_trial = grams.retraction(C, step[..., None, None, None] * direction, indexes)
+                value_trial = evaluate(C_trial, omega, indexes)[0]
+                accept = searching & (value_trial <= value + armijo * step * slope)
+                stalled = stalled | (searching & ~accept & (step < threshold_fixedpoint * lr))
+                C_new = np.where(accept[..., None, None, None], C_trial, C_new)
+                searching = searching & ~accept & ~stalled
+                step = np.where(searching, step * backtrack, step)
+            # the conjugate directions along which the line search failed restart from the steepest descent direction and the step lr
+            restart = stalled & ~steepest
+            stalled = stalled & ~restart
+            direction = np.where(restart[..., None, None, None], -grad_embedded, direction)
+            steepest = steepest | restart
+            step = np.where(restart, lr, np.where(active & ~stalled, step / backtrack, step))
+        value_new, grad_new, gradnorm_new = evaluate(C_new, omega, indexes)
+        grad_embedded_new = grams.gradient_embedded(C_new, grad_new, indexes, grassmann)
+        if method == 'cg':
+            # Polak-Ribiere+ on the old gradient and direction transported to the new iterate
+            grad_transported = grams.projection_tangent(C_new, grad_embedded, indexes, grassmann)
+            beta = np.maximum(grams.inner(grad_embedded_new, grad_embedded_new - grad_transported, indexes) 
+                              / np.maximum(grams.inner(grad_embedded, grad_embedded, indexes), np.finfo(float).tiny), 0)
+            direction_new = -grad_embedded_new + beta[..., None, None, None] * grams.projection_tangent(C_new, direction, indexes, grassmann)
+            steepest_new = beta == 0
+        else:
+            direction_new = -grad_new if method == 'gd' else -grad_embedded_new
+            steepest_new = np.ones(np.shape(gradnorm), dtype=bool)
+        # update the queries that moved, the restarted ones stay where they are and search along the new direction next
+        moved = active & ~stalled & ~restart
+        C = np.where(moved[..., None, None, None], C_new, C)
+        value = np.where(moved, value_new, value)
+        grad = np.where(moved[..., None, None, None], grad_new, grad)
+        grad_embedded = np.where(moved[..., None, None, None], grad_embedded_new, grad_embedded)
+        gradnorm = np.where(moved, gradnorm_new, gradnorm)
+        direction = np.where(moved[..., None, None, None], direction_new, direction)
+        steepest = np.where(moved, steepest_new, steepest)
+        iterations = iterations + moved
+        active = (moved & (gradnorm >= stop)) | (active & restart)
+        valueseq.append(value)
+        gradnormseq.append(gradnorm)
+    return C, np.array(valueseq), np.array(gradnormseq), iterations
 
 
 
@@ -180,7 +572,7 @@ if __name__ == "__main__":
     Seq[2] = np.array([[0, 0], [0, 1], [0, 0], [1, 0]])
     # set the weights
     omega = np.array([1, 3, 4])
-    omega = omega.astype(np.float)
+    omega = omega.astype(float)
     # set the threshold numbers
     threshold_gradnorm = 1e-4
     threshold_fixedpoint = 1e-4
@@ -225,4 +617,48 @@ if __name__ == "__main__":
         for i in range(m):
             print("frame ", i+1, "weight is ", omega[i], " matrix is \n", Seq[i], "\n")
         print("center is \n", center, "\n")
-        print("function f_F(A)=\sum_{k=1}^m w_k\|A-A_k\|_F^2\nvalue is ", value, "\ngradnorm is ", gradnorm, "\n")
\ No newline at end of file
+        print("function f_F(A)=\sum_{k=1}^m w_k\|A-A_k\|_F^2\nvalue is ", value, "\ngradnorm is ", gradnorm, "\n")
+
+
+    # do the batched Euclid center of mass, of the frame set above and of its first two frames padded with a zero weight
+    doCenterMassEuclidBatch = 1
+    if doCenterMassEuclidBatch:
+        omega_batch = np.array([omega, [omega[0], omega[1], 0]])
+        Seq_batch = np.array([Seq, Seq])
+        centers, values, gradnorms = Center_Mass_Euclid_Batch(omega_batch, Seq_batch)
+        print("batched centers are \n", centers, "\nvalues are ", values, "\ngradnorms are ", gradnorms, "\n")
+        centers, values, gradnorms = Center_Mass_Euclid_Batch(omega_batch, Seq, [[0, 1, 2], [0, 1, -1]])
+        print("batched centers by indexes, values are ", values, "\ngradnorms are ", gradnorms, "\n")
+
+
+    # do the Gram-based evaluation at the Euclid center, from its coefficients on the frames
+    doFrameGrams = 1
+    if doFrameGrams:
+        grams = Frame_Grams(Seq)
+        center, value, gradnorm = StiefelOpt.Center_Mass_Euclid()
+        C = grams.coefficients(center)
+        value_grams, D, gradnorm_grams = grams.function_gradient_Euclid(C, omega)
+        print("Gram-based value is ", value_grams, " gradnorm is ", gradnorm_grams, "\n")
+        value_grams, D, gradnorm_grams = grams.function_gradient_Euclid(grams.coefficients(center, [0, 1]), omega[:2], [0, 1])
+        value, grad = Stiefel_Optimization(omega[:2], Seq[:2], threshold_gradnorm, threshold_fixedpoint, threshold_checkonStiefel, threshold_logStiefel).Center_Mass_function_gradient_Euclid(center)
+        print("Gram-based value on the first two frames is ", value_grams, " direct value is ", value, "\n")
+
+
+    # do the Euclid center of mass by Riemannian GD from the first frame, with fixed steps, Armijo line search and conjugate gradients
+    doCenterMassGDEuclid = 1
+    if doCenterMassGDEuclid:
+        for method in ['gd', 'armijo', 'cg']:
+            center, valueseq, gradnormseq, iterations = StiefelOpt.Center_Mass_GD_Euclid(Seq[0], 1000, 0.02, 1.0, method)
+            print(method, ": iterations = ", iterations, " value = ", valueseq[-1], " gradnorm = ", gradnormseq[-1], "\n")
+        print("center is \n", center, "\n")
+
+
+    # do the batched Stiefel exponential and logarithmic maps, log_Y(exp_Y(H)) = H for the tangent vectors H at Y = Seq[0]
+    doExpLogStiefel = 1
+    if doExpLogStiefel:
+        Y = np.array([Seq[0], Seq[0], Seq[1]], dtype=float)
+        H = StiefelOpt.projection_tangent(Seq[0], Seq[2])
+        H = np.array([0.5 * H, 0.1 * H, 0.3 * StiefelOpt.projection_tangent(Seq[1], Seq[0])])
+        M, N, Q, exp = exp_stiefel(Y, H)
+        A, B, Q, log, iterations = log_stiefel(Y, exp, 1e-10)
+        print("exp on Stiefel = ", [StiefelOpt.CheckOnStiefel(_)[0] for _ in exp], "\nlog error = ", np.linalg.norm(log - H, axis=(1, 2)), "\niterations = ", iterations, "\n")
@@ -8,110 +8,482 @@ Note: This is the python version of the matlab code BuildVisualWordList.m origin
 """
 
 import numpy as np
-from operator import itemgetter
 import math
+import multiprocessing
 
 ############################################################################
-# function buildVisualWordList()
+# class VisualWordIndex
+# compact array-backed kd-tree index, as returned by buildVisualWordIndex
+# fields:
+#   d_cuts, v_cuts - cut dimensions (int32) and cut values (float64) of the parent nodes 1, ..., 2^ht-1 of the tree as built
+#   leaf_nodes - leaf k is the leaf node 2^ht + leaf_nodes[k] of the tree as built
+#   node_dims, node_vals, node_kids, node_leafs - the tree as explicit node arrays (node 0 is the root), kept up to date by insert:
+#                                                 a node is either a cut x(node_dims) <= node_vals going to node_kids[:, 0], else to node_kids[:, 1],
+#                                                 or the leaf node_leafs (node_kids = -1)
+#   leafs_perm, leafs_offsets - leafs in CSR form, the members of leaf k are leafs_perm[leafs_offsets[k]:leafs_offsets[k+1]]
+#   mbrs_min, mbrs_max - (number of leafs x d) min bounding rectangles of the leafs, of the data x the tree was built on
+#   leafs_means - (number of leafs x d) means of the leafs, of the data x the tree was built on
+#                 (both are set by buildVisualWordIndex and kept up to date by insert only, compute_mbrs and compute_means never change them)
+#   PCA_basis_kdtree, offs_kdtree - how the data was embedded for the tree (None if not), see LPP_KdtreeEmbedding in LPP_CenterMass
+#   x, y - the data the tree was built on and its labels, needed by insert, not saved (None if not attached)
+#   dirty - dirty[k] is True if leaf k was changed by insert since its LPP frame was computed
+############################################################################
+
+class VisualWordIndex:
+
+    def __init__(self,
+                 d_cuts,            # the cut dimensions
+                 v_cuts,            # the cut values
+                 leaf_nodes,        # the tree position of each leaf
+                 leafs_perm,        # the members of all leafs, leaf after leaf
+                 leafs_offsets,     # the start of each leaf in leafs_perm
+                 mbrs_min,          # the lower corners of the min bounding rectangles
+                 mbrs_max,          # the upper corners of the min bounding rectangles
+                 leafs_means,       # the means of the leafs
+                 PCA_basis_kdtree=None,     # the second level PCA basis the tree was built on
+                 offs_kdtree=None,          # the tuning permutation of dimensions the tree was built on
+                 nodes=None                 # the explicit node arrays (node_dims, node_vals, node_kids, node_leafs), None to derive them from the cuts
+                 ):
+        self.d_cuts = np.asarray(d_cuts, dtype=np.int32)
+        self.v_cuts = np.asarray(v_cuts, dtype=np.float64)
+        self.leaf_nodes = np.asarray(leaf_nodes, dtype=np.int32)
+        self.leafs_perm = np.asarray(leafs_perm, dtype=np.int64)
+        self.leafs_offsets = np.asarray(leafs_offsets, dtype=np.int64)
+        self.mbrs_min = None if mbrs_min is None else np.asarray(mbrs_min)
+        self.mbrs_max = None if mbrs_max is None else np.asarray(mbrs_max)
+        self.leafs_means = None if leafs_means is None else np.asarray(leafs_means)
+        self.PCA_basis_kdtree = PCA_basis_kdtree
+        self.offs_kdtree = offs_kdtree
+        self.num_leafs = len(self.leafs_offsets) - 1
+        if nodes is None:
+            # heap node k (1-based) of the tree as built is node k-1, with kids 2k-1 and 2k
+            nLeafNode = len(self.d_cuts) + 1
+            nNode = 2*nLeafNode - 1
+            self.node_dims = np.zeros(nNode, dtype=np.int32)
+            self.node_dims[:nLeafNode-1] = self.d_cuts
+            self.node_vals = np.zeros(nNode)
+            self.node_vals[:nLeafNode-1] = self.v_cuts
+            self.node_kids = -np.ones((nNode, 2), dtype=np.int64)
+            self.node_kids[:nLeafNode-1, 0] = 2*np.arange(1, nLeafNode) - 1
+            self.node_kids[:nLeafNode-1, 1] = 2*np.arange(1, nLeafNode)
+            self.node_leafs = -np.ones(nNode, dtype=np.int64)
+            self.node_leafs[nLeafNode-1 + self.leaf_nodes] = np.arange(nLeafNode)
+        else:
+            self.node_dims, self.node_vals, self.node_kids, self.node_leafs = [np.asarray(array) for array in nodes]
+        self.x = None
+        self.y = None
+        self.dirty = np.zeros(self.num_leafs, dtype=bool)
+
+
+    # the members of leaf k, a view of leafs_perm
+    def leaf(self, k):
+        return self.leafs_perm[self.leafs_offsets[k]:self.leafs_offsets[k+1]]
+
+
+    # the members of all leafs, as a list of views of leafs_perm
+    def leafs(self):
+        return [self.leaf(k) for k in range(self.num_leafs)]
+
+
+    # the number of members of each leaf
+    def leaf_sizes(self):
+        return np.diff(self.leafs_offsets)
+
+
+    # the means of the leafs of the data X (rows indexed as in leafs_perm) by segmented reduction, returned without changing leafs_means
+    def compute_means(self, X):
+        X = np.asarray(X)
+        sums = np.add.reduceat(X[self.leafs_perm], self.leafs_offsets[:-1], axis=0)
+        return sums / np.maximum(self.leaf_sizes(), 1)[:, None]
+
+
+    # the min bounding rectangles (mbrs_min, mbrs_max) of the leafs of the data X by segmented reduction, returned without changing the index's own
+    def compute_mbrs(self, X):
+        X_perm = np.asarray(X)[self.leafs_perm]
+        return np.minimum.reduceat(X_perm, self.leafs_offsets[:-1], axis=0), np.maximum.reduceat(X_perm, self.leafs_offsets[:-1], axis=0)
+
+
+    # attach the data x the tree was built on (rows indexed as in leafs_perm) and its labels y, as needed by insert
+    def attach_data(self, x, y=None):
+        self.x = np.asarray(x)
+        self.y = None if y is None else np.asarray(y)
+
+
+    # set the leafs to the list of index arrays leafs, in CSR form
+    def set_leafs(self, leafs):
+        self.leafs_offsets = np.zeros(len(leafs)+1, dtype=np.int64)
+        self.leafs_offsets[1:] = np.cumsum([len(leaf) for leaf in leafs])
+        self.leafs_perm = np.concatenate(leafs).astype(np.int64)
+        self.num_leafs = len(leafs)
+
+
+    # append the members new_members[k] (an index array) to leaf k for each k, e.g. the augmented data of the leaf 
+    # the new members have no coordinates in the attached data, so the attached data is dropped
+    def extend_leafs(self, new_members):
+        self.set_leafs([np.concatenate((self.leaf(k), np.asarray(new_members[k], dtype=np.int64))) for k in range(self.num_leafs)])
+        self.x = None
+        self.y = None
+
+
+    # insert the new points (in the coordinates of the attached data x) with labels, they become the rows len(x), len(x)+1, ... of x
+    # each point is routed to its leaf, the MBRs and means of the leafs receiving points are updated,
+    # and the leafs with more than max_leaf_size members (if given) are split at the median of their dimension of maximal variance
+    # return the leafs changed (or created) by the insertion, they are also marked in dirty until their LPP frames are recomputed
+    def insert(self, points, labels, max_leaf_size=None):
+        if self.x is None:
+            raise ValueError("insert needs the data the tree was built on, see attach_data")
+        points = np.atleast_2d(np.asarray(points))
+        labels = np.asarray(labels)
+        ids = np.arange(len(self.x), len(self.x)+len(points))
+        self.x = np.concatenate((self.x, points))
+        if self.y is not None:
+            self.y = np.concatenate((self.y, labels))
+        # route the points to their leafs and group them by leaf
+        leaf_ids, _ = locate(self, points, None)
+        order = np.argsort(leaf_ids, kind='stable')
+        counts = np.bincount(leaf_ids, minlength=self.num_leafs)
+        changed = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        new_members = np.split(ids[order], np.cumsum(counts)[:-1])
+        sizes = self.leaf_sizes()
+        self.set_leafs([np.concatenate((self.leaf(k), new_members[k])) for k in range(self.num_leafs)])
+        # update the MBRs and means of the changed leafs by segmented reductions over the new points,
+        # those of an index loaded from the model store are read-only memory maps and are copied first
+        self.mbrs_min, self.mbrs_max, self.leafs_means = [np.array(array) for array in (self.mbrs_min, self.mbrs_max, self.leafs_means)]
+        points_sorted = points[order]
+        self.mbrs_min[changed] = np.minimum(self.mbrs_min[changed], np.minimum.reduceat(points_sorted, starts[changed], axis=0))
+        self.mbrs_max[changed] = np.maximum(self.mbrs_max[changed], np.maximum.reduceat(points_sorted, starts[changed], axis=0))
+        sums = np.add.reduceat(points_sorted, starts[changed], axis=0)
+        self.leafs_means[changed] = (self.leafs_means[changed] * sizes[changed][:, None] + sums) / (sizes[changed] + counts[changed])[:, None]
+        self.dirty[changed] = True
+        # split the leafs over the size bound, a split leaf keeps its left half and its right half becomes a new leaf
+        if max_leaf_size is not None:
+            oversized = list(changed[self.leaf_sizes()[changed] > max_leaf_size])
+            while len(oversized) > 0:
+                k = oversized.pop()
+                new_leaf = self.split_leaf(k)
+                changed = np.append(changed, new_leaf)
+                oversized.extend([_ for _ in [k, new_leaf] if self.leaf_sizes()[_] > max_leaf_size])
+        return np.unique(changed)
+
+
+    # split leaf k as buildVisualWordIndex splits a node: at the median of its dimension of maximal variance, its left half stays leaf k,
+    # its right half becomes the new leaf num_leafs, return the new leaf
+    def split_leaf(self, k):
+        members = self.leaf(k)
+        x_members = self.x[members]
+        d_cut, v_cut, left = splitVisualWordNode(x_members, False)
+        # the leaf node of k becomes a cut node with two new leaf nodes as kids
+        node = int(np.flatnonzero(self.node_leafs == k)[0])
+        new_leaf = self.num_leafs
+        num_nodes = len(self.node_dims)
+        self.node_dims = np.concatenate((self.node_dims, [0, 0]))
+        self.node_vals = np.concatenate((self.node_vals, [0, 0]))
+        self.node_kids = np.concatenate((self.node_kids, -np.ones((2, 2), dtype=np.int64)))
+        self.node_leafs = np.concatenate((self.node_leafs, [k, new_leaf]))
+        self.node_dims[node] = d_cut
+        self.node_vals[node] = v_cut
+        self.node_kids[node] = [num_nodes, num_nodes+1]
+        self.node_leafs[node] = -1
+        leafs = self.leafs()
+        leafs[k] = members[left]
+        leafs.append(members[~left])
+        self.set_leafs(leafs)
+        # the MBRs and means of both halfs
+        self.mbrs_min = np.concatenate((self.mbrs_min, np.zeros((1, self.x.shape[1]))))
+        self.mbrs_max = np.concatenate((self.mbrs_max, np.zeros((1, self.x.shape[1]))))
+        self.leafs_means = np.concatenate((self.leafs_means, np.zeros((1, self.x.shape[1]))))
+        for leaf in [k, new_leaf]:
+            x_leaf = self.x[self.leaf(leaf)]
+            self.mbrs_min[leaf] = np.min(x_leaf, 0)
+            self.mbrs_max[leaf] = np.max(x_leaf, 0)
+            self.leafs_means[leaf] = np.mean(x_leaf, 0)
+        self.dirty = np.append(self.dirty, True)
+        self.dirty[k] = True
+        return new_leaf
+
+
+    # the index in the output format of buildVisualWordList: indx dictionary, list of lists leafs, list of dictionaries mbrs
+    # the indx dictionary describes the tree as built, without the splits of insert
+    def to_lists(self):
+        indx = {"d_cuts": self.d_cuts.tolist(), "v_cuts": self.v_cuts.tolist(), "leaf_nodes": self.leaf_nodes.tolist()}
+        leafs = [leaf.tolist() for leaf in self.leafs()]
+        mbrs = [{"min": self.mbrs_min[k].tolist(), "max": self.mbrs_max[k].tolist()} for k in range(self.num_leafs)]
+        return indx, leafs, mbrs
+
+
+    # the fields of the index as a dictionary {name: array}, the embedding fields only if they are set
+    def to_arrays(self):
+        arrays = {"d_cuts": self.d_cuts, "v_cuts": self.v_cuts, "leaf_nodes": self.leaf_nodes,
+                  "node_dims": self.node_dims, "node_vals": self.node_vals, "node_kids": self.node_kids, "node_leafs": self.node_leafs,
+                  "leafs_perm": self.leafs_perm, "leafs_offsets": self.leafs_offsets,
+                  "mbrs_min": self.mbrs_min, "mbrs_max": self.mbrs_max, "leafs_means": self.leafs_means}
+        if self.PCA_basis_kdtree is not None:
+            arrays["PCA_basis_kdtree"] = self.PCA_basis_kdtree
+        if self.offs_kdtree is not None:
+            arrays["offs_kdtree"] = self.offs_kdtree
+        return arrays
+
+
+    # rebuild the index from a dictionary {name: array} as given by to_arrays, other entries are ignored
+    @staticmethod
+    def from_arrays(arrays):
+        return VisualWordIndex(arrays["d_cuts"], arrays["v_cuts"], arrays["leaf_nodes"], 
+                               arrays["leafs_perm"], arrays["leafs_offsets"], 
+                               arrays["mbrs_min"], arrays["mbrs_max"], arrays["leafs_means"],
+                               arrays["PCA_basis_kdtree"] if "PCA_basis_kdtree" in arrays else None,
+                               arrays["offs_kdtree"] if "offs_kdtree" in arrays else None,
+                               [arrays[name] for name in ["node_dims", "node_vals", "node_kids", "node_leafs"]] if "node_dims" in arrays else None)
+
+
+    # save the index into the single .npz file file_name
+    def save(self, file_name):
+        np.savez(file_name, **self.to_arrays())
+
+
+    # load an index saved by save
+    @staticmethod
+    def load(file_name):
+        with np.load(file_name, allow_pickle=False) as arrays:
+            return VisualWordIndex.from_arrays({name: arrays[name] for name in arrays.files})
+
+
+
+
+############################################################################
+# function splitVisualWordNode()
+# the cut of one node of the kd-tree
+# input:
+#   x_node - the rows of x in the node, in the order of its members (stably sorted by their values at the cut of the parent, as in the original code)
+#   first_cut - if True cut at dimension 0 (the root), otherwise at the dimension of maximal variance
+# output:
+#   d_cut, v_cut - the cut dimension and the median value at d_cut
+#   left - boolean mask of the members going to the left kid, the floor(nk/2) smallest values; among values equal to v_cut the earlier members go left
+############################################################################
+
+def splitVisualWordNode(x_node, first_cut):
+
+    nk = len(x_node)
+    # median offs
+    moffs = math.floor(nk/2)-1
+    if first_cut:
+        d_cut = 0
+    else:
+        # compute the covariance of x in the node along the kd dimensions, find the dimension with the maximal variance
+        d_cut = int(np.argmax(np.var(x_node, 0)))
+    # the median value at dimension d_cut by linear-time selection
+    v_k = x_node[:, d_cut]
+    v_cut = np.partition(v_k, moffs)[moffs]
+    left = v_k < v_cut
+    equal = np.flatnonzero(v_k == v_cut)
+    left[equal[:moffs+1-np.count_nonzero(left)]] = True
+
+    return d_cut, v_cut, left
+
+
+
+
+############################################################################
+# function buildVisualWordSubtree()
+# build the subtree of height ht below node root of the kd-tree, as one task of the process pool in buildVisualWordIndex
+# input (as one tuple):
+#   x - the rows of the data in the subtree root, in the order of its members
+#   values - the values of these rows at the cut of the parent of root
+#   ht - the subtree height
+#   root - the (1-based) heap number of the subtree root in the whole tree
+#   quiet - if True, do not print the splits
+# output:
+#   d_cuts, v_cuts - cut dimensions and values of the subtree nodes 1, ..., 2^ht-1 in local heap numbering
+#   leafs - the 2^ht subtree leaf nodes, as (member indexes in x, values at the cut of their parent)
+############################################################################
+
+def buildVisualWordSubtree(task):
+
+    x, values, ht, root, quiet = task
+    nNode = 2**(ht+1) - 1 
+    # intermediate storages, offs[k-1] is the integer index array of the members of local node k
+    offs = [None for _ in range(nNode)]
+    offs[0] = np.arange(len(x))
+    # the order of the members of a node is the sorted order of their values at the cut of its parent
+    parent_values = [None for _ in range(nNode)]
+    parent_values[0] = np.asarray(values)
+    d_cuts = np.zeros(2**ht-1, dtype=np.int32)
+    v_cuts = np.zeros(2**ht-1)
+
+    # first cut at dimension 0, then the parents nodes at height h+1 are cut at their dimension of maximal variance
+    for k in range(1, 2**ht):
+        offs_k = offs[k-1]
+        nk = len(offs_k)
+        # the heap number of local node k in the whole tree
+        level = int(math.log2(k))
+        k_global = root * 2**level + k - 2**level
+        d_cut, v_cut, left = splitVisualWordNode(x[offs_k], k_global == 1)
+        d_cuts[k-1] = d_cut 
+        v_cuts[k-1] = v_cut
+        v_k = x[offs_k, d_cut]
+        # current parent node k, left kid would be 2k, right kid would be 2k+1
+        # each kid lists its members stably sorted by their values at the cut, as the sort of the original code, 
+        # so that the ties at the next cut are broken in the same order
+        for kid, side in [(2*k, left), (2*k+1, ~left)]:
+            order = np.argsort(v_k[side], kind='stable')
+            offs[kid-1] = offs_k[side][order]
+            parent_values[kid-1] = v_k[side][order]
+
+        # prompt
+        if k_global > 1 and not quiet:
+            print("split [", k_global+1, ":", nk, "] at", d_cut, ": ", v_cut)
+
+        # clean up node k
+        offs[k-1] = None
+        parent_values[k-1] = None
+
+    leafs = [(offs[2**ht+j-1], parent_values[2**ht+j-1]) for j in range(2**ht)]
+    return d_cuts, v_cuts, leafs
+
+
+
+
+############################################################################
+# function buildVisualWordIndex()
 # visual code word and inverted list approach with kd-tree in fast dub detection
 # input:
 #   x - n x d data points
 #   ht - kd-tree height
+#   quiet - if True, do not print the splits
+#   y - the labels of x, attached to the index for insert (optional)
+#   parallel_depth - if given, the 2^parallel_depth subtrees below depth parallel_depth are built concurrently in a pool of num_workers processes
+#   num_workers - the size of the process pool (None for the number of cpus)
 # output:
-#   indx - indx structure with dim and val of cuts
-#   leafs - leaf nodes of offs of x. 
-#   mbrs - min bounding rectangles
+#   index - VisualWordIndex with the cuts, the leafs in CSR form, the min bounding rectangles and the leaf means of x, with x (and y) attached
 ############################################################################
 
-def buildVisualWordList(x, ht):
-    
+def buildVisualWordIndex(x, ht, quiet=False, y=None, parallel_depth=None, num_workers=None):
+
     # turn x into an array of dimension n times d, x is an array
-    x = np.array(x)
-    #print("x=", x)
-    #print("ht=", ht)
+    x = np.asarray(x)
     # var
     n = len(x)
-    #print("n=", n)
-    kd = len(x[0])
-    nNode = 2**(ht+1) - 1 
     nLeafNode = 2**ht
-        
-    # intermediate storages, offs is a list of lists
-    offs = [[] for _ in range(nNode)]
-    #print("offs=", offs)
-    
-    # initialize indx as a dictionary {"d_cuts": [store cut dimensions], "v_cuts": [store cut values]}
-    indx = {"d_cuts": [], "v_cuts": []}
-    
-    # first cut
-    # cut at dimension 0
-    indx['d_cuts'].append(0) 
-    # sort the x-value at first dimension, sv, soffs are lists
-    soffs, sv = zip(*sorted(enumerate(x.T[0]), key=itemgetter(1))) 
-    sv = list(sv)
-    soffs = list(soffs)
-    #print("sv=", sv)
-    #print("soffs=", soffs)
-    indx['v_cuts'].append(sv[math.floor(n/2)-1])
-    #print("indx=", indx)
-    
-    # split at mv, left child x(:,1) <= mv, right child x(:,1) > mv
-    offs[1]=soffs[1-1 : math.floor(n/2)] 
-    offs[2]=soffs[math.floor(n/2)+1-1 : n]
-    #print("offs=", offs)
-    
-    for h in range(ht-1):
-        #print("h=", h)
-        # parents nodes at height h+1
-        for k in range(2**(h+1), 2**(h+1+1)):
-            #print("k=", k)
-            # compute covariance
-            offs_k = offs[k-1]
-            #print("offs_k=", offs_k)
-            nk = len(offs_k)
-            # median offs 
-            moffs = math.floor(nk/2)-1 
-            # pick all rows of x with indexes from offs_k
-            x_offs_k = [x[_] for _ in offs_k]
-            x_offs_k = np.array(x_offs_k)
-            #print("x_offs_k=", x_offs_k)
-            # compute the covariance of x in offs_k along the kd dimensions, find the dimension with the maximal variance
-            sk = np.var(x_offs_k, 0)
-            #print("sk=", sk)
-            max_s = max(sk)
-            sk = list(sk)
-            d_cut = sk.index(max(sk))
-            #print("d_cut=", d_cut)
-            # cut x in offs_k at dimension d_cut
-            indx['d_cuts'].append(d_cut) 
-            # sort the x-value in offs_k at dimension d_cut, sv, soffs are lists
-            soffs, sv = zip(*sorted(enumerate(x_offs_k.T[d_cut]), key=itemgetter(1))) 
-            sv = list(sv)
-            soffs = list(soffs)
-            #print("sv=", sv)
-            #print("soffs=", soffs)
-            indx['v_cuts'].append(sv[moffs])
-            #print("indx=", indx)
-            # current parent node k, left kid would be 2k, right kid would be 2k+1
-            offs[2*k-1]     = [offs_k[_] for _ in soffs[1-1:moffs+1]]
-            offs[2*k+1-1]   = [offs_k[_] for _ in soffs[moffs+1+1-1:nk]] 
-            
-            # prompt
-            print("split [", k+1, ":", nk, "] at", d_cut, ": ", sv[moffs]) 
-                
-            # clean up node k
-            offs[k-1] = []
-            
-    #print("offs=", offs)
-    # leaf nodes
-    leafs = sorted([offs[2**ht+j-1] for j in range(nLeafNode)])
-    #print("leafs=", leafs)
-    
-    mbrs = [{"min": [min([x[_][col] for _ in leafs[j]]) for col in range(kd)], "max": [max([x[_][col] for _ in leafs[j]]) for col in range(kd)]} for j in range(nLeafNode)]
-    #print("mbrs=", mbrs)
-    
-    return indx, leafs, mbrs
 
+    # the cut dimensions and cut values of the parent nodes 1, ..., 2^ht-1
+    d_cuts = np.zeros(nLeafNode-1, dtype=np.int32)
+    v_cuts = np.zeros(nLeafNode-1)
+
+    if parallel_depth is None or parallel_depth <= 0 or parallel_depth >= ht:
+        d_cuts, v_cuts, leafs = buildVisualWordSubtree((x, np.zeros(n), ht, 1, quiet))
+        leafs = [offs_j[np.argsort(values_j, kind='stable')] for offs_j, values_j in leafs]
+    else:
+        # the top of the tree down to depth parallel_depth
+        d_cuts_top, v_cuts_top, roots = buildVisualWordSubtree((x, np.zeros(n), parallel_depth, 1, quiet))
+        d_cuts[:2**parallel_depth-1] = d_cuts_top
+        v_cuts[:2**parallel_depth-1] = v_cuts_top
+        # the subtrees below depth parallel_depth, each in a worker process
+        ht_sub = ht - parallel_depth
+        tasks = [(x[offs_r], values_r, ht_sub, 2**parallel_depth + r, quiet) for r, (offs_r, values_r) in enumerate(roots)]
+        with multiprocessing.Pool(num_workers) as pool:
+            subtrees = pool.map(buildVisualWordSubtree, tasks)
+        leafs = []
+        for r, (d_cuts_r, v_cuts_r, leafs_r) in enumerate(subtrees):
+            root = 2**parallel_depth + r
+            # local node k at level l of the subtree is the node root*2^l + k - 2^l of the whole tree
+            for level in range(ht_sub):
+                k_local = np.arange(2**level, 2**(level+1))
+                k_global = root * 2**level + k_local - 2**level
+                d_cuts[k_global-1] = d_cuts_r[k_local-1]
+                v_cuts[k_global-1] = v_cuts_r[k_local-1]
+            offs_r = roots[r][0]
+            leafs.extend([offs_r[offs_j[np.argsort(values_j, kind='stable')]] for offs_j, values_j in leafs_r])
+
+    # leaf nodes, each leaf is ordered by the values at the cut of its parent, the leafs are sorted
+    # leaf k is the leaf node 2^ht + leaf_nodes[k] of the tree
+    leaf_nodes = sorted(range(nLeafNode), key=lambda j: leafs[j].tolist())
+    leafs_offsets = np.zeros(nLeafNode+1, dtype=np.int64)
+    leafs_offsets[1:] = np.cumsum([len(leafs[j]) for j in leaf_nodes])
+    leafs_perm = np.concatenate([leafs[j] for j in leaf_nodes]).astype(np.int64)
+
+    index = VisualWordIndex(d_cuts, v_cuts, leaf_nodes, leafs_perm, leafs_offsets, None, None, None)
+    # min bounding rectangles and means by segmented reductions over the leafs
+    index.mbrs_min, index.mbrs_max = index.compute_mbrs(x)
+    index.leafs_means = index.compute_means(x)
+    index.attach_data(x, y)
+
+    return index
+
+
+
+
+############################################################################
+# function buildVisualWordList()
+# visual code word and inverted list approach with kd-tree in fast dub detection
+# input:
+#   x - n x d data points
+#   ht - kd-tree height
+#   quiet - if True, do not print the splits
+# output:
+#   indx - indx structure with dim and val of cuts, and the tree position of each leaf in leafs
+#   leafs - leaf nodes of offs of x. 
+#   mbrs - min bounding rectangles
+############################################################################
+
+def buildVisualWordList(x, ht, quiet=False):
+
+    return buildVisualWordIndex(x, ht, quiet).to_lists()
+
+
+
+
+############################################################################
+# function locate()
+# point location of a batch of queries on the kd-tree built by buildVisualWordList, descending all queries level by level
+# input:
+#   indx - indx structure returned by buildVisualWordList, or the VisualWordIndex returned by buildVisualWordIndex
+#   X_queries - nq x d query points, in the same coordinates as the x the tree was built on
+#   margin - None for the defeatist search (x(d_cut) <= v_cut goes left), otherwise also descend into the far child whenever |x(d_cut) - v_cut| <= margin
+#            the default 0 follows both children at ties: the split puts the values equal to the median on both sides, as the original code,
+#            so with the defeatist search the tied training points (many on integer-valued data) would not be located in their own leaf
+# output:
+#   leaf_ids, offsets - the leafs located for X_queries[i] are leaf_ids[offsets[i]:offsets[i+1]], in the order of leafs
+#   with margin None every query is located in exactly one leaf, so that offsets = 0, 1, ..., nq and leaf_ids[i] is the leaf containing X_queries[i]
+############################################################################
+
+def locate(indx, X_queries, margin=0):
+
+    X_queries = np.atleast_2d(np.asarray(X_queries))
+    nq = len(X_queries)
+    if not isinstance(indx, VisualWordIndex):
+        indx = VisualWordIndex(indx['d_cuts'], indx['v_cuts'], indx['leaf_nodes'], [], [0], None, None, None)
+
+    # the frontier of (query, node) pairs, starting at the root node 0
+    query = np.arange(nq)
+    node = np.zeros(nq, dtype=np.int64)
+    located_query = []
+    located_leaf = []
+    while len(query) > 0:
+        # the pairs arrived at a leaf are located
+        at_leaf = indx.node_kids[node, 0] < 0
+        located_query.append(query[at_leaf])
+        located_leaf.append(indx.node_leafs[node[at_leaf]])
+        query = query[~at_leaf]
+        node = node[~at_leaf]
+        diff = X_queries[query, indx.node_dims[node]] - indx.node_vals[node]
+        # left child x(:, d_cut) <= v_cut, right child x(:, d_cut) > v_cut
+        side = (diff > 0).astype(np.int64)
+        near = indx.node_kids[node, side]
+        if margin is None:
+            node = near
+        else:
+            # backtrack into the far child for the pairs within margin of the split plane
+            far = np.abs(diff) <= margin
+            query = np.concatenate((query, query[far]))
+            node = np.concatenate((near, indx.node_kids[node[far], 1 - side[far]]))
+
+    query = np.concatenate(located_query)
+    leaf_ids = np.concatenate(located_leaf)
+    # group the located leafs by query
+    order = np.lexsort((leaf_ids, query))
+    offsets = np.zeros(nq+1, dtype=int)
+    offsets[1:] = np.cumsum(np.bincount(query, minlength=nq))
+    return leaf_ids[order], offsets
 
 
 
@@ -124,10 +496,28 @@ testing buildVisualWordList
 """
 
 if __name__ == "__main__":
-    
+
     x = [[2, 1], [4, 3], [5, 6], [8, 7], [9, 10], [12, 11], [13, 14], [16, 15], [17, 18], [20, 19], [21, 22], [24, 23], [25, 26], [28, 27], [30, 29], [31, 32]]
     ht = 3
     indx, leafs, mbrs = buildVisualWordList(x, ht)
     print("leafs=", leafs)
     print("indx=", indx)
     print("mbrs=", mbrs)
+    x_queries = [[3, 2], [15, 15], [30, 31]]
+    print("located leafs=", locate(indx, x_queries, None))
+    print("located leafs within margin 1=", locate(indx, x_queries, 1))
+    index = buildVisualWordIndex(x, ht, quiet=True)
+    print("leafs_perm=", index.leafs_perm, "leafs_offsets=", index.leafs_offsets)
+    print("leafs_means=", index.leafs_means)
+    print("located leafs with the index=", locate(index, x_queries, None))
+    x_ties = np.floor(np.asarray(x) / 8)
+    index_ties = buildVisualWordIndex(x_ties, ht, quiet=True)
+    leaf_ids, offsets = locate(index_ties, x_ties)
+    print("tied points located in their own leaf=", all(k in leaf_ids[offsets[i]:offsets[i+1]] for k in range(index_ties.num_leafs) for i in index_ties.leaf(k)))
+    index_parallel = buildVisualWordIndex(x, ht, quiet=True, parallel_depth=1, num_workers=2)
+    print("parallel build equal=", np.array_equal(index_parallel.leafs_perm, index.leafs_perm), np.array_equal(index_parallel.v_cuts, index.v_cuts))
+    index.attach_data(x, np.arange(len(x)) % 2)
+    changed = index.insert([[3, 3], [3.5, 2], [29, 30]], [0, 1, 0], max_leaf_size=3)
+    print("changed leafs=", changed, "dirty=", index.dirty)
+    print("leafs after insert=", index.leafs())
+    print("located leafs after insert=", locate(index, [[3, 3], [3.5, 2], [29, 30]], None))
@@ -0,0 +1,53 @@
+"""
+%%%%%%%%%%%%%%%%%%%% Smoke tests of the LPP_CenterMass pipeline on small synthetic data %%%%%%%%%%%%%%%%%%%%
+
+Run with python -m pytest from python_code
+"""
+
+import ast
+import os
+import numpy as np
+import pytest
+from sklearn.datasets import make_classification
+from buildVisualWordList import buildVisualWordIndex
+from LPP_Auxiliary import knn_batch, knn_tree_batch, PCA_Basis, PCA_Project
+from LPP_DataStore import DataStore_Columns
+
+# importing LPP_CenterMass builds the pre-trained learning models (tensorflow and their stored weights),
+# so the functions under test are compiled from its source into a namespace holding the globals of its __main__ block
+def LPP_CenterMass_Functions(names, settings):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "LPP_CenterMass.py")
+    with open(path) as source:
+        tree = ast.parse(source.read())
+    module = ast.Module([node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in names], [])
+    namespace = {"np": np, "buildVisualWordIndex": buildVisualWordIndex, "knn_batch": knn_batch, "knn_tree_batch": knn_tree_batch,
+                 "PCA_Basis": PCA_Basis, "PCA_Project": PCA_Project}
+    namespace.update(settings)
+    exec(compile(module, path, "exec"), namespace)
+    return namespace
+
+
+# a small synthetic classification data set, in the layout returned by load_data
+def SyntheticData(n_train, n_test, d):
+    x, y = make_classification(n_samples=n_train+n_test, n_features=d, n_informative=d//2, n_classes=3, random_state=0)
+    return DataStore_Columns([x[:n_train]], y[:n_train], [x[n_train:]], y[n_train:])
+
+
+# the full data set k-nearest neighbor test, brute force and on the kd-tree leafs, with and without held out insertion data
+@pytest.mark.parametrize("doTreeKnn", [0, 1])
+@pytest.mark.parametrize("doInsertData", [0, 1])
+def test_OriginalFullDataSet_NearestNeighborTest(tmp_path, monkeypatch, doTreeKnn, doInsertData):
+    np.random.seed(0)
+    settings = {"doMNIST": 0, "doCIFAR10": 0, "doOlivetti": 0, "dovgg_faces": 0, "dopca256": 1,
+                "do_preliminary_PCA_reduction": 1, "PCA_solver": "full", "d_PCA": 8,
+                "doAugment_Global": 0, "doSecondPCA_kdtree": 1, "d_SecondPCA_kdtree": 4, "dokdtreetuning": 0,
+                "kdtree_parallel_depth": 0, "num_workers_build": 1, "doInsertData": doInsertData, "insert_size": 20,
+                "doAugment_kdtreeCluster": 0, "doUseAugmentData_kdtreeCluster": 0, "doTreeKnn": doTreeKnn, "k_nearest_neighbor": 3,
+                "train_size": 300, "test_size": 50, "ht": 3}
+    data_original_train, data_original_test = SyntheticData(400, 80, 12)
+    namespace = LPP_CenterMass_Functions(["LPP_ObtainData", "OriginalFullDataSet_NearestNeighborTest"], settings)
+    namespace["load_data"] = lambda *args: (data_original_train, data_original_test)
+    monkeypatch.chdir(tmp_path)
+    rate_f = namespace["OriginalFullDataSet_NearestNeighborTest"]()
+    assert 0 <= rate_f <= 100
+    assert (tmp_path / "conclusion_originalknn.txt").exists()
@@ -39,6 +39,7 @@ import tensorflow.keras.backend as K
 import scipy.io
 #import cv2
 import matplotlib.pyplot as plt
+from LPP_DataStore import DataStore_Write, DataStore_Read
 
 # Files used for face detection, download from https://github.com/spmallick/learnopencv/tree/master/FaceDetectionComparison/models
 modelFile ="res10_300x300_ssd_iter_140000_fp16.caffemodel"
@@ -149,50 +150,45 @@ class vggFace:
             return x1, y1, x2, y2
         return cv_rgb
 
-    def load_data(self, Vgg_Embedded_Matfile):
+    # load the embedded faces as float32 arrays with int label codes, le_name_mapping[code] is the name of the class
+    # if data_store_dir is given, the split dataset is converted once into the columnar store and then returned as memory-mapped views
+    def load_data(self, Vgg_Embedded_Matfile, data_store_dir=None):
+        data_name = os.path.splitext(os.path.basename(Vgg_Embedded_Matfile))[0]
+        if data_store_dir is not None:
+            data_stored = DataStore_Read(data_store_dir, data_name)
+            if data_stored is not None:
+                data_original_train, data_original_test = data_stored
+                le_name_mapping = dict(enumerate(data_original_train["labels"]))
+                return data_original_train["x"], data_original_train["y"], data_original_test["x"], data_original_test["y"], le_name_mapping
         vgg_faces = scipy.io.loadmat(Vgg_Embedded_Matfile,
                                      matlab_compatible=False, struct_as_record=False, squeeze_me=True)
         keys = list(k for k, v in vgg_faces.items() if k not in ['__header__', '__version__', '__globals__'])
-        num_classes = len(keys)
-        data_original = {"x": [], "y": []}
-        for i in range(num_classes):
-            num_faces = len(vgg_faces[keys[i]])
-            for j in range(num_faces):
-                data_original["x"].append(list(vgg_faces[keys[i]][j]))
-                data_original["y"].append(keys[i])
-
-        from sklearn.preprocessing import LabelEncoder
-        # creating instance of labelencoder
-        le = LabelEncoder()
-        le.fit(data_original["y"])
-        le_name_mapping = dict(zip(le.transform(le.classes_), le.classes_))
+        # one block of rows per class, the class keys are the labels
+        x_blocks = [np.atleast_2d(vgg_faces[key]) for key in keys]
+        y = np.repeat(keys, [len(block) for block in x_blocks])
+        x = np.concatenate(x_blocks).astype(np.float32)
+
+        # the label codes are the indexes of the sorted names, as given by a LabelEncoder
+        labels, y_code = np.unique(y, return_inverse=True)
+        le_name_mapping = dict(enumerate(labels))
         print(le_name_mapping)
-        data_original["y"] = le.transform(data_original["y"])
 
-        num_total_faces = len(data_original["y"])
+        num_total_faces = len(y)
         # split into the training and testing data sets
-        data_original_train = {"x": [], "y": []}
-        data_original_test = {"x": [], "y": []}
-        # extract the training and testing data sets
         indexes = np.random.permutation(num_total_faces)
         train_size = int(0.9 * num_total_faces)
-
-        train_indexes = [indexes[_] for _ in range(train_size)]
-        test_indexes = [indexes[_] for _ in range(train_size, num_total_faces)]
-        data_original_train["x"] = [data_original["x"][_] for _ in train_indexes]
-        data_original_train["y"] = [data_original["y"][_] for _ in train_indexes]
-        data_original_test["x"] = [data_original["x"][_] for _ in test_indexes]
-        data_original_test["y"] = [data_original["y"][_] for _ in test_indexes]
-
-        x_train = data_original_train["x"]
-        y_train = data_original_train["y"]
-        x_test = data_original_test["x"]
-        y_test = data_original_test["y"]
-
-        x_train = np.array(x_train, dtype=np.float)
-        y_train = np.array(y_train)
-        x_test = np.array(x_test, dtype=np.float)
-        y_test = np.array(y_test)
+        train_indexes = indexes[:train_size]
+        test_indexes = indexes[train_size:]
+
+        if data_store_dir is not None:
+            DataStore_Write(data_store_dir, data_name, [x[train_indexes]], y[train_indexes], [x[test_indexes]], y[test_indexes])
+            data_original_train, data_original_test = DataStore_Read(data_store_dir, data_name)
+            return data_original_train["x"], data_original_train["y"], data_original_test["x"], data_original_test["y"], le_name_mapping
+
+        x_train = x[train_indexes]
+        y_train = y_code[train_indexes]
+        x_test = x[test_indexes]
+        y_test = y_code[test_indexes]
 
         return x_train, y_train, x_test, y_test, le_name_mapping
 